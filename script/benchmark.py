@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：生成模拟的contig基因组、HiFi-C/Pore-C reads及对应的PAF，逐个阶段
+（fq_split、paf2mnd、排序+dups.awk/dups.py去重、post_review.py的ass2fasta）在不同
+进程数、块大小下运行，记录records/s、MB/s和峰值内存，结果写出JSON，便于在自己的
+机器上对比不同版本。
+
+峰值内存记录两项：peak_rss_mb为单个进程的峰值（os.wait4取rusage，含已回收的子进程，
+取最大值而非总和）；peak_tree_rss_mb为定时采样/proc得到的整个进程树（含多进程阶段的
+所有工作进程）RSS之和的峰值，仅Linux，采样间隔内的短暂峰值可能漏掉。
+post_review阶段需要pysam，未安装时跳过；只测试ass2fasta（review assembly转FASTA），
+不运行依赖3d-dna的步骤。
+
+# 生成数据并测试（相同参数的数据已存在时直接复用）
+python3 benchmark.py --workdir bench --reads 5000 --threads 1,4,16 -o bench.json
+
+# Pore-C模拟数据，测试按字节分块
+python3 benchmark.py --workdir bench_ont --read_type ont --enzyme_site CATG \
+                     --threads 8,32 --chunk_bytes 0,16777216 -o bench_ont.json
+
+# 只测试部分阶段
+python3 benchmark.py --workdir bench --stages paf2mnd --paf_chunk_sizes 100000,1000000 -o paf.json
+
+# 只测试post_review（模拟review assembly分为10条染色体）
+python3 benchmark.py --workdir bench --stages post_review --chrom_num 10 -o post_review.json
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import fq_split
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 模拟参数：read长度为对数正态分布（中位数、sigma），ont带随机替换错误
+READ_TYPES = {
+    'hifi': {'median_length': 15000, 'sigma': 0.35, 'error_rate': 0.0, 'identity': 0.99},
+    'ont': {'median_length': 30000, 'sigma': 0.8, 'error_rate': 0.05, 'identity': 0.90},
+}
+MAX_READ_LENGTH = 300000
+SECONDARY_RATE = 0.03
+COMPLEMENT = bytes.maketrans(b"ACGT", b"TGCA")
+# 随机字节到碱基、质量值的映射表
+BASE_TABLE = b"ACGT" * 64
+QUAL_TABLE = b"5?IIIIII" * 32
+STAGES = ('fq_split', 'paf2mnd', 'dedup', 'post_review')
+# 进程树RSS的采样间隔（秒）
+RSS_SAMPLE_INTERVAL = 0.1
+# 模拟review assembly中未挂载到染色体的片段比例
+UNANCHORED_RATE = 0.1
+
+def parse_int_list(value):
+    """解析逗号分隔的整数列表"""
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer list: {value}")
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def random_bytes(length, table, rng):
+    """按映射表生成长度为length的随机序列"""
+    if length <= 0:
+        return b""
+    return rng.getrandbits(8 * length).to_bytes(length, 'little').translate(table)
+
+def generate_genome(path, contigs, contig_length, rng):
+    """生成随机contig基因组并写出FASTA，返回 [(名称, 序列bytes), ...]"""
+    genome = []
+    with open(path, 'wb') as f:
+        for i in range(contigs):
+            name = f"ctg{i + 1:04d}"
+            seq = random_bytes(contig_length, BASE_TABLE, rng)
+            genome.append((name, seq))
+            f.write(b">%s\n" % name.encode('ascii'))
+            for start in range(0, len(seq), 80):
+                f.write(seq[start:start + 80] + b"\n")
+    return genome
+
+def site_fragments(genome, scanner):
+    """按酶切位点把基因组切成片段，返回 [(contig序号, 起点, 终点), ...]"""
+    fragments = []
+    for index, (_, seq) in enumerate(genome):
+        sites = [0] + [site for site in scanner.cut_sites(seq) if site > 0] + [len(seq)]
+        for start, end in zip(sites, sites[1:]):
+            if end > start:
+                fragments.append((index, start, end))
+    return fragments
+
+def mutate(seq, error_rate, rng):
+    """按error_rate随机替换碱基"""
+    if not error_rate or not seq:
+        return seq
+    seq = bytearray(seq)
+    for i in rng.sample(range(len(seq)), int(len(seq) * error_rate)):
+        seq[i] = rng.choice(b"ACGT".replace(bytes([seq[i]]), b""))
+    return bytes(seq)
+
+def simulate_read(genome, fragments, profile, rng):
+    """拼接随机基因组片段组成一条read，返回 (序列, [(read起点, 终点, contig序号, 基因组起点, 链)])"""
+    target = min(MAX_READ_LENGTH, int(rng.lognormvariate(math.log(profile['median_length']),
+                                                         profile['sigma'])))
+    pieces = []
+    segments = []
+    length = 0
+    while length < target:
+        index, start, end = fragments[rng.randrange(len(fragments))]
+        # 部分酶切：偶尔把相邻的几个片段连在一起
+        while rng.random() < 0.1 and end < len(genome[index][1]):
+            end = min(len(genome[index][1]), end + rng.randint(100, 1000))
+        seq = genome[index][1][start:end]
+        strand = '+'
+        if rng.random() < 0.5:
+            seq = reverse_complement(seq)
+            strand = '-'
+        pieces.append(seq)
+        segments.append((length, length + len(seq), index, start, strand))
+        length += len(seq)
+    return mutate(b"".join(pieces), profile['error_rate'], rng), segments
+
+def paf_lines(read_name, seq, segments, genome, scanner, min_length, profile, rng):
+    """模拟fq_split切割后各片段的比对结果（与fq_split的片段命名一致）"""
+    lines = []
+    pos_start = 0
+    for pos_end in scanner.cut_sites(seq) + [len(seq)]:
+        length = pos_end - pos_start
+        if length >= min_length:
+            # 以片段中点所在的基因组片段作为比对位置
+            middle = (pos_start + pos_end) // 2
+            for read_start, read_end, index, genome_start, strand in segments:
+                if read_start <= middle < read_end:
+                    break
+            name, contig = genome[index]
+            if strand == '+':
+                target_start = genome_start + max(0, pos_start - read_start)
+            else:
+                target_start = genome_start + max(0, read_end - pos_end)
+            target_start = min(target_start, len(contig) - 1)
+            target_end = min(len(contig), target_start + length)
+            identity = min(1.0, rng.gauss(profile['identity'], 0.05))
+            matches = int(length * identity)
+            mapq = 60 if rng.random() > 0.1 else rng.randint(0, 30)
+            record = (f"{read_name}:{pos_start + 1}-{pos_end}\t{length}\t0\t{length}\t{strand}\t"
+                      f"{name}\t{len(contig)}\t{target_start}\t{target_end}\t{matches}\t{length}\t"
+                      f"{mapq}\ttp:A:P\tcm:i:{length // 20}\n")
+            lines.append(record)
+            # 少量多重比对，paf2mnd会将其过滤
+            if rng.random() < SECONDARY_RATE:
+                lines.append(record)
+        pos_start = pos_end
+    return lines
+
+def generate_dataset(args):
+    """生成基因组、FASTQ和PAF，返回数据集描述"""
+    rng = random.Random(args.seed)
+    profile = READ_TYPES[args.read_type]
+    scanner = fq_split.SiteScanner(args.enzyme_site)
+    paths = dataset_paths(args.workdir)
+
+    sys.stderr.write(f"Generating genome: {args.contigs} x {args.contig_length:,} bp\n")
+    genome = generate_genome(paths['genome'], args.contigs, args.contig_length, rng)
+    fragments = site_fragments(genome, scanner)
+
+    sys.stderr.write(f"Generating {args.reads:,} {args.read_type} reads and PAF\n")
+    bases = 0
+    paf_count = 0
+    with open(paths['fastq'], 'wb') as fq, open(paths['paf'], 'w') as paf:
+        for i in range(args.reads):
+            read_name = f"sim_{i + 1}"
+            seq, segments = simulate_read(genome, fragments, profile, rng)
+            qual = random_bytes(len(seq), QUAL_TABLE, rng)
+            fq.write(b"@%s\n%s\n+\n%s\n" % (read_name.encode('ascii'), seq, qual))
+            lines = paf_lines(read_name, seq, segments, genome, scanner, args.min_length, profile, rng)
+            paf.writelines(lines)
+            bases += len(seq)
+            paf_count += len(lines)
+
+    dataset = dataset_params(args)
+    dataset.update({'bases': bases, 'paf_lines': paf_count})
+    with open(paths['dataset'], 'w') as f:
+        json.dump(dataset, f, indent=2)
+        f.write("\n")
+    return dataset
+
+def dataset_params(args):
+    """决定模拟数据内容的参数，参数变化时需重新生成数据"""
+    return {
+        'read_type': args.read_type,
+        'enzyme_site': args.enzyme_site,
+        'min_length': args.min_length,
+        'seed': args.seed,
+        'contigs': args.contigs,
+        'contig_length': args.contig_length,
+        'reads': args.reads,
+    }
+
+def load_dataset(args):
+    """读取已有模拟数据的描述，数据不完整或参数不同时返回None"""
+    paths = dataset_paths(args.workdir)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    with open(paths['dataset']) as f:
+        dataset = json.load(f)
+    for key, value in dataset_params(args).items():
+        if dataset.get(key) != value:
+            return None
+    return dataset
+
+def dataset_paths(workdir):
+    return {
+        'genome': os.path.join(workdir, 'genome.fa'),
+        'fastq': os.path.join(workdir, 'reads.fq'),
+        'paf': os.path.join(workdir, 'reads.paf'),
+        'dataset': os.path.join(workdir, 'dataset.json'),
+    }
+
+def count_lines(path):
+    count = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            count += block.count(b"\n")
+    return count
+
+def write_review_assembly(path, dataset, chrom_num, rng):
+    """模拟JuiceBox导出的review assembly：每条contig切成两段，随机方向后分配到
+    chrom_num条染色体，部分片段未挂载。返回片段数"""
+    fragments = []
+    with open(path, 'w') as f:
+        for i in range(dataset['contigs']):
+            half = dataset['contig_length'] // 2
+            for part, length in enumerate((half, dataset['contig_length'] - half)):
+                fragments.append(len(fragments) + 1)
+                f.write(f">ctg{i + 1:04d}:::fragment_{part + 1} {fragments[-1]} {length}\n")
+        rng.shuffle(fragments)
+        anchored = fragments[int(len(fragments) * UNANCHORED_RATE):]
+        unanchored = fragments[:len(fragments) - len(anchored)]
+        for chrom in range(chrom_num):
+            members = anchored[chrom::chrom_num]
+            f.write(" ".join(f"{'-' if rng.random() < 0.5 else ''}{index}" for index in members) + "\n")
+        for index in unanchored:
+            f.write(f"{index}\n")
+    return len(fragments)
+
+def process_tree_rss(root):
+    """进程root及其所有子孙进程的RSS之和（MB），读取/proc，不支持时返回None"""
+    children = {}
+    rss = {}
+    try:
+        pids = [int(pid) for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # 进程名可能含空格和括号，从最后一个')'之后取字段：ppid为第2个，rss（页数）为第22个
+        fields = stat[stat.rfind(b')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21])
+    if root not in rss:
+        return None
+    total = 0
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, ()))
+    return total * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def sample_tree_rss(root, stop, result):
+    """每RSS_SAMPLE_INTERVAL秒采样一次进程树RSS，峰值写入result['peak']"""
+    while not stop.wait(RSS_SAMPLE_INTERVAL):
+        rss = process_tree_rss(root)
+        if rss is not None:
+            result['peak'] = max(result.get('peak', 0), rss)
+
+def run_measured(cmd, log_path, shell=False):
+    """运行一个阶段并返回 (墙钟秒, 用户态秒, 内核态秒, 单进程峰值RSS MB, 进程树峰值RSS MB)
+
+    单进程峰值RSS取自os.wait4返回的rusage，是该进程及其已回收子进程中最大的一个；
+    进程树峰值RSS为采样得到的所有子孙进程RSS之和的最大值，无法采样时为None。
+    阶段的输出写入log_path。
+    """
+    tree_rss = {}
+    with open(log_path, 'w') as log:
+        start = time.time()
+        proc = subprocess.Popen(cmd, shell=shell, stdout=log, stderr=subprocess.STDOUT)
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_tree_rss, args=(proc.pid, stop, tree_rss))
+        sampler.start()
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            stop.set()
+            sampler.join()
+        wall = time.time() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Stage failed with status {proc.returncode}, see {log_path}")
+    return wall, usage.ru_utime, usage.ru_stime, usage.ru_maxrss / 1024, tree_rss.get('peak')
+
+def stage_runs(args, dataset, paths, outdir):
+    """生成各阶段的 (阶段名, 参数, 命令, 输入路径, 输入记录数, 是否shell) 列表"""
+    python = sys.executable
+    fq_out = os.path.join(outdir, 'split.fq')
+    mnd_out = os.path.join(outdir, 'contacts.mnd')
+    runs = []
+    if 'fq_split' in args.stages:
+        for threads in args.threads:
+            for chunk_bytes in args.chunk_bytes:
+                chunk_sizes = args.chunk_sizes if not chunk_bytes else [args.chunk_sizes[0]]
+                for chunk_size in chunk_sizes:
+                    cmd = [python, os.path.join(SCRIPT_DIR, 'fq_split.py'),
+                           '--enzyme_site', args.enzyme_site, '--fq_in', paths['fastq'],
+                           '--fq_out', fq_out, '--threads', str(threads),
+                           '--min_length', str(args.min_length),
+                           '--chunk_size', str(chunk_size), '--chunk_bytes', str(chunk_bytes)]
+                    params = {'threads': threads, 'chunk_size': chunk_size, 'chunk_bytes': chunk_bytes}
+                    runs.append(('fq_split', params, cmd, paths['fastq'], args.reads, False))
+    if 'paf2mnd' in args.stages:
+        paf_lines = count_lines(paths['paf'])
+        for workers in args.threads:
+            for chunk_size in args.paf_chunk_sizes:
+                cmd = [python, os.path.join(SCRIPT_DIR, 'paf2mnd.py'), paths['paf'], mnd_out,
+                       '-w', str(workers), '-c', str(chunk_size)]
+                params = {'workers': workers, 'chunk_size': chunk_size}
+                runs.append(('paf2mnd', params, cmd, paths['paf'], paf_lines, False))
+    if 'dedup' in args.stages:
+        # 与3d-dna流程相同：按染色体、位置排序后用dups.awk去重，需要先有paf2mnd的输出
+        if not os.path.exists(mnd_out) or os.path.getmtime(mnd_out) < os.path.getmtime(paths['paf']):
+            subprocess.check_call([python, os.path.join(SCRIPT_DIR, 'paf2mnd.py'), paths['paf'],
+                                   mnd_out], stderr=subprocess.DEVNULL)
+        # dups.awk与dups.py（各进程数）分别测试，输出前缀不同以便比较结果
+        engines = [('awk', {'engine': 'awk'},
+                    f"awk -f {shlex.quote(os.path.join(SCRIPT_DIR, 'dups.awk'))} -v name=")]
+        for threads in args.threads:
+            engines.append((f"dups_py_t{threads}", {'engine': 'dups.py', 'threads': threads},
+                            f"{shlex.quote(python)} {shlex.quote(os.path.join(SCRIPT_DIR, 'dups.py'))} "
+                            f"-t {threads} -n "))
+        for label, params, dedup_cmd in engines:
+            prefix = os.path.join(outdir, f"dedup_{label}_")
+            cmd = (f"LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n "
+                   f"{shlex.quote(mnd_out)} | {dedup_cmd}{shlex.quote(prefix)}")
+            runs.append(('dedup', params, cmd, mnd_out, None, True))
+    if 'post_review' in args.stages:
+        if importlib.util.find_spec('pysam') is None:
+            sys.stderr.write("Skipping post_review: pysam is not installed\n")
+        else:
+            # 按review assembly拼接染色体序列，即post_review.py中的ass2fasta步骤
+            assembly = os.path.join(outdir, 'review.assembly')
+            fragments = write_review_assembly(assembly, dataset, args.chrom_num, random.Random(args.seed))
+            code = ("import sys; sys.path.insert(0, sys.argv[1]); import post_review; "
+                    "post_review.ass2fasta(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5])")
+            cmd = [python, '-c', code, SCRIPT_DIR, assembly, paths['genome'], str(args.chrom_num),
+                   os.path.join(outdir, 'post_review')]
+            params = {'chrom_num': args.chrom_num}
+            runs.append(('post_review', params, cmd, paths['genome'], fragments, False))
+    return runs
+
+def git_version():
+    """当前代码版本（git describe），不在git仓库中时返回None"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic HiFi-C/Pore-C data and benchmark the Python stages',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('--workdir', default='benchmark_data',
+                        help='Directory for the synthetic data and stage outputs')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='Output JSON file')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='Regenerate the synthetic data even if it already exists')
+    parser.add_argument('--read_type', choices=sorted(READ_TYPES), default='hifi',
+                        help='Simulated read type')
+    parser.add_argument('--reads', type=int, default=5000,
+                        help='Number of simulated reads')
+    parser.add_argument('--contigs', type=int, default=20,
+                        help='Number of simulated contigs')
+    parser.add_argument('--contig_length', type=int, default=1000000,
+                        help='Length of each simulated contig')
+    parser.add_argument('--enzyme_site', default='GATC',
+                        help='Enzyme site used for simulation and splitting')
+    parser.add_argument('--min_length', type=int, default=50,
+                        help='Minimum fragment length')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed')
+    parser.add_argument('--stages', type=lambda v: v.split(','), default=list(STAGES),
+                        help='Comma-separated stages to run: fq_split, paf2mnd, dedup, post_review '
+                             '(needs pysam; skipped otherwise)')
+    parser.add_argument('--threads', type=parse_int_list, default=[1, 4],
+                        help='Comma-separated process counts to test')
+    parser.add_argument('--chunk_sizes', type=parse_int_list, default=[1000],
+                        help='Comma-separated fq_split --chunk_size values')
+    parser.add_argument('--chunk_bytes', type=parse_int_list, default=[0],
+                        help='Comma-separated fq_split --chunk_bytes values (0 = record chunks)')
+    parser.add_argument('--paf_chunk_sizes', type=parse_int_list, default=[1000000],
+                        help='Comma-separated paf2mnd -c values')
+    parser.add_argument('--chrom_num', type=int, default=10,
+                        help='Chromosomes in the simulated review assembly (post_review stage)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per configuration; all are recorded')
+
+    args = parser.parse_args()
+
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    fq_split.parse_site_spec(args.enzyme_site)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    paths = dataset_paths(args.workdir)
+    dataset = None if args.regenerate else load_dataset(args)
+    if dataset is None:
+        dataset = generate_dataset(args)
+    else:
+        sys.stderr.write(f"Reusing synthetic data in {args.workdir}\n")
+    outdir = os.path.join(args.workdir, 'out')
+    os.makedirs(outdir, exist_ok=True)
+
+    results = []
+    for stage, params, cmd, input_path, records, shell in stage_runs(args, dataset, paths, outdir):
+        if records is None:
+            records = count_lines(input_path)
+        input_bytes = os.path.getsize(input_path)
+        for run in range(args.repeat):
+            log_path = os.path.join(outdir, f"{stage}.log")
+            wall, user, system, peak_rss, peak_tree_rss = run_measured(cmd, log_path, shell)
+            result = {
+                'stage': stage,
+                'params': params,
+                'run': run,
+                'wall_s': round(wall, 3),
+                'user_s': round(user, 3),
+                'sys_s': round(system, 3),
+                'records': records,
+                'input_bytes': input_bytes,
+                'records_per_s': round(records / wall, 1) if wall else None,
+                'mb_per_s': round(input_bytes / 1024 ** 2 / wall, 2) if wall else None,
+                'peak_rss_mb': round(peak_rss, 1),
+                'peak_tree_rss_mb': round(peak_tree_rss, 1) if peak_tree_rss is not None else None,
+            }
+            results.append(result)
+            sys.stderr.write(f"{stage} {json.dumps(params)}: {wall:.2f} s, "
+                             f"{result['records_per_s']:,} records/s, {result['mb_per_s']} MB/s, "
+                             f"peak RSS {peak_rss:.0f} MB"
+                             + (f", process tree {peak_tree_rss:.0f} MB" if peak_tree_rss is not None else "")
+                             + "\n")
+
+    report = {
+        'version': git_version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'dataset': dataset,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    sys.stderr.write(f"Results saved to: {args.output}\n")
+
+if __name__ == "__main__":
+    main()
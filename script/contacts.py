@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：列式二进制contact文件（paf2mnd.py --contacts输出）的读写与导出。
+每条contact只保存 方向位、contig编号、int32位置、mapq字节，read名称每条read只存一次；
+按块存储，每列单独压缩。MND中恒为"-"的列和片段号(0/1)不保存，导出时补齐。
+
+# 导出为MND文本（与paf2mnd.py输出的MND相同），供3d-dna等工具使用
+python3 contacts.py your_species.contacts.bin your_species.mnd.txt
+
+# 查看contact数、read数和contig数
+python3 contacts.py your_species.contacts.bin --info
+
+# 在Python脚本中读取
+import contacts
+with contacts.ContactReader('your_species.contacts.bin') as reader:
+    for chunk in reader:
+        chunk.contig1, chunk.pos1, ...  # numpy数组，contig编号对应reader.contigs
+"""
+import argparse
+import struct
+import sys
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+# 文件结构：
+#   文件头  MAGIC + <HH 版本、标志（FLAG_WEIGHT：每条read带权重）
+#   数据块  CHUNK_TAG + <II contact数、read数，之后每列为 <I 压缩长度 + zlib数据，
+#           列顺序见CHUNK_COLUMNS；块内contig编号为块内contig表（contigs列）的下标
+#   contig表 CONTIG_TAG + <I 压缩长度 + zlib("\n"连接的全部contig名称)
+#   文件尾  <Q contig表的偏移 + MAGIC
+MAGIC = b"3DHFCNT\n"
+VERSION = 1
+FLAG_WEIGHT = 1
+CHUNK_TAG = b"CHNK"
+CONTIG_TAG = b"CTGS"
+HEADER = struct.Struct('<HH')
+CHUNK_HEADER = struct.Struct('<II')
+LENGTH = struct.Struct('<I')
+TRAILER = struct.Struct('<Q')
+COMPRESS_LEVEL = 1
+
+STRAND_REVERSE = 16
+# 数值列：名称、dtype；多字节列按字节重排后压缩（同一字节位的数据放在一起）
+NUMERIC_COLUMNS = (('strand', np.uint8), ('contig1', np.dtype('<u4')), ('pos1', np.dtype('<i4')),
+                   ('contig2', np.dtype('<u4')), ('pos2', np.dtype('<i4')),
+                   ('mapq1', np.uint8), ('mapq2', np.uint8), ('read_counts', np.dtype('<u4')))
+WEIGHT_COLUMN = ('weights', np.dtype('<f8'))
+CHUNK_COLUMNS = [name for name, _ in NUMERIC_COLUMNS] + ['read_names', 'contigs']
+
+# 读出的一块contact，每个数组长度为该块contact数：
+#   strand1/strand2  方向（0/16），contig1/contig2  全文件contig编号（reader.contigs的下标）
+#   pos1/pos2、mapq1/mapq2  位置与比对质量
+#   read_names/read_counts  每条read的名称及其contact数（contact按read连续存放）
+#   weights  每条read的权重，文件不带权重时为None
+ContactChunk = namedtuple('ContactChunk', ['strand1', 'contig1', 'pos1', 'strand2', 'contig2',
+                                           'pos2', 'mapq1', 'mapq2', 'read_names', 'read_counts',
+                                           'weights'])
+
+# 工作进程编码好的块：data为块数据，contigs为块内contig表（父进程据此登记全文件contig表）
+EncodedChunk = namedtuple('EncodedChunk', ['data', 'contigs'])
+
+def pack_column(values, dtype):
+    """把一列数值按dtype转为字节，多字节类型按字节重排后压缩"""
+    values = np.ascontiguousarray(values, dtype=dtype)
+    if values.dtype.itemsize > 1:
+        data = values.view(np.uint8).reshape(-1, values.dtype.itemsize).T.tobytes()
+    else:
+        data = values.tobytes()
+    return zlib.compress(data, COMPRESS_LEVEL)
+
+def unpack_column(data, dtype, count):
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    if dtype.itemsize > 1:
+        raw = raw.reshape(dtype.itemsize, count).T.copy()
+    return raw.view(dtype).reshape(count)
+
+def pack_names(names):
+    return zlib.compress("\n".join(names).encode(), COMPRESS_LEVEL)
+
+def unpack_names(data):
+    text = zlib.decompress(data).decode()
+    return text.split("\n") if text else []
+
+def encode_chunk(contigs, strand1, contig1, pos1, strand2, contig2, pos2, mapq1, mapq2,
+                 read_names, read_counts, weights=None):
+    """把一块contact编码为EncodedChunk
+
+    contig1/contig2为contigs（块内contig表）的下标；read_counts为每条read的contact数，
+    contact按read连续排列；weights为每条read的权重（文件带权重时必须提供）。
+    位置超出int32、mapq超出0~255时报错。
+    """
+    pos1 = np.asarray(pos1)
+    pos2 = np.asarray(pos2)
+    for pos in (pos1, pos2):
+        if len(pos) and (pos.min() < -2 ** 31 or pos.max() >= 2 ** 31):
+            raise ValueError("contact position does not fit in int32")
+    for mapq in (mapq1, mapq2):
+        mapq = np.asarray(mapq)
+        if len(mapq) and (mapq.min() < 0 or mapq.max() > 255):
+            raise ValueError("mapq out of range 0-255")
+    strand = ((np.asarray(strand1) == STRAND_REVERSE).astype(np.uint8) |
+              ((np.asarray(strand2) == STRAND_REVERSE).astype(np.uint8) << 1))
+    columns = {'strand': strand, 'contig1': contig1, 'pos1': pos1, 'contig2': contig2,
+               'pos2': pos2, 'mapq1': mapq1, 'mapq2': mapq2, 'read_counts': read_counts}
+    parts = [CHUNK_TAG, CHUNK_HEADER.pack(len(strand), len(read_names))]
+    packed = [pack_column(columns[name], dtype) for name, dtype in NUMERIC_COLUMNS]
+    packed += [pack_names(read_names), pack_names(contigs)]
+    if weights is not None:
+        packed.append(pack_column(weights, WEIGHT_COLUMN[1]))
+    for data in packed:
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+    return EncodedChunk(b"".join(parts), list(contigs))
+
+class ContactWriter(object):
+    """顺序写入EncodedChunk，关闭时写出全文件contig表和文件尾"""
+
+    def __init__(self, path, weight=False):
+        self.handle = open(path, 'wb')
+        self.contigs = []
+        self.contig_index = {}
+        self.handle.write(MAGIC + HEADER.pack(VERSION, FLAG_WEIGHT if weight else 0))
+
+    def write_chunk(self, chunk):
+        for name in chunk.contigs:
+            if name not in self.contig_index:
+                self.contig_index[name] = len(self.contigs)
+                self.contigs.append(name)
+        self.handle.write(chunk.data)
+
+    def close(self):
+        if self.handle.closed:
+            return
+        offset = self.handle.tell()
+        data = pack_names(self.contigs)
+        self.handle.write(CONTIG_TAG + LENGTH.pack(len(data)) + data)
+        self.handle.write(TRAILER.pack(offset) + MAGIC)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ContactReader(object):
+    """读取contact文件：contigs为全文件contig表，迭代得到各块的ContactChunk"""
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        head = self.handle.read(len(MAGIC) + HEADER.size)
+        if head[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"not a contact file: {path}")
+        version, flags = HEADER.unpack(head[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError(f"unsupported contact file version {version}: {path}")
+        self.weight = bool(flags & FLAG_WEIGHT)
+        self.handle.seek(-(TRAILER.size + len(MAGIC)), 2)
+        tail = self.handle.read()
+        if tail[TRAILER.size:] != MAGIC:
+            raise ValueError(f"truncated contact file: {path}")
+        self.data_end = TRAILER.unpack(tail[:TRAILER.size])[0]
+        self.handle.seek(self.data_end)
+        if self.handle.read(len(CONTIG_TAG)) != CONTIG_TAG:
+            raise ValueError(f"corrupt contact file: {path}")
+        length = LENGTH.unpack(self.handle.read(LENGTH.size))[0]
+        self.contigs = unpack_names(self.handle.read(length))
+        self.contig_index = {name: index for index, name in enumerate(self.contigs)}
+
+    def read_exact(self, size):
+        data = self.handle.read(size)
+        if len(data) != size:
+            raise ValueError("truncated contact chunk")
+        return data
+
+    def __iter__(self):
+        self.handle.seek(len(MAGIC) + HEADER.size)
+        while self.handle.tell() < self.data_end:
+            if self.read_exact(len(CHUNK_TAG)) != CHUNK_TAG:
+                raise ValueError("corrupt contact chunk")
+            count, reads = CHUNK_HEADER.unpack(self.read_exact(CHUNK_HEADER.size))
+            columns = []
+            for _ in range(len(CHUNK_COLUMNS) + self.weight):
+                length = LENGTH.unpack(self.read_exact(LENGTH.size))[0]
+                columns.append(self.read_exact(length))
+            yield self.decode_chunk(columns, count, reads)
+
+    def decode_chunk(self, columns, count, reads):
+        values = {}
+        for (name, dtype), data in zip(NUMERIC_COLUMNS, columns):
+            values[name] = unpack_column(data, dtype, reads if name == 'read_counts' else count)
+        read_names = unpack_names(columns[len(NUMERIC_COLUMNS)])
+        # 块内contig编号换算为全文件编号
+        local = np.array([self.contig_index[name]
+                          for name in unpack_names(columns[len(NUMERIC_COLUMNS) + 1])],
+                         dtype=np.uint32)
+        weights = None
+        if self.weight:
+            weights = unpack_column(columns[-1], WEIGHT_COLUMN[1], reads)
+        strand = values['strand']
+        return ContactChunk(
+            (strand & 1).astype(np.int64) * STRAND_REVERSE, local[values['contig1']],
+            values['pos1'], ((strand >> 1) & 1).astype(np.int64) * STRAND_REVERSE,
+            local[values['contig2']], values['pos2'], values['mapq1'], values['mapq2'],
+            read_names, values['read_counts'], weights)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def format_weight(value):
+    return f"{value:.6g}"
+
+def chunk_to_mnd(chunk, contigs):
+    """把ContactChunk格式化为MND文本（16列，带权重时17列）"""
+    first = [f"{s}\t{contigs[c]}\t{p}\t0\t" for s, c, p in
+             zip(chunk.strand1.tolist(), chunk.contig1.tolist(), chunk.pos1.tolist())]
+    second = [f"{s}\t{contigs[c]}\t{p}\t1\t" for s, c, p in
+              zip(chunk.strand2.tolist(), chunk.contig2.tolist(), chunk.pos2.tolist())]
+    if chunk.weights is not None:
+        read_tails = [f"\t-\t-\t{name}\t{name}\t{format_weight(weight)}\n"
+                      for name, weight in zip(chunk.read_names, chunk.weights.tolist())]
+    else:
+        read_tails = [f"\t-\t-\t{name}\t{name}\n" for name in chunk.read_names]
+    tails = np.repeat(np.arange(len(read_tails)), chunk.read_counts).tolist()
+    pieces = [None] * (5 * len(first))
+    pieces[0::5] = first
+    pieces[1::5] = second
+    pieces[2::5] = [f"{q}\t-\t-\t" for q in chunk.mapq1.tolist()]
+    pieces[3::5] = map(str, chunk.mapq2.tolist())
+    pieces[4::5] = map(read_tails.__getitem__, tails)
+    return "".join(pieces)
+
+def export_mnd(path, out_f):
+    """把contact文件导出为MND文本写入out_f，返回contact数"""
+    total = 0
+    with ContactReader(path) as reader:
+        for chunk in reader:
+            out_f.write(chunk_to_mnd(chunk, reader.contigs))
+            total += len(chunk.pos1)
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export a binary contact file written by paf2mnd.py --contacts to MND text',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('input', help='Binary contact file')
+    parser.add_argument('output', nargs='?', default='-',
+                        help='Output MND file (- for stdout)')
+    parser.add_argument('--info', action='store_true',
+                        help='Print contact, read and contig counts instead of exporting')
+
+    args = parser.parse_args()
+
+    if args.info:
+        contacts = reads = chunks = 0
+        with ContactReader(args.input) as reader:
+            for chunk in reader:
+                chunks += 1
+                contacts += len(chunk.pos1)
+                reads += len(chunk.read_names)
+            print(f"Contacts: {contacts:,}")
+            print(f"Reads: {reads:,}")
+            print(f"Contigs: {len(reader.contigs):,}")
+            print(f"Chunks: {chunks:,}")
+            print(f"Weights: {'yes' if reader.weight else 'no'}")
+        return
+
+    if args.output == '-':
+        export_mnd(args.input, sys.stdout)
+    else:
+        with open(args.output, 'w') as out_f:
+            export_mnd(args.input, out_f)
+
+if __name__ == "__main__":
+    main()
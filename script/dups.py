@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：对排序后的MND去重，规则与dups.awk（Juicer 1.5）一致，可直接替换：
+相邻行的方向、染色体、片段号（第1、2、4、5、6、8列）相同且第3列位置相差不超过
+wobble（默认4，--nowobble时为0）时归入同一潜在重复组，组内两两比较，两端位置
+都在wobble内的记为重复；read名称为Illumina格式且tile相同、x/y坐标相差小于50的
+记为光学重复（HiFi-C/Pore-C的read名称不是Illumina格式，可用--no-optical跳过）。
+输出 name+merged_nodups.txt、name+dups.txt、name+optdups.txt，各文件中行的顺序
+与输入一致。
+
+# 替代 sort ... | awk -f dups.awk -v name=prefix_
+LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n your_species.mnd.txt | \
+    python3 dups.py -n prefix_
+
+# paf2mnd.py --sorted的输出可直接去重
+python3 dups.py your_species.mnd.sort.txt -n prefix_ --no-optical
+
+# 多进程去重：输入在潜在重复组的边界处切块（染色体对变化处必然是边界），
+# 各块独立去重后按输入顺序写出，结果与单进程相同
+python3 dups.py your_species.mnd.sort.txt -n prefix_ -t 16
+
+# 精确去重（等同--nowobble且不做光学检查），输入无需排序：按位置、方向、染色体、
+# 片段号的64位指纹去重，每组精确重复保留最先出现的一行，输出顺序与输入一致
+# （超出内存预算后的部分按指纹分区溢写到磁盘判重，再按输入序号归并，顺序不变）
+python3 dups.py your_species.mnd.txt -n prefix_ --hash --max_memory 8G
+"""
+import argparse
+import heapq
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from functools import partial
+
+import inflight
+import memory_size
+
+# numpy可选：可用时按块向量化划分潜在重复组，否则逐行比较
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_WOBBLE = 4
+# 光学重复的x/y坐标距离阈值
+OPTICAL_DISTANCE = 50
+DEFAULT_BLOCK_BYTES = 16 * 1024 * 1024
+OUTPUT_BUFFER = 4 * 1024 * 1024
+
+# 精确去重时集合中每个指纹约占用的内存（集合槽位+整数对象）
+FINGERPRINT_BYTES = 64
+SPILL_PARTITIONS = 256
+# 溢写分区按输入序号归并时，每累计这么多行写出一次
+MERGE_BATCH_LINES = 100000
+DEFAULT_HASH_MEMORY = 4 * 1024 ** 3
+
+NODUP, DUP, OPTDUP = 0, 1, 2
+OUTPUT_SUFFIXES = ('merged_nodups.txt', 'dups.txt', 'optdups.txt')
+
+AWK_NUMBER = re.compile(r"\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)")
+
+def awk_number(text):
+    """按awk规则把字符串转为数值：取开头的数字部分，没有时为0"""
+    try:
+        return int(text)
+    except ValueError:
+        match = AWK_NUMBER.match(text)
+        return float(match.group(1)) if match else 0
+
+def block_lines(handle, block_bytes):
+    """按块读取文本，返回不含换行符的行列表，块在行边界处切分"""
+    carry = ""
+    while True:
+        data = handle.read(block_bytes)
+        if not data:
+            break
+        lines = (carry + data).split('\n')
+        carry = lines.pop()
+        yield lines
+    if carry:
+        yield [carry]
+
+def line_key(line):
+    """返回 (第1、2、4、5、6、8列组成的比较键, 第3列位置, 第7列位置)，按空白分列"""
+    fields = line.split(None, 8)
+    if len(fields) < 8:
+        fields += [''] * (8 - len(fields))
+    key = '\t'.join((fields[0], fields[1], fields[3], fields[4], fields[5], fields[7]))
+    return key, awk_number(fields[2]), awk_number(fields[6])
+
+def group_starts(keys, positions, wobble):
+    """返回每个潜在重复组起始行的下标（第0行总是起点）
+
+    与前一行（而不是组的第一行）比较：第1、2、4、5、6、8列有一列不同，
+    或第3列位置相差超过wobble时开始新组。MND中这些列为规范写法，按字符串比较。
+    """
+    count = len(keys)
+    if np is not None and count > 1:
+        changed = np.fromiter(map(str.__ne__, keys[1:], keys[:-1]), dtype=bool, count=count - 1)
+        pos = np.array(positions, dtype=np.float64 if any(
+            type(p) is float for p in positions) else np.int64)
+        changed |= np.abs(pos[1:] - pos[:-1]) > wobble
+        return [0] + (np.flatnonzero(changed) + 1).tolist()
+    starts = [0] if count else []
+    for i in range(1, count):
+        if keys[i] != keys[i - 1] or abs(positions[i] - positions[i - 1]) > wobble:
+            starts.append(i)
+    return starts
+
+def optical_fields(line, index):
+    """按dups.awk从第15列read名称取 (tile, x, y)
+
+    名称按":"拆分后不止一段时视为Illumina格式，tile为第3~5段拼接，x为第6段，
+    y为第7段"/"之前的部分；否则tile取组内序号，不会判为光学重复。
+    """
+    fields = line.split()
+    parts = fields[14].split(':') if len(fields) > 14 else ['']
+    if len(parts) < 2:
+        return str(index), 0, 0
+    parts += [''] * (7 - len(parts))
+    return (parts[2] + parts[3] + parts[4], awk_number(parts[5]),
+            awk_number(parts[6].split('/')[0]))
+
+def classify_group(lines, pos1, pos2, wobble, optical):
+    """对一个潜在重复组（至少2行）按dups.awk的两两比较规则分类，返回每行的类别
+
+    已被标记的行不再作为比较的基准（不连锁标记）；基准行j向后比较到第一个
+    第3列位置相差超过wobble的行为止（该行仍参与比较）。同一行既被判为重复又被
+    判为光学重复时按重复输出。
+    """
+    count = len(lines)
+    marks = [0] * count
+    tiles = None
+    if optical:
+        tiles = [optical_fields(line, index) for index, line in enumerate(lines)]
+    for j in range(count):
+        if marks[j]:
+            continue
+        p1, p2 = pos1[j], pos2[j]
+        for k in range(j + 1, count):
+            near1 = abs(p1 - pos1[k]) <= wobble
+            if near1 and abs(p2 - pos2[k]) <= wobble:
+                if optical and tiles[j][0] == tiles[k][0] and \
+                        abs(tiles[j][1] - tiles[k][1]) < OPTICAL_DISTANCE and \
+                        abs(tiles[j][2] - tiles[k][2]) < OPTICAL_DISTANCE:
+                    marks[k] |= 1 << OPTDUP
+                else:
+                    marks[k] |= 1 << DUP
+            if not near1:
+                break
+    return [DUP if mark & (1 << DUP) else OPTDUP if mark else NODUP for mark in marks]
+
+def dedup_lines(lines, wobble, optical, final):
+    """对一块行分类，返回 (各类别的行列表, 未处理完的最后一组的行)
+
+    final为False时最后一组可能延续到下一块，原样返回留待与下一块合并。
+    """
+    keys = []
+    pos1 = []
+    pos2 = []
+    for line in lines:
+        key, first, second = line_key(line)
+        keys.append(key)
+        pos1.append(first)
+        pos2.append(second)
+
+    starts = group_starts(keys, pos1, wobble)
+    carry = []
+    if not final and starts:
+        carry = lines[starts.pop():]
+    end = len(lines) - len(carry)
+    starts.append(end)
+
+    outputs = ([], [], [])
+    nodups = outputs[NODUP]
+    for start, stop in zip(starts, starts[1:]):
+        if stop - start == 1:
+            nodups.append(lines[start])
+            continue
+        classes = classify_group(lines[start:stop], pos1[start:stop], pos2[start:stop],
+                                 wobble, optical)
+        for line, kind in zip(lines[start:stop], classes):
+            outputs[kind].append(line)
+    return outputs, carry
+
+def dedup_stream(handle, name, wobble=DEFAULT_WOBBLE, optical=True,
+                 block_bytes=DEFAULT_BLOCK_BYTES):
+    """对排序后的MND行流去重，写出name+merged_nodups.txt/dups.txt/optdups.txt
+
+    三个输出文件总是创建（没有对应记录时为空文件），返回各类别的行数。
+    """
+    counts = [0, 0, 0]
+    handles = [open(name + suffix, 'w', buffering=OUTPUT_BUFFER) for suffix in OUTPUT_SUFFIXES]
+    try:
+        carry = []
+        for lines in block_lines(handle, block_bytes):
+            outputs, carry = dedup_lines(carry + lines, wobble, optical, final=False)
+            write_outputs(handles, outputs, counts)
+        if carry:
+            outputs, carry = dedup_lines(carry, wobble, optical, final=True)
+            write_outputs(handles, outputs, counts)
+    finally:
+        for out_f in handles:
+            out_f.close()
+    return counts
+
+def last_group_start(text, end, wobble):
+    """从text[:end]（以完整行结束）的末尾向前找最后一个潜在重复组的起始行，
+    返回该行的起始下标；整段只有一组时返回-1
+    """
+    line_start = text.rfind('\n', 0, end) + 1
+    key, pos, _ = line_key(text[line_start:end])
+    while line_start > 0:
+        prev_start = text.rfind('\n', 0, line_start - 1) + 1
+        prev_key, prev_pos, _ = line_key(text[prev_start:line_start - 1])
+        if key != prev_key or abs(pos - prev_pos) > wobble:
+            return line_start
+        line_start, key, pos = prev_start, prev_key, prev_pos
+    return -1
+
+def group_units(handle, block_bytes, wobble):
+    """按块读取文本并在潜在重复组的边界处切分，每块可独立去重
+
+    不同染色体对的记录不会在同一组中，每个染色体对变化处都是可切分的边界；
+    同一染色体对的记录很多时也在组边界处切开，块大小不受染色体对大小影响。
+    """
+    carry = ""
+    while True:
+        data = handle.read(block_bytes)
+        if not data:
+            break
+        text = carry + data
+        end = text.rfind('\n')
+        cut = last_group_start(text, end, wobble) if end > 0 else -1
+        if cut < 0:
+            carry = text
+            continue
+        carry = text[cut:]
+        yield text[:cut]
+    if carry:
+        yield carry
+
+def dedup_text(text, wobble, optical):
+    """在工作进程中对一块文本去重，返回 (各类别的输出文本, 各类别的行数)"""
+    lines = text.split('\n')
+    if text.endswith('\n'):
+        lines.pop()
+    outputs, _ = dedup_lines(lines, wobble, optical, final=True)
+    return (tuple('\n'.join(kind) + '\n' if kind else '' for kind in outputs),
+            [len(kind) for kind in outputs])
+
+def dedup_parallel(handle, name, workers, wobble=DEFAULT_WOBBLE, optical=True,
+                   block_bytes=DEFAULT_BLOCK_BYTES):
+    """多进程去重：主进程在组边界处切块，工作进程去重，结果按输入顺序写出
+
+    同时在途的块最多为工作进程数的2倍，输出与dedup_stream完全相同。
+    """
+    counts = [0, 0, 0]
+    pool = multiprocessing.Pool(processes=workers)
+    slots = threading.Semaphore(2 * workers)
+    stop = threading.Event()
+    units = inflight.bounded_chunks(group_units(handle, block_bytes, wobble), slots, stop)
+    handles = [open(name + suffix, 'w', buffering=OUTPUT_BUFFER) for suffix in OUTPUT_SUFFIXES]
+    try:
+        for texts, unit_counts in pool.imap(partial(dedup_text, wobble=wobble, optical=optical),
+                                            units):
+            for kind, text in enumerate(texts):
+                if text:
+                    handles[kind].write(text)
+                counts[kind] += unit_counts[kind]
+            slots.release()
+    except BaseException:
+        # 让任务线程退出，避免阻塞在名额上
+        stop.set()
+        slots.release()
+        pool.terminate()
+        raise
+    finally:
+        for out_f in handles:
+            out_f.close()
+
+    pool.close()
+    pool.join()
+    return counts
+
+def fingerprint(line):
+    """精确重复判断用的64位指纹：第1、2、4、5、6、8列及第3、7列位置（按数值）
+
+    指纹在同一进程内稳定，溢写到磁盘的指纹只由本进程读回。
+    """
+    return hash(line_key(line))
+
+class FingerprintSpill(object):
+    """指纹集合超出内存预算后的磁盘分区
+
+    已见过的指纹和之后的行都按指纹低位分到SPILL_PARTITIONS个分区，行前附带输入序号；
+    最后逐个分区载入指纹集合判重，每次只需一个分区的指纹在内存中，各分区的判重结果
+    （按序号有序）再按输入序号归并，输出顺序与输入一致。
+    """
+
+    def __init__(self, tmp_dir):
+        self.path = tempfile.mkdtemp(prefix='dups_spill_', dir=tmp_dir)
+        self.seen_files = [open(self.partition_path(p, 'fp'), 'wb')
+                           for p in range(SPILL_PARTITIONS)]
+        self.line_files = [open(self.partition_path(p, 'txt'), 'w')
+                           for p in range(SPILL_PARTITIONS)]
+
+    def partition_path(self, partition, suffix):
+        return os.path.join(self.path, f"part{partition:03d}.{suffix}")
+
+    def add_seen(self, fingerprints):
+        parts = [array('q') for _ in range(SPILL_PARTITIONS)]
+        for fp in fingerprints:
+            parts[fp % SPILL_PARTITIONS].append(fp)
+        for seen_f, part in zip(self.seen_files, parts):
+            part.tofile(seen_f)
+
+    def add_lines(self, lines, first_index):
+        """溢写一块行，first_index为第一行的输入序号"""
+        parts = [[] for _ in range(SPILL_PARTITIONS)]
+        for index, line in enumerate(lines, first_index):
+            parts[fingerprint(line) % SPILL_PARTITIONS].append(f"{index}\t{line}\n")
+        for line_f, part in zip(self.line_files, parts):
+            line_f.writelines(part)
+
+    def resolve(self, block_bytes):
+        """逐个分区判重后按输入序号归并，依次返回各批的 (各类别的行列表)"""
+        for handle in self.seen_files + self.line_files:
+            handle.close()
+        for partition in range(SPILL_PARTITIONS):
+            seen = array('q')
+            with open(self.partition_path(partition, 'fp'), 'rb') as seen_f:
+                seen.frombytes(seen_f.read())
+            seen = set(seen)
+            add = seen.add
+            with open(self.partition_path(partition, 'txt')) as line_f, \
+                    open(self.partition_path(partition, 'res'), 'w') as res_f:
+                for lines in block_lines(line_f, block_bytes):
+                    classified = []
+                    for entry in lines:
+                        index, line = entry.split('\t', 1)
+                        fp = fingerprint(line)
+                        kind = DUP if fp in seen else NODUP
+                        if kind == NODUP:
+                            add(fp)
+                        classified.append(f"{index}\t{kind}\t{line}\n")
+                    res_f.writelines(classified)
+            del seen
+        res_files = [open(self.partition_path(p, 'res')) for p in range(SPILL_PARTITIONS)]
+        try:
+            outputs = ([], [], [])
+            pending = 0
+            for _, kind, line in heapq.merge(*map(classified_lines, res_files)):
+                outputs[kind].append(line)
+                pending += 1
+                if pending >= MERGE_BATCH_LINES:
+                    yield outputs
+                    outputs = ([], [], [])
+                    pending = 0
+            if pending:
+                yield outputs
+        finally:
+            for res_f in res_files:
+                res_f.close()
+
+    def cleanup(self):
+        for handle in self.seen_files + self.line_files:
+            handle.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def classified_lines(handle):
+    """读取分区判重结果，依次返回 (输入序号, 类别, 行)"""
+    for entry in handle:
+        index, kind, line = entry.rstrip('\n').split('\t', 2)
+        yield int(index), int(kind), line
+
+def exact_dedup_lines(lines, seen):
+    """按指纹判重，指纹已在seen中的行为重复，否则加入seen；返回各类别的行列表"""
+    outputs = ([], [], [])
+    nodups = outputs[NODUP]
+    dups = outputs[DUP]
+    add = seen.add
+    for line in lines:
+        fp = fingerprint(line)
+        if fp in seen:
+            dups.append(line)
+        else:
+            add(fp)
+            nodups.append(line)
+    return outputs
+
+def dedup_hash(handle, name, max_memory=DEFAULT_HASH_MEMORY, tmp_dir=None,
+               block_bytes=DEFAULT_BLOCK_BYTES):
+    """不排序的精确去重（wobble为0，不做光学检查），返回各类别的行数
+
+    与排序后 dups.awk -v nowobble=1 的去重结果数量相同，每组精确重复保留最先出现的一行。
+    指纹集合超过max_memory后溢写到tmp_dir下的分区（见FingerprintSpill），
+    之后的行在输入读完后分区判重、按输入序号归并输出，输出顺序始终与输入一致。
+    """
+    counts = [0, 0, 0]
+    seen = set()
+    limit = max(1, max_memory // FINGERPRINT_BYTES)
+    spill = None
+    spilled = 0
+    handles = [open(name + suffix, 'w', buffering=OUTPUT_BUFFER) for suffix in OUTPUT_SUFFIXES]
+    try:
+        for lines in block_lines(handle, block_bytes):
+            if spill is not None:
+                spill.add_lines(lines, spilled)
+                spilled += len(lines)
+                continue
+            write_outputs(handles, exact_dedup_lines(lines, seen), counts)
+            if len(seen) > limit:
+                sys.stderr.write(f"Fingerprint set exceeds the memory budget, spilling "
+                                 f"{len(seen):,} fingerprints to {SPILL_PARTITIONS} partitions\n")
+                spill = FingerprintSpill(tmp_dir)
+                spill.add_seen(seen)
+                seen = set()
+        if spill is not None:
+            for outputs in spill.resolve(block_bytes):
+                write_outputs(handles, outputs, counts)
+    finally:
+        if spill is not None:
+            spill.cleanup()
+        for out_f in handles:
+            out_f.close()
+    return counts
+
+def write_outputs(handles, outputs, counts):
+    for kind, lines in enumerate(outputs):
+        if lines:
+            handles[kind].write('\n'.join(lines) + '\n')
+            counts[kind] += len(lines)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Remove duplicates from a sorted MND with the rules of dups.awk',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('input', nargs='?', default='-',
+                        help='Sorted MND file (- for stdin)')
+    parser.add_argument('-n', '--name', default='',
+                        help='Output prefix (as awk -v name=...)')
+    parser.add_argument('--nowobble', action='store_true',
+                        help='Exact positions only (wobble 0 instead of 4)')
+    parser.add_argument('--no-optical', action='store_true',
+                        help='Skip the Illumina optical duplicate check')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Number of dedup processes (input is cut at duplicate group boundaries)')
+    parser.add_argument('--hash', action='store_true',
+                        help='Exact dedup (as --nowobble --no-optical) by 64-bit fingerprints; '
+                             'the input does not need to be sorted and the output keeps its order '
+                             '(also after spilling)')
+    parser.add_argument('--max_memory', type=memory_size.parse_memory_size, default=DEFAULT_HASH_MEMORY,
+                        help='Fingerprint memory budget for --hash before spilling to disk '
+                             '(e.g. 8G; plain numbers are MB)')
+    parser.add_argument('--tmp_dir', default=None,
+                        help='Directory for --hash spill partitions (default: next to the outputs)')
+    parser.add_argument('--block_bytes', type=int, default=DEFAULT_BLOCK_BYTES,
+                        help='Bytes of MND read per block')
+
+    args = parser.parse_args()
+    if args.block_bytes < 1:
+        sys.stderr.write("Error: --block_bytes must be positive\n")
+        sys.exit(1)
+    if args.threads < 1:
+        sys.stderr.write("Error: --threads must be at least 1\n")
+        sys.exit(1)
+    if args.hash and args.threads > 1:
+        sys.stderr.write("Error: --hash runs in a single process\n")
+        sys.exit(1)
+
+    start_time = time.time()
+    wobble = 0 if args.nowobble else DEFAULT_WOBBLE
+    if args.hash:
+        tmp_dir = args.tmp_dir or os.path.dirname(os.path.abspath(args.name + 'dups.txt'))
+        dedup = partial(dedup_hash, max_memory=args.max_memory, tmp_dir=tmp_dir)
+    elif args.threads > 1:
+        dedup = partial(dedup_parallel, workers=args.threads, wobble=wobble,
+                        optical=not args.no_optical)
+    else:
+        dedup = partial(dedup_stream, wobble=wobble, optical=not args.no_optical)
+    if args.input == '-':
+        counts = dedup(sys.stdin, args.name, block_bytes=args.block_bytes)
+    else:
+        with open(args.input) as in_f:
+            counts = dedup(in_f, args.name, block_bytes=args.block_bytes)
+
+    sys.stderr.write(f"Processing completed: {time.time() - start_time:.2f} s\n")
+    sys.stderr.write(f"Unique: {counts[NODUP]:,} | duplicates: {counts[DUP]:,} | "
+                     f"optical duplicates: {counts[OPTDUP]:,}\n")
+
+if __name__ == "__main__":
+    main()
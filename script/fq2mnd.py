@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：流式串联 fq_split -> minimap2 -> paf2mnd，切割后的片段直接写入
+minimap2的stdin，minimap2输出的PAF直接按read分组转换为MND，中间文件不落盘。
+
+# 只输出MND
+python3 fq2mnd.py -r contig.fa -i HiFi-C.fq.gz -e GATC -p '-x map-hifi' -t 32 \
+                  -o your_species.mnd.txt
+
+# 同时保留切割后的FASTQ和PAF（可选）
+python3 fq2mnd.py -r contig.fa -i HiFi-C.fq.gz -e GATC -p '-x map-hifi' -t 32 \
+                  -o your_species.mnd.txt --fq_out split.fq.gz --paf_out your_species.paf
+
+# 直接输出排序后的MND（可作为dups.awk的输入，省去单独的排序步骤）
+python3 fq2mnd.py -r contig.fa -i HiFi-C.fq.gz -e GATC -p '-x map-hifi' -t 32 \
+                  -o your_species.mnd.sort.txt --sorted
+
+# 使用fq_split.py --index_out生成的酶切位点索引，按需从原始FASTQ生成片段送入minimap2
+python3 fq2mnd.py -r contig.fa -i HiFi-C.fq.gz --index_in HiFi-C.cidx -t 32 -o your_species.mnd.txt
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import fq_split
+import paf2mnd
+
+class FragmentTee(object):
+    """把片段bytes同时写入比对程序的stdin和可选的FASTQ输出"""
+
+    def __init__(self, aligner_stdin, fq_handle=None):
+        self.aligner_stdin = aligner_stdin
+        self.fq_handle = fq_handle
+
+    def write(self, data):
+        self.aligner_stdin.write(data)
+        if self.fq_handle is not None:
+            self.fq_handle.write(data)
+
+def tee_lines(lines, handle):
+    """逐行透传PAF，同时写入可选的PAF输出"""
+    for line in lines:
+        handle.write(line)
+        yield line
+
+def run_split(in_handle, tee, split_args, pool, result):
+    """切割线程：切割完成（或出错）后关闭minimap2的stdin，使其正常结束"""
+    try:
+        result['split'] = fq_split.split_fastq(in_handle, tee, split_args, pool)
+    except BaseException as e:
+        result['error'] = e
+    finally:
+        try:
+            tee.aligner_stdin.close()
+        except BrokenPipeError:
+            # minimap2已退出（出错或被主线程结束），错误由主线程报告
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stream enzyme-site splitting, minimap2 alignment and PAF to MND '
+                    'conversion without intermediate files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument('-r', '--ref', required=True,
+                        help='Contig genome')
+    parser.add_argument('-i', '--fq_in', required=True,
+                        help='Input HiFi-C/Pore-C FASTQ file (gzipped if ends with .gz)')
+    parser.add_argument('-e', '--enzyme_site', default=None,
+                        help='Enzyme recognition site (e.g., GATC); not needed with --index_in')
+    parser.add_argument('-o', '--mnd_out', required=True,
+                        help='Output MND file')
+    parser.add_argument('-p', '--map_params', default='-x map-hifi',
+                        help='minimap2 align parameters (Pore-C: "-x map-ont")')
+    parser.add_argument('-t', '--threads', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of minimap2 threads')
+    parser.add_argument('--split_threads', type=int, default=0,
+                        help='Number of splitting processes (0 = threads / 4)')
+    parser.add_argument('--mnd_workers', type=int, default=0,
+                        help='Number of PAF to MND processes (0 = threads / 4)')
+    parser.add_argument('--minimap2', default='minimap2',
+                        help='minimap2 executable')
+    parser.add_argument('--fq_out', default=None,
+                        help='Also write split fragments to this FASTQ (will gzip if ends with .gz)')
+    parser.add_argument('--paf_out', default=None,
+                        help='Also write minimap2 PAF to this file')
+    parser.add_argument('-m', '--min-identity', type=float, default=0.75,
+                        help='Minimum alignment identity (0.0-1.0)')
+    parser.add_argument('--paf-chunk-size', type=int, default=1000000,
+                        help='PAF lines per MND processing chunk')
+    parser.add_argument('--pairing', choices=paf2mnd.PAIRING_MODES, default='all',
+                        help='Fragment pairs per read: all, adjacent, knn (--neighbors) '
+                             'or capped (--max-pairs, deterministic sampling)')
+    parser.add_argument('--neighbors', type=int, default=2,
+                        help='Following fragments paired with each fragment in knn mode')
+    parser.add_argument('--max-pairs', type=int, default=100,
+                        help='Maximum pairs per read in capped mode')
+    parser.add_argument('--weight', action='store_true',
+                        help='Append a weight column (all pairs / emitted pairs of the read) to the MND')
+    parser.add_argument('--sorted', action='store_true',
+                        help='Write the MND sorted as by LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n '
+                             '-k1,1n -k5,5n -k3,3n (merged from sorted runs)')
+    parser.add_argument('--sort-tmp', default=None,
+                        help='Directory for sorted runs with --sorted (default: next to the MND)')
+    parser.add_argument('--contacts', default=None,
+                        help='Also write a columnar binary contact file (needs numpy; '
+                             'export with contacts.py)')
+    # --max_memory（见fq_split参数）在此为切割与PAF转换的总预算，不含minimap2
+    fq_split.add_split_arguments(parser)
+
+    args = parser.parse_args()
+
+    # 验证参数
+    if not os.path.exists(args.ref):
+        sys.stderr.write(f"Error: reference not found - {args.ref}\n")
+        sys.exit(1)
+    if not os.path.exists(args.fq_in):
+        sys.stderr.write(f"Error: input FASTQ not found - {args.fq_in}\n")
+        sys.exit(1)
+    if args.min_identity < 0 or args.min_identity > 1:
+        sys.stderr.write("Error: minimum identity must be between 0.0 and 1.0\n")
+        sys.exit(1)
+    if args.contacts and paf2mnd.np is None:
+        sys.stderr.write("Error: --contacts needs numpy\n")
+        sys.exit(1)
+    pairing = paf2mnd.pairing_from_args(args)
+    sort_dir = None
+    if args.sorted:
+        sort_dir = args.sort_tmp or os.path.dirname(os.path.abspath(args.mnd_out))
+    map_threads = args.threads
+    if args.split_threads <= 0:
+        args.split_threads = max(1, args.threads // 4)
+    if args.mnd_workers <= 0:
+        args.mnd_workers = max(1, args.threads // 4)
+    # 内存预算（不含minimap2本身）切割与PAF转换各占一半
+    paf_chunk_bytes, paf_inflight = 0, 0
+    if args.max_memory is not None:
+        args.max_memory //= 2
+        args.mnd_workers, paf_chunk_bytes, paf_inflight = paf2mnd.plan_paf_memory(
+            args.max_memory, args.mnd_workers)
+    # fq_split的参数按切割进程数校验（按内存预算时可能减少进程数）
+    args.threads = args.split_threads
+    fq_split.check_split_arguments(args)
+    args.split_threads = args.threads
+
+    start_time = time.time()
+    sys.stderr.write(f"Start time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+    sys.stderr.write(f"minimap2 threads: {map_threads} | split processes: {args.split_threads} | "
+                     f"MND processes: {args.mnd_workers}\n")
+
+    # 先创建进程池再启动子进程，避免fork出的工作进程继承管道写端，
+    # 导致minimap2/pigz收不到EOF
+    split_pool = multiprocessing.Pool(processes=args.split_threads)
+    mnd_pool = multiprocessing.Pool(processes=args.mnd_workers)
+
+    pigz_available = os.system("which unpigz > /dev/null 2>&1") == 0
+    in_handle, proc_in = fq_split.open_fastq_input(args.fq_in, pigz_available)
+    fq_handle = None
+    if args.fq_out:
+        fq_handle, fq_proc, fq_file = fq_split.open_fastq_output(
+            args.fq_out, args.split_threads, pigz_available)
+
+    cmd = [args.minimap2] + shlex.split(args.map_params) + ['-t', str(map_threads), args.ref, '-']
+    sys.stderr.write("Running: " + " ".join(shlex.quote(c) for c in cmd) + "\n")
+    aligner = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # 切割在后台线程中进行，主线程消费minimap2的PAF输出
+    split_result = {}
+    splitter = threading.Thread(
+        target=run_split,
+        args=(in_handle, FragmentTee(aligner.stdin, fq_handle), args, split_pool, split_result))
+    splitter.start()
+
+    paf_lines = io.TextIOWrapper(aligner.stdout, encoding='utf-8')
+    paf_handle = None
+    if args.paf_out:
+        paf_handle = open(args.paf_out, 'w')
+        paf_lines = tee_lines(paf_lines, paf_handle)
+
+    try:
+        total_lines, total_mnd_records = paf2mnd.convert_paf_stream(
+            paf_lines, args.mnd_out, args.min_identity, args.paf_chunk_size,
+            args.mnd_workers, mnd_pool, chunk_bytes=paf_chunk_bytes, max_inflight=paf_inflight,
+            pairing=pairing, sort_dir=sort_dir, contacts_file=args.contacts)
+    except BaseException:
+        # 转换出错（含Ctrl-C）后不再读取minimap2的输出：先结束minimap2，否则它阻塞在
+        # 写满的管道上，切割线程随之阻塞在写stdin上，join永远无法返回
+        aligner.kill()
+        mnd_pool.terminate()
+        raise
+    finally:
+        aligner.stdout.close()
+        splitter.join()
+        returncode = aligner.wait()
+        split_pool.terminate()
+        mnd_pool.close()
+        mnd_pool.join()
+        fq_split.close_fastq_input(in_handle, proc_in)
+        if fq_handle is not None:
+            fq_split.close_fastq_output(fq_handle, fq_proc, fq_file)
+        if paf_handle is not None:
+            paf_handle.close()
+
+    if 'error' in split_result:
+        raise split_result['error']
+    if returncode != 0:
+        sys.stderr.write(f"Error: minimap2 exited with status {returncode}\n")
+        sys.exit(1)
+
+    total_records, total_fragments = split_result['split']
+    end_time = time.time()
+    sys.stderr.write(f"\nProcessing completed: {end_time - start_time:.2f} s\n")
+    sys.stderr.write(f"Total records processed: {total_records:,}\n")
+    sys.stderr.write(f"Total fragments generated: {total_fragments:,}\n")
+    sys.stderr.write(f"PAF lines: {total_lines:,}\n")
+    sys.stderr.write(f"MND records: {total_mnd_records:,}\n")
+    sys.stderr.write(f"Peak memory (parent): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB\n")
+    sys.stderr.write(f"End time: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,35 @@ python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --fq_out output.fq.gz
 python3 fq_script.py --enzyme_site GATC --fq_in large.fq --fq_out output.fq \
                  --chunk_size 2000 --threads 16
 
+# 按原始字节块分发给工作进程（父进程不解析记录，适合32线程以上）
+python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --chunk_bytes 67108864 --threads 48
+
+# 输出8个分片（同一read的片段在同一分片）及清单output.manifest.tsv，供多个minimap2并行比对
+python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --chunk_bytes 67108864 --threads 32 --shards 8
+
+# 同时输出酶切统计（片段长度、每条read片段数直方图、--min_length过滤掉的碱基比例）
+python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --threads 32 --stats_out output.stats.json
+
+# 只给定内存预算，由脚本按字节推算块大小、在途块数（必要时减少进程数）
+python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --threads 32 --max_memory 16G
+
+# 多酶组合/简并位点一次扫描（^为切割位置，也可写酶名，如 DpnII,HinfI 或 Arima）
+python3 fq_script.py --enzyme_site ^GATC,G^ANTC --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --chunk_bytes 67108864 --threads 32
+
+# 只扫描一次酶切位点写出索引，之后换--min_length时直接按索引从原始FASTQ生成片段
+python3 fq_script.py --enzyme_site GATC --fq_in huge.fq.gz --index_out huge.cidx --threads 32
+python3 fq_script.py --index_in huge.cidx --fq_in huge.fq.gz --fq_out output.fq.gz \
+                 --min_length 100 --threads 32
+
 """
 import re
+import struct
+from array import array
 import argparse
 import multiprocessing
 from functools import partial
@@ -21,45 +48,156 @@ import time
 import os
 import subprocess
 import sys
+import threading
+import queue
+import json
+
+import inflight
+import memory_size
+
+def format_fragments(header, seq, qual, cut_sites, min_length):
+    """按切割位点切分一条记录并过滤短片段
+
+    全程在bytes上操作：片段通过memoryview切片（不复制），最后一次性拼接为
+    该记录所有片段的bytes。cut_sites为升序的切割位点（0起始偏移）。
+
+    返回 (片段bytes, 片段数)
+    """
+    seq_view = memoryview(seq)
+    qual_view = memoryview(qual)
+    pieces = []
+    fragment_count = 0
 
-def process_record(lines, compiled_pattern, min_length):
-    """处理单个FASTQ记录（4行文本），切割并过滤片段"""
-    if len(lines) != 4:
-        return []
-    
-    header, seq, plus, qual = lines
-    fragments = []
-    header=header.split()[0]
-    plus="+"
-    
-    # 查找酶切位点
-    enzyme_site_pos = [m.start() for m in compiled_pattern.finditer(seq)]
-    
     pos_start = 0
-    for pos_end in enzyme_site_pos:
-        frag_length = pos_end - pos_start
-        if frag_length >= min_length:
+    for pos_end in cut_sites:
+        if pos_end - pos_start >= min_length:
             # 创建片段
-            frag_seq = seq[pos_start:pos_end]
-            frag_qual = qual[pos_start:pos_end]
-            frag_header = f"{header}:{pos_start+1}-{pos_end}"
-            
-            fragments.append(f"{frag_header}\n{frag_seq}\n{plus}\n{frag_qual}\n")
+            pieces += (b"%s:%d-%d\n" % (header, pos_start + 1, pos_end),
+                       seq_view[pos_start:pos_end], b"\n+\n",
+                       qual_view[pos_start:pos_end], b"\n")
+            fragment_count += 1
         pos_start = pos_end
-    
+
     # 处理最后一段
-    frag_length = len(seq) - pos_start
-    if frag_length >= min_length:
-        frag_seq = seq[pos_start:]
-        frag_qual = qual[pos_start:]
-        frag_header = f"{header}:{pos_start+1}-{len(seq)}"
-        
-        fragments.append(f"{frag_header}\n{frag_seq}\n{plus}\n{frag_qual}\n")
-    
-    return fragments
+    seq_length = len(seq)
+    if seq_length - pos_start >= min_length:
+        pieces += (b"%s:%d-%d\n" % (header, pos_start + 1, seq_length),
+                   seq_view[pos_start:], b"\n+\n",
+                   qual_view[pos_start:], b"\n")
+        fragment_count += 1
+
+    return b"".join(pieces), fragment_count
+
+# 统计直方图：片段长度按固定宽度分箱，片段数/read按个数分箱，最后一箱为溢出箱
+LENGTH_BIN_WIDTH = 50
+LENGTH_BINS = 1000
+FRAGMENTS_PER_READ_BINS = 256
+
+class DigestStats(object):
+    """酶切统计：工作进程按块累加计数和直方图，父进程合并后写出JSON
+
+    只使用已求得的切割位点和序列长度，不再扫描序列。
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.bases = 0
+        self.reads_without_site = 0
+        self.kept_fragments = 0
+        self.kept_bases = 0
+        self.dropped_fragments = 0
+        self.dropped_bases = 0
+        self.length_histogram = [0] * LENGTH_BINS
+        self.fragments_per_read = [0] * FRAGMENTS_PER_READ_BINS
+
+    def add_read(self, cut_sites, seq_length, min_length):
+        """累加一条read：cut_sites为升序切割位点，长度为0的片段不计"""
+        self.records += 1
+        self.bases += seq_length
+        if not len(cut_sites):
+            self.reads_without_site += 1
+        histogram = self.length_histogram
+        last_bin = LENGTH_BINS - 1
+        kept = 0
+        kept_bases = 0
+        pos_start = 0
+        for pos_end in list(cut_sites) + [seq_length]:
+            length = pos_end - pos_start
+            pos_start = pos_end
+            if length <= 0:
+                continue
+            histogram[min(length // LENGTH_BIN_WIDTH, last_bin)] += 1
+            if length >= min_length:
+                kept += 1
+                kept_bases += length
+            else:
+                self.dropped_fragments += 1
+        self.kept_fragments += kept
+        self.kept_bases += kept_bases
+        self.dropped_bases += seq_length - kept_bases
+        self.fragments_per_read[min(kept, FRAGMENTS_PER_READ_BINS - 1)] += 1
+
+    def merge(self, other):
+        """合并另一个块的统计"""
+        for name in ('records', 'bases', 'reads_without_site', 'kept_fragments',
+                     'kept_bases', 'dropped_fragments', 'dropped_bases'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for i, count in enumerate(other.length_histogram):
+            self.length_histogram[i] += count
+        for i, count in enumerate(other.fragments_per_read):
+            self.fragments_per_read[i] += count
+
+    def to_dict(self):
+        return {
+            'records': self.records,
+            'bases': self.bases,
+            'reads_without_site': self.reads_without_site,
+            'kept_fragments': self.kept_fragments,
+            'kept_bases': self.kept_bases,
+            'dropped_fragments': self.dropped_fragments,
+            'dropped_bases': self.dropped_bases,
+            'dropped_base_fraction': self.dropped_bases / self.bases if self.bases else 0,
+            'mean_fragments_per_read': self.kept_fragments / self.records if self.records else 0,
+            'mean_kept_fragment_length': (self.kept_bases / self.kept_fragments
+                                          if self.kept_fragments else 0),
+            # 所有非空片段（过滤前），第i箱为 [i*bin_width, (i+1)*bin_width)，最后一箱含更长片段
+            'fragment_length_histogram': {
+                'bin_width': LENGTH_BIN_WIDTH,
+                'counts': self.length_histogram,
+            },
+            # 第i箱为保留i个片段的read数，最后一箱含更多片段
+            'fragments_per_read_histogram': self.fragments_per_read,
+        }
+
+    def write_json(self, path, **params):
+        """写出统计JSON，params为附带的运行参数"""
+        report = dict(params)
+        report.update(self.to_dict())
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+def new_stats(collect_stats):
+    """collect_stats为真时返回新的空统计，否则返回None"""
+    return DigestStats() if collect_stats else None
+
+def process_record(lines, scanner, min_length, stats=None):
+    """处理单个FASTQ记录（4行bytes），在bytes中查找酶切位点，切割并过滤片段
+
+    stats不为None时顺便累加统计。返回 (片段bytes, 片段数)
+    """
+    if len(lines) != 4:
+        return b"", 0
+
+    header, seq, plus, qual = lines
+    # 查找酶切位点
+    cut_sites = scanner.cut_sites(seq)
+    if stats is not None:
+        stats.add_read(cut_sites, len(seq), min_length)
+    return format_fragments(header.split()[0], seq, qual, cut_sites, min_length)
 
 def read_fastq_chunks(input_handle, chunk_size=1000):
-    """从文件句柄中读取FASTQ记录块"""
+    """从二进制文件句柄中读取FASTQ记录块"""
     chunk = []
     lines = []
     
@@ -77,133 +215,666 @@ def read_fastq_chunks(input_handle, chunk_size=1000):
     if chunk:
         yield chunk
 
+def process_chunk(chunk, scanner, min_length, collect_stats=False):
+    """在工作进程中处理一整个记录块，返回 (片段bytes, 记录数, 片段数, 统计或None)"""
+    stats = new_stats(collect_stats)
+    pieces = []
+    total_fragments = 0
+    for lines in chunk:
+        data, fragment_count = process_record(lines, scanner, min_length, stats)
+        pieces.append(data)
+        total_fragments += fragment_count
+    return b"".join(pieces), len(chunk), total_fragments, stats
+
+def record_boundary(buf):
+    """返回buf中最后一个完整FASTQ记录（4行）之后的偏移，buf须从记录开头开始"""
+    remainder = buf.count(b"\n") % 4
+    end = len(buf)
+    for _ in range(remainder + 1):
+        end = buf.rfind(b"\n", 0, end)
+        if end < 0:
+            return 0
+    return end + 1
+
+def read_fastq_blocks(input_handle, block_bytes):
+    """从二进制文件句柄中按字节读取原始数据块，块边界对齐到记录边界
+
+    父进程只统计换行符并切块，不解析记录；解析交给工作进程。
+    """
+    carry = b""
+    while True:
+        data = input_handle.read(block_bytes)
+        if not data:
+            break
+        buf = carry + data if carry else data
+        cut = record_boundary(buf)
+        if cut == 0:
+            # 块比一条记录还小，继续累积
+            carry = buf
+            continue
+        yield buf[:cut]
+        carry = buf[cut:]
+
+    # 处理文件末尾剩余的数据
+    if carry:
+        yield carry
+
+def split_block_lines(block):
+    """把原始字节块拆成行，返回 (行列表, 完整记录数)"""
+    lines = block.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    return lines, len(lines) // 4
+
+def process_block(block, scanner, min_length, collect_stats=False):
+    """在工作进程中解析并处理一个原始字节块，返回 (片段bytes, 记录数, 片段数, 统计或None)"""
+    stats = new_stats(collect_stats)
+    lines, record_count = split_block_lines(block)
+    pieces = []
+    total_fragments = 0
+    for i in range(0, record_count * 4, 4):
+        data, fragment_count = process_record(
+            [line.strip() for line in lines[i:i + 4]], scanner, min_length, stats)
+        pieces.append(data)
+        total_fragments += fragment_count
+    return b"".join(pieces), record_count, total_fragments, stats
+
+# 酶切位点索引（二进制）：
+#   文件头: b"FQCI" + <IH(版本, 酶切位点描述长度) + 酶切位点描述
+#   每个块: <QIIQ(首条read序号, read数, uint32个数, 对应原始FASTQ字节数)
+#           + uint32数组，每条read依次为 [序列长度, 位点数, 位点偏移...]
+# 索引与原始FASTQ按块一一对应，复用时按字节数直接读取原始数据，无需重新扫描序列。
+INDEX_MAGIC = b"FQCI"
+INDEX_VERSION = 1
+INDEX_FILE_HEADER = struct.Struct('<IH')
+INDEX_BLOCK_HEADER = struct.Struct('<QIIQ')
+DEFAULT_INDEX_BLOCK_BYTES = 16 * 1024 * 1024
+
+def count_fragments(cut_sites, seq_length, min_length):
+    """统计按cut_sites切割后长度不小于min_length的片段数"""
+    fragment_count = 0
+    pos_start = 0
+    for pos_end in cut_sites:
+        if pos_end - pos_start >= min_length:
+            fragment_count += 1
+        pos_start = pos_end
+    if seq_length - pos_start >= min_length:
+        fragment_count += 1
+    return fragment_count
+
+def index_block(block, scanner, min_length, collect_stats=False):
+    """在工作进程中扫描原始字节块的酶切位点，返回 (索引块bytes, 记录数, 片段数, 统计或None)
+
+    索引块中的首条read序号由写出端填写。
+    """
+    stats = new_stats(collect_stats)
+    lines, record_count = split_block_lines(block)
+    words = array('I')
+    total_fragments = 0
+    for i in range(1, record_count * 4, 4):
+        seq = lines[i].strip()
+        cut_sites = scanner.cut_sites(seq)
+        words.append(len(seq))
+        words.append(len(cut_sites))
+        words.extend(cut_sites)
+        total_fragments += count_fragments(cut_sites, len(seq), min_length)
+        if stats is not None:
+            stats.add_read(cut_sites, len(seq), min_length)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    header = INDEX_BLOCK_HEADER.pack(0, record_count, len(words), len(block))
+    return header + words.tobytes(), record_count, total_fragments, stats
+
+class CutSiteIndexWriter(object):
+    """酶切位点索引的写出端，按顺序写入各索引块并填写read序号"""
+
+    def __init__(self, path, site_spec):
+        self.path = path
+        self.handle = open(path, 'wb')
+        spec = site_spec.encode('ascii')
+        self.handle.write(INDEX_MAGIC + INDEX_FILE_HEADER.pack(INDEX_VERSION, len(spec)) + spec)
+        self.next_ordinal = 0
+
+    def write_chunk(self, result):
+        data, record_count, _ = result
+        self.handle.write(struct.pack('<Q', self.next_ordinal))
+        self.handle.write(memoryview(data)[8:])
+        self.next_ordinal += record_count
+
+    def close(self):
+        self.handle.close()
+
+def open_cut_site_index(path):
+    """打开酶切位点索引并校验文件头，返回 (句柄, 酶切位点描述)"""
+    handle = open(path, 'rb')
+    magic = handle.read(len(INDEX_MAGIC))
+    if magic != INDEX_MAGIC:
+        handle.close()
+        raise ValueError(f"Not a cut-site index: {path}")
+    version, spec_length = INDEX_FILE_HEADER.unpack(handle.read(INDEX_FILE_HEADER.size))
+    if version != INDEX_VERSION:
+        handle.close()
+        raise ValueError(f"Unsupported cut-site index version {version}: {path}")
+    return handle, handle.read(spec_length).decode('ascii')
+
+def read_indexed_blocks(input_handle, index_handle):
+    """按索引块读取对应字节数的原始FASTQ，生成 (原始块, 索引数据, read数)"""
+    while True:
+        header = index_handle.read(INDEX_BLOCK_HEADER.size)
+        if not header:
+            break
+        if len(header) != INDEX_BLOCK_HEADER.size:
+            raise ValueError("Truncated cut-site index")
+        _, record_count, word_count, block_bytes = INDEX_BLOCK_HEADER.unpack(header)
+        payload = index_handle.read(4 * word_count)
+        block = input_handle.read(block_bytes)
+        if len(payload) != 4 * word_count or len(block) != block_bytes:
+            raise ValueError("Cut-site index does not match the input FASTQ")
+        yield block, payload, record_count
+
+    if input_handle.read(1):
+        raise ValueError("Input FASTQ has more records than the cut-site index")
+
+def process_indexed_block(item, min_length, collect_stats=False):
+    """在工作进程中按索引中的位点切割原始字节块，不扫描序列
+
+    返回 (片段bytes, 记录数, 片段数, 统计或None)
+    """
+    stats = new_stats(collect_stats)
+    block, payload, index_records = item
+    lines, record_count = split_block_lines(block)
+    if record_count != index_records:
+        raise ValueError("Cut-site index does not match the input FASTQ")
+    words = array('I')
+    words.frombytes(payload)
+    if sys.byteorder == 'big':
+        words.byteswap()
+
+    pieces = []
+    total_fragments = 0
+    pos = 0
+    for i in range(0, record_count * 4, 4):
+        seq = lines[i + 1].strip()
+        seq_length, site_count = words[pos], words[pos + 1]
+        if seq_length != len(seq):
+            raise ValueError("Cut-site index does not match the input FASTQ")
+        cut_sites = words[pos + 2:pos + 2 + site_count]
+        pos += 2 + site_count
+        if stats is not None:
+            stats.add_read(cut_sites, seq_length, min_length)
+        data, fragment_count = format_fragments(
+            lines[i].split()[0], seq, lines[i + 3].strip(), cut_sites, min_length)
+        pieces.append(data)
+        total_fragments += fragment_count
+    return b"".join(pieces), record_count, total_fragments, stats
+
+def chunk_writer(out_handle, write_queue, slots, errors):
+    """写出线程：按顺序写出结果块并释放在途名额，遇到None结束"""
+    while True:
+        result = write_queue.get()
+        if result is None:
+            break
+        try:
+            if errors:
+                pass
+            elif isinstance(out_handle, (ShardedOutput, CutSiteIndexWriter)):
+                out_handle.write_chunk(result)
+            else:
+                out_handle.write(result[0])
+        except Exception as e:
+            # 记录错误后继续消费队列，避免读取端阻塞在名额上
+            errors.append(e)
+        finally:
+            slots.release()
+
+def open_fastq_input(path, pigz_available):
+    """以二进制方式打开输入FASTQ，返回 (句柄, 解压子进程或None)"""
+    if path.endswith('.gz') and pigz_available:
+        print("Using unpigz for parallel decompression...")
+        proc_in = subprocess.Popen(['unpigz', '-c', path], stdout=subprocess.PIPE)
+        return proc_in.stdout, proc_in
+    elif path.endswith('.gz'):
+        print("unpigz not found, using gzip...")
+        import gzip
+        return gzip.open(path, 'rb'), None
+    else:
+        return open(path, 'rb'), None
+
+def close_fastq_input(in_handle, proc_in):
+    """关闭输入句柄，如果是通过subprocess打开的输入，需要等待进程结束"""
+    in_handle.close()
+    if proc_in is not None:
+        proc_in.wait()
+
+def open_fastq_output(path, threads, pigz_available):
+    """以二进制方式打开输出FASTQ，返回 (句柄, 压缩子进程或None, 底层文件或None)"""
+    if path.endswith('.gz') and pigz_available:
+        print("Using pigz for parallel compression...")
+        # 直接打开输出文件，使用subprocess处理压缩
+        out_file = open(path, 'wb')
+        proc_out = subprocess.Popen(['pigz', '-c', '-p', str(threads)], 
+                                   stdin=subprocess.PIPE, stdout=out_file)
+        return proc_out.stdin, proc_out, out_file
+    elif path.endswith('.gz'):
+        print("pigz not found, using gzip...")
+        import gzip
+        return gzip.open(path, 'wb'), None, None
+    else:
+        return open(path, 'wb'), None, None
+
+def close_fastq_output(out_handle, proc_out, out_file):
+    """关闭输出句柄，等待压缩子进程结束"""
+    out_handle.close()
+    if proc_out is not None:
+        proc_out.wait()
+        out_file.close()
+
+FASTQ_SUFFIXES = ('.fastq.gz', '.fq.gz', '.fastq', '.fq', '.gz')
+
+def split_fastq_suffix(path):
+    """拆分输出路径为 (前缀, 扩展名)，如 out.fq.gz -> (out, .fq.gz)"""
+    for suffix in FASTQ_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)], suffix
+    return path, ''
+
+def shard_path(path, index):
+    """第index个分片的输出路径，如 out.fq.gz -> out.shard0.fq.gz"""
+    stem, suffix = split_fastq_suffix(path)
+    return f"{stem}.shard{index}{suffix}"
+
+class ShardedOutput(object):
+    """分片输出：结果块按顺序轮流写入各分片
+
+    同一read的所有片段总在同一个块内，因此必然落在同一分片，各分片可以
+    独立比对、独立用paf2mnd转换后直接合并。
+    """
+
+    def __init__(self, path, shards, threads, pigz_available):
+        self.paths = [shard_path(path, i) for i in range(shards)]
+        pigz_threads = max(1, threads // shards)
+        self.outputs = [open_fastq_output(p, pigz_threads, pigz_available) for p in self.paths]
+        self.records = [0] * shards
+        self.fragments = [0] * shards
+        self.bytes = [0] * shards
+        self.next_shard = 0
+
+    def write_chunk(self, result):
+        data, record_count, fragment_count = result
+        shard = self.next_shard
+        self.outputs[shard][0].write(data)
+        self.records[shard] += record_count
+        self.fragments[shard] += fragment_count
+        self.bytes[shard] += len(data)
+        self.next_shard = (shard + 1) % len(self.outputs)
+
+    def close(self):
+        for out_handle, proc_out, out_file in self.outputs:
+            close_fastq_output(out_handle, proc_out, out_file)
+
+    def write_manifest(self, manifest):
+        """写出分片清单：分片编号、路径、记录数、片段数、未压缩字节数"""
+        with open(manifest, 'w') as f:
+            f.write("#shard\tpath\trecords\tfragments\tbytes\n")
+            for i, path in enumerate(self.paths):
+                f.write(f"{i}\t{os.path.abspath(path)}\t{self.records[i]}\t"
+                        f"{self.fragments[i]}\t{self.bytes[i]}\n")
+
+# IUPAC简并碱基，N等只匹配ACGT
+IUPAC_BASES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+
+# 常用酶名称，^为切割位置
+NAMED_ENZYMES = {
+    'DPNII': '^GATC', 'MBOI': '^GATC', 'SAU3AI': '^GATC',
+    'HINFI': 'G^ANTC', 'DDEI': 'C^TNAG', 'MSEI': 'T^TAA',
+    'NLAIII': 'CATG^', 'HINDIII': 'A^AGCTT', 'ARIMA': '^GATC,G^ANTC',
+}
+
+def parse_site_spec(enzyme_site):
+    """解析酶切位点描述，返回 [(位点, 切割偏移), ...]
+
+    多个位点或酶名以逗号分隔，如 GATC,GANTC 或 DpnII,HinfI；位点可含IUPAC
+    简并碱基，^标记切割位置，不写^时在位点起始处切割。
+    """
+    motifs = []
+    for item in enzyme_site.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        for site in NAMED_ENZYMES.get(item.upper(), item).split(','):
+            site = site.upper()
+            offset = site.find('^')
+            site = site.replace('^', '')
+            if offset < 0:
+                offset = 0
+            if not site or any(base not in IUPAC_BASES for base in site):
+                raise ValueError(f"Invalid enzyme site: {item}")
+            if (site, offset) not in motifs:
+                motifs.append((site, offset))
+    if not motifs:
+        raise ValueError(f"Invalid enzyme site: {enzyme_site}")
+    return motifs
+
+def site_regex(site):
+    """把含简并碱基的位点转为bytes正则"""
+    return b"".join(base.encode('ascii') if len(IUPAC_BASES[base]) == 1
+                    else b"[" + IUPAC_BASES[base].encode('ascii') + b"]"
+                    for base in site)
+
+class SiteScanner(object):
+    """一次扫描序列找出所有位点的切割位置（bytes，可pickle传给工作进程）
+
+    单个非简并位点用bytes.find逐个查找（与原来的单位点正则结果一致）；
+    多个或简并位点合并为一个正则交替式（按长度从长到短排列），每个匹配处
+    再按匹配到的具体序列查出所有在此处成立的位点及其切割偏移（结果缓存）。
+    """
+
+    def __init__(self, enzyme_site):
+        self.motifs = parse_site_spec(enzyme_site)
+        site, offset = self.motifs[0]
+        if len(self.motifs) == 1 and len(site_regex(site)) == len(site):
+            self.literal = site.encode('ascii')
+            self.offset = offset
+            return
+        self.literal = None
+        self.motifs.sort(key=lambda motif: -len(motif[0]))
+        self.pattern = re.compile(b"|".join(site_regex(site) for site, _ in self.motifs))
+        self.matchers = [(re.compile(site_regex(site)), len(site), offset)
+                         for site, offset in self.motifs]
+        self.offsets = {}
+        self.mixed_offsets = len(set(offset for _, offset in self.motifs)) > 1
+
+    def site_offsets(self, matched):
+        """匹配序列matched起始处成立的所有位点的切割偏移"""
+        offsets = self.offsets.get(matched)
+        if offsets is None:
+            offsets = tuple(sorted(set(
+                offset for matcher, length, offset in self.matchers
+                if length <= len(matched) and matcher.match(matched, 0, length))))
+            self.offsets[matched] = offsets
+        return offsets
+
+    def cut_sites(self, seq):
+        """返回seq上升序、去重的切割位点（0起始偏移）"""
+        cut_sites = []
+        if self.literal is not None:
+            find = seq.find
+            literal, step, offset = self.literal, len(self.literal), self.offset
+            pos = find(literal)
+            while pos >= 0:
+                cut_sites.append(pos + offset)
+                pos = find(literal, pos + step)
+            return cut_sites
+
+        # 交替式一次扫描，从匹配起点的下一位继续查找，不漏掉不同位点间的重叠
+        search = self.pattern.search
+        offsets = self.offsets
+        match = search(seq)
+        while match is not None:
+            start = match.start()
+            matched = match.group()
+            site_offsets = offsets.get(matched) or self.site_offsets(matched)
+            for offset in site_offsets:
+                cut_sites.append(start + offset)
+            match = search(seq, start + 1)
+        if self.mixed_offsets:
+            cut_sites = sorted(set(cut_sites))
+        return cut_sites
+
+def split_fastq(in_handle, out_handle, args, pool=None):
+    """切割流水线：读取(进程池任务线程) -> 有序imap切割 -> 写出线程
+
+    in_handle为二进制输入句柄，out_handle为任意带write(bytes)方法的对象
+    （文件、pigz管道或比对程序的stdin），或ShardedOutput/CutSiteIndexWriter。
+    args.index_in不为空时按已有索引切割，不再扫描序列；args.stats_out不为空时
+    工作进程顺便统计，合并后写出JSON。
+    pool为None时自行创建进程池。返回 (记录数, 片段数)。
+    """
+    if pool is None:
+        # 创建进程池
+        with multiprocessing.Pool(processes=args.threads) as pool:
+            return split_fastq(in_handle, out_handle, args, pool)
+
+    slots = threading.BoundedSemaphore(args.inflight_chunks)
+    write_queue = queue.Queue()
+    write_errors = []
+    writer = threading.Thread(target=chunk_writer,
+                              args=(out_handle, write_queue, slots, write_errors),
+                              daemon=True)
+    writer.start()
+
+    collect_stats = bool(args.stats_out)
+    index_handle = None
+    if args.index_in:
+        # 复用酶切位点索引：按索引块读取原始数据，只做切割和过滤
+        index_handle, _ = open_cut_site_index(args.index_in)
+        chunk_reader = read_indexed_blocks(in_handle, index_handle)
+        process_func = partial(process_indexed_block, min_length=args.min_length,
+                               collect_stats=collect_stats)
+    elif isinstance(out_handle, CutSiteIndexWriter):
+        # 只扫描酶切位点，输出索引
+        chunk_reader = read_fastq_blocks(in_handle, args.chunk_bytes or DEFAULT_INDEX_BLOCK_BYTES)
+        process_func = partial(index_block,
+                              scanner=SiteScanner(args.enzyme_site),
+                              min_length=args.min_length,
+                              collect_stats=collect_stats)
+    # 按字节块时只向工作进程传递原始bytes，由工作进程解析
+    elif args.chunk_bytes:
+        scanner = SiteScanner(args.enzyme_site)
+        chunk_reader = read_fastq_blocks(in_handle, args.chunk_bytes)
+        process_func = partial(process_block,
+                              scanner=scanner,
+                              min_length=args.min_length,
+                              collect_stats=collect_stats)
+    else:
+        scanner = SiteScanner(args.enzyme_site)
+        chunk_reader = read_fastq_chunks(in_handle, args.chunk_size)
+        process_func = partial(process_chunk,
+                              scanner=scanner,
+                              min_length=args.min_length,
+                              collect_stats=collect_stats)
+
+    # 统计变量
+    total_records = 0
+    total_fragments = 0
+    total_stats = new_stats(collect_stats)
+    last_report = time.time()
+
+    # 处理记录块：imap保证输出顺序与输入一致
+    chunks = inflight.bounded_chunks(chunk_reader, slots)
+    for data, record_count, fragment_count, stats in pool.imap(process_func, chunks):
+        # 交给写出线程，整块一次写入
+        write_queue.put((data, record_count, fragment_count))
+        
+        total_records += record_count
+        total_fragments += fragment_count
+        if stats is not None:
+            total_stats.merge(stats)
+
+        # 进度报告
+        current_time = time.time()
+        if current_time - last_report > 60 or total_records % 10000 == 0:
+            frag_per_rec = total_fragments / total_records if total_records else 0
+            print(f"Processed {total_records:,} records | "
+                  f"Fragments: {total_fragments:,} | "
+                  f"Avg fragments/record: {frag_per_rec:.2f} | "
+                  f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            last_report = current_time
+
+    # 等待写出线程写完所有块
+    write_queue.put(None)
+    writer.join()
+    if index_handle is not None:
+        index_handle.close()
+    if write_errors:
+        raise write_errors[0]
+    if total_stats is not None:
+        total_stats.write_json(args.stats_out, enzyme_site=args.enzyme_site,
+                               min_length=args.min_length)
+
+    return total_records, total_fragments
+
+# 内存预算：每个在途块在内存中约有这么多份（父进程原始块、工作进程拆出的行、
+# 工作进程输出、等待写出的输出），每个工作进程另有固定开销
+MEMORY_COPIES_PER_CHUNK = 4
+WORKER_BASE_MEMORY = 32 * 1024 * 1024
+MIN_CHUNK_BYTES = 1024 * 1024
+MAX_CHUNK_BYTES = 256 * 1024 * 1024
+
+def plan_memory(args):
+    """按--max_memory推算块字节数、在途块数，必要时减少工作进程数
+
+    按字节分块后每块的内存与read长度无关（超长read会自动并入同一块），
+    因此峰值内存约为 工作进程数 x 固定开销 + 在途块数 x 块字节数 x 份数。
+    """
+    # 每个进程至少要有2个最小块在途，否则减少进程数
+    per_thread = WORKER_BASE_MEMORY + 2 * MIN_CHUNK_BYTES * MEMORY_COPIES_PER_CHUNK
+    if args.max_memory < per_thread:
+        raise ValueError(f"--max_memory is too small, need at least {per_thread // 1024 ** 2} MB")
+    threads = min(args.threads, args.max_memory // per_thread)
+    budget = args.max_memory - threads * WORKER_BASE_MEMORY
+    args.threads = threads
+
+    inflight = args.inflight_chunks or 2 * threads
+    if args.chunk_bytes:
+        # 固定块大小时只调整在途块数
+        chunk_bytes = args.chunk_bytes
+        inflight = min(inflight, max(1, budget // (chunk_bytes * MEMORY_COPIES_PER_CHUNK)))
+    else:
+        chunk_bytes = budget // (inflight * MEMORY_COPIES_PER_CHUNK)
+        chunk_bytes = max(MIN_CHUNK_BYTES, min(MAX_CHUNK_BYTES, chunk_bytes))
+        inflight = min(inflight, max(2, budget // (chunk_bytes * MEMORY_COPIES_PER_CHUNK)))
+    args.chunk_bytes = chunk_bytes
+    args.inflight_chunks = inflight
+
+def add_split_arguments(parser):
+    """添加切割相关参数（fq_split.py与流式入口共用）"""
+    parser.add_argument('--min_length', type=int, default=50,
+                        help='Minimum fragment length to output')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of records per processing chunk')
+    parser.add_argument('--chunk_bytes', type=int, default=0,
+                        help='Raw FASTQ bytes per block shipped to workers; '
+                             'workers parse whole blocks (0 = chunk by --chunk_size records)')
+    parser.add_argument('--inflight_chunks', type=int, default=0,
+                        help='Maximum chunks being read/processed/written at once (0 = 2 x threads)')
+    parser.add_argument('--index_in', default=None,
+                        help='Cut fragments using a cut-site index written by --index_out '
+                             'instead of scanning sequences (--enzyme_site not needed)')
+    parser.add_argument('--stats_out', default=None,
+                        help='Write digestion statistics (fragment-length and fragments-per-read '
+                             'histograms, bases dropped by --min_length) to this JSON file')
+    parser.add_argument('--max_memory', type=memory_size.parse_memory_size, default=None,
+                        help='Memory budget for splitting, e.g. 8G or 512M (plain numbers are MB); '
+                             'derives --chunk_bytes and --inflight_chunks and may lower the process count')
+
+def check_split_arguments(args):
+    """验证切割相关参数"""
+    if not args.index_in and not args.enzyme_site:
+        raise ValueError("--enzyme_site is required unless --index_in is given")
+    if args.enzyme_site:
+        parse_site_spec(args.enzyme_site)
+    if args.min_length < 1:
+        raise ValueError("Minimum length must be at least 1")
+    if args.threads < 1:
+        raise ValueError("Thread count must be at least 1")
+    if args.chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")
+    if args.chunk_bytes < 0:
+        raise ValueError("Chunk bytes must not be negative")
+    if args.inflight_chunks < 0:
+        raise ValueError("In-flight chunk count must not be negative")
+    if args.max_memory is not None:
+        plan_memory(args)
+    elif args.inflight_chunks == 0:
+        args.inflight_chunks = 2 * args.threads
+
 def main():
     parser = argparse.ArgumentParser(
         description='Split FASTQ sequences at enzyme sites and filter by length',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
-    parser.add_argument('--enzyme_site', required=True,
-                        help='Enzyme recognition site (e.g., GATC)')
+    parser.add_argument('--enzyme_site', default=None,
+                        help='Enzyme recognition site(s), comma-separated; IUPAC codes and '
+                             '^ cut marks allowed, or enzyme names (e.g., GATC, ^GATC,G^ANTC, DpnII,HinfI)')
     parser.add_argument('--fq_in', required=True,
                         help='Input FASTQ file (gzipped if ends with .gz)')
-    parser.add_argument('--fq_out', required=True,
+    parser.add_argument('--fq_out', default=None,
                         help='Output FASTQ file (will gzip if ends with .gz)')
-    parser.add_argument('--min_length', type=int, default=50,
-                        help='Minimum fragment length to output')
+    parser.add_argument('--index_out', default=None,
+                        help='Write a compact binary cut-site index instead of fragment FASTQ')
     parser.add_argument('--threads', type=int, default=multiprocessing.cpu_count(),
                         help='Number of parallel threads to use')
-    parser.add_argument('--chunk_size', type=int, default=1000,
-                        help='Number of records per processing chunk')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Write N output shards (fragments of a read stay in one shard) '
+                             'plus a manifest, e.g. out.shard0.fq.gz ... out.manifest.tsv')
+    add_split_arguments(parser)
 
     args = parser.parse_args()
 
     # 验证参数
-    if args.min_length < 1:
-        raise ValueError("Minimum length must be at least 1")
-    if args.threads < 1:
-        raise ValueError("Thread count must be at least 1")
-    if args.chunk_size < 1:
-        raise ValueError("Chunk size must be at least 1")
+    check_split_arguments(args)
+    if args.shards < 1:
+        raise ValueError("Shard count must be at least 1")
+    if bool(args.fq_out) == bool(args.index_out):
+        raise ValueError("Specify exactly one of --fq_out and --index_out")
+    if args.index_out and (args.index_in or args.shards > 1):
+        raise ValueError("--index_out cannot be combined with --index_in or --shards")
+    if args.index_in:
+        index_handle, args.enzyme_site = open_cut_site_index(args.index_in)
+        index_handle.close()
 
     print("Processing parameters:")
     print(f"  Enzyme site: {args.enzyme_site}")
     print(f"  Input file: {args.fq_in}")
-    print(f"  Output file: {args.fq_out}")
+    if args.index_in:
+        print(f"  Cut-site index: {args.index_in}")
+    if args.index_out:
+        print(f"  Output cut-site index: {args.index_out}")
+    else:
+        print(f"  Output file: {args.fq_out}")
     print(f"  Minimum fragment length: {args.min_length}")
     print(f"  Threads: {args.threads}")
-    print(f"  Chunk size: {args.chunk_size}")
+    if args.chunk_bytes:
+        print(f"  Chunk bytes: {args.chunk_bytes:,}")
+    else:
+        print(f"  Chunk size: {args.chunk_size}")
+    print(f"  In-flight chunks: {args.inflight_chunks}")
+    if args.max_memory is not None:
+        print(f"  Memory budget: {args.max_memory / 1024 ** 2:,.0f} MB")
+    if args.shards > 1:
+        print(f"  Shards: {args.shards}")
     print(f"Start time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    # 预编译正则表达式
-    compiled_pattern = re.compile(re.escape(args.enzyme_site))
-    
     # 检查是否安装了pigz/unpigz
     pigz_available = os.system("which unpigz > /dev/null 2>&1") == 0
     
-    # 打开输入文件
-    if args.fq_in.endswith('.gz') and pigz_available:
-        print("Using unpigz for parallel decompression...")
-        proc_in = subprocess.Popen(['unpigz', '-c', args.fq_in], stdout=subprocess.PIPE, text=True)
-        in_handle = proc_in.stdout
-    elif args.fq_in.endswith('.gz'):
-        print("unpigz not found, using gzip...")
-        import gzip
-        in_handle = gzip.open(args.fq_in, 'rt')
+    # 打开输入、输出文件
+    in_handle, proc_in = open_fastq_input(args.fq_in, pigz_available)
+    if args.index_out:
+        out_handle = CutSiteIndexWriter(args.index_out, args.enzyme_site)
+    elif args.shards > 1:
+        out_handle = ShardedOutput(args.fq_out, args.shards, args.threads, pigz_available)
     else:
-        in_handle = open(args.fq_in, 'r')
+        out_handle, proc_out, out_file = open_fastq_output(args.fq_out, args.threads, pigz_available)
 
-    # 打开输出文件
-    if args.fq_out.endswith('.gz') and pigz_available:
-        print("Using pigz for parallel compression...")
-        # 直接打开输出文件，稍后使用subprocess处理压缩
-        out_file = open(args.fq_out, 'wb')
-        proc_out = subprocess.Popen(['pigz', '-c', '-p', str(args.threads)], 
-                                   stdin=subprocess.PIPE, stdout=out_file)
-        out_handle = proc_out.stdin
-        use_binary_output = True
-    elif args.fq_out.endswith('.gz'):
-        print("pigz not found, using gzip...")
-        import gzip
-        out_handle = gzip.open(args.fq_out, 'wt')
-        use_binary_output = False
-    else:
-        out_handle = open(args.fq_out, 'w')
-        use_binary_output = False
-
-    # 创建进程池
-    with multiprocessing.Pool(processes=args.threads) as pool:
-        process_func = partial(process_record,
-                              compiled_pattern=compiled_pattern,
-                              min_length=args.min_length)
-
-        # 统计变量
-        total_records = 0
-        total_fragments = 0
-        last_report = time.time()
-
-        # 处理记录块
-        for chunk in read_fastq_chunks(in_handle, args.chunk_size):
-            # 处理当前块
-            results = pool.map(process_func, chunk)
-            
-            # 写入输出
-            for fragments in results:
-                for frag in fragments:
-                    if use_binary_output:
-                        # 对于二进制输出，需要编码为字节
-                        out_handle.write(frag.encode('utf-8'))
-                    else:
-                        # 对于文本输出，直接写入字符串
-                        out_handle.write(frag)
-            
-            total_records += len(chunk)
-            total_fragments += sum(len(frags) for frags in results)
-
-            # 进度报告
-            current_time = time.time()
-            if current_time - last_report > 60 or total_records % 10000 == 0:
-                frag_per_rec = total_fragments / total_records if total_records else 0
-                print(f"Processed {total_records:,} records | "
-                      f"Fragments: {total_fragments:,} | "
-                      f"Avg fragments/record: {frag_per_rec:.2f} | "
-                      f"Time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-                last_report = current_time
+    total_records, total_fragments = split_fastq(in_handle, out_handle, args)
 
     # 清理资源
-    in_handle.close()
-    
-    # 如果是通过subprocess打开的输入，需要等待进程结束
-    if args.fq_in.endswith('.gz') and pigz_available:
-        proc_in.wait()
-    
-    # 关闭输出句柄
-    if use_binary_output:
+    close_fastq_input(in_handle, proc_in)
+    if args.index_out:
         out_handle.close()
-        proc_out.wait()
-        out_file.close()
-    else:
+    elif args.shards > 1:
         out_handle.close()
+        manifest = split_fastq_suffix(args.fq_out)[0] + ".manifest.tsv"
+        out_handle.write_manifest(manifest)
+    else:
+        close_fastq_output(out_handle, proc_out, out_file)
 
     # 最终报告
     frag_per_rec = total_fragments / total_records if total_records else 0
@@ -212,7 +883,15 @@ def main():
     print(f"Total fragments generated: {total_fragments:,}")
     print(f"Average fragments per record: {frag_per_rec:.2f}")
     print(f"End time: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"Results saved to: {args.fq_out}")
+    if args.stats_out:
+        print(f"Digestion statistics saved to: {args.stats_out}")
+    if args.index_out:
+        print(f"Cut-site index saved to: {args.index_out}")
+    elif args.shards > 1:
+        print(f"Results saved to: {', '.join(out_handle.paths)}")
+        print(f"Shard manifest: {manifest}")
+    else:
+        print(f"Results saved to: {args.fq_out}")
 
 if __name__ == "__main__":
     main()
@@ -18,7 +18,7 @@ __version__ = "v2.0"
 '''
 
 def hic_viewer(hicfile, ref, rslu=500000, norm="KR", xchrom="assembly", ychrom='assembly', 
-	outpfix='samplename', outfmt="pdf"):
+	outpfix='samplename', outfmt="pdf", threads=1):
 	''' ############# generate figure from .hic file #############
 	[usage] python hic_viewer.py 
 	            --hicfile arabidopsis_thaliana.hic
@@ -28,11 +28,12 @@ def hic_viewer(hicfile, ref, rslu=500000, norm="KR", xchrom="assembly", ychrom='
 	            --xchrom 1:20000:50000
 	            --ychrom 1:20000:50000
 	            --outpfix arabidopsis_thaliana	
+	            --threads 4
 	[note] `ref' used to get x/y axis limit, sometimes (eg. genome size > 2G) 
 	       bin number in hic file is less than which genome size < 2G
 	'''
 	xchrom, ychrom = str(xchrom), str(ychrom)
-	hic_matrix = straw.straw(norm, hicfile, xchrom, ychrom, "BP", int(rslu))
+	hic_matrix = straw.straw(norm, hicfile, xchrom, ychrom, "BP", int(rslu), threads=int(threads))
 	#uniq_x = np.unique(hic_matrix[0])
 	#axis_limit = (len(uniq_x) - 1) * int(rslu) / 1000 / 1000
 	infa = [i for i in SeqIO.parse(ref,'fasta')]
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：fq_split.py、paf2mnd.py、dups.py共用的在途块限制。读取端每送出一块
+前先占用一个名额，写出端写完该块后释放，读取、处理和写出可以重叠进行，而内存
+中最多只有固定数量的块。
+
+import inflight
+slots = threading.Semaphore(2 * workers)
+for result in pool.imap(func, inflight.bounded_chunks(chunks, slots)):
+    ...
+    slots.release()
+"""
+
+def bounded_chunks(chunks, slots, stop=None):
+    """每送出一块前先占用一个在途名额，名额在该块结果写出后释放
+
+    stop（threading.Event）置位后停止读取，供出错时让读取线程退出：
+    出错一方先置位stop，再释放一个名额唤醒可能阻塞在名额上的读取端。
+    """
+    for chunk in chunks:
+        slots.acquire()
+        if stop is not None and stop.is_set():
+            break
+        yield chunk
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: zhengshang@frasergen.com zhengshang-zn@qq.com
+
+脚本说明：fq_split.py、paf2mnd.py、fq2mnd.py、dups.py共用的内存大小参数解析，
+保证各脚本的 --max_memory/--max-memory 写法一致。
+
+import memory_size
+parser.add_argument('--max_memory', type=memory_size.parse_memory_size)
+"""
+import argparse
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_memory_size(value):
+    """解析内存大小，如 512M、16G、1.5T（可带B后缀）；不带单位时按MB计，返回字节数"""
+    text = value.strip().upper().rstrip('B')
+    try:
+        if text and text[-1] in UNITS:
+            return int(float(text[:-1]) * UNITS[text[-1]])
+        return int(float(text) * UNITS['M'])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid memory size: {value}")
@@ -10,127 +10,783 @@ python paf2mnd.py reads.paf contacts.mnd
 python paf2mnd.py reads.paf contacts.mnd -m 0.85
 处理超大型文件：
 python paf2mnd.py huge.paf huge_contacts.mnd -m 0.75 -c 5000000 -w 16
+限制每条read的组合数（只组合相邻片段，或每条read最多100个组合并输出权重列）：
+python paf2mnd.py reads.paf contacts.mnd --pairing adjacent
+python paf2mnd.py reads.paf contacts.mnd --pairing capped --max-pairs 100 --weight
+工作进程按字节区间并行读取（普通文件或bgzip压缩的PAF）：
+python paf2mnd.py huge.paf.gz huge_contacts.mnd -w 32 --read-ranges
+按内存预算自动确定块大小和进程数：
+python paf2mnd.py huge.paf huge_contacts.mnd -w 16 --max-memory 32G
+同时输出列式二进制contact文件（可用contacts.py导出为MND或在Python中读取）：
+python paf2mnd.py huge.paf huge_contacts.mnd -w 16 --contacts huge.contacts.bin
+直接输出排序后的MND（等同于 LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n），
+可省去单独的排序步骤，直接作为dups.awk的输入：
+python paf2mnd.py huge.paf your_species.mnd.sort.txt -w 16 --sorted
 """
 
 from itertools import combinations
 import multiprocessing
 import os
 import time
-from collections import defaultdict
+from array import array
+from collections import namedtuple
 import resource
 import sys
-import tempfile
-import shutil
+import threading
+import struct
+import zlib
+import gzip
+from functools import partial
+from contextlib import contextmanager
 import argparse
+import random
+import re
+import heapq
+import shutil
+import tempfile
+
+import inflight
+import memory_size
+
+# numpy可选：可用时整块向量化生成组合，否则逐组处理；二进制contact输出需要numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    import contacts
 
 def strand_change(record):
     """方向转换函数"""
     return 0 if record == "+" else 16
 
-def process_read_group(group, min_identity=0.75):
-    """处理单个read ID的分组数据，生成MND记录"""
-    results = []
-    fragments_set=set()
-    dup_list=[]
-    global group_dedup
-    group_dedup=[]
-    # 1. 检查是否为唯一比对 - 只保留只有一个比对记录的分组
-    if len(group) > 1:
-        # 检查是否有重复的完整read ID（包括位置信息）
-        for record in group:
-            if record[0] in fragments_set:
-                dup_list.append(record[0])
-            else:
-                fragments_set.add(record[0])
-        group_dedup=[i for i in group if i[0] not in dup_list]
-        if len(group_dedup) == 0:
-            # 去多重比对后group为空，跳过该组
-            return []
-    
-    # 2. identity过滤
-    filtered_alignments = []
-    for record in group_dedup:
+# 按列投影后的PAF块：只保留用到的列（0,4,5,7,8,9,10,11），数值列为紧凑的array
+#   read_ids  每组（连续相同基础read ID的记录）的基础read ID
+#   offsets   每组在记录数组中的起止位置，长度为组数+1
+#   contigs   本块内出现的contig名称表，contig为其下标
+#   strand    方向（0/16）
+#   pos       比对中点 (起点+终点)//2，坐标无法解析时为-1（不参与组合）
+#   matches/aln_len  计算identity用，无法解析时aln_len为0（被identity过滤）
+#   mapq      比对质量，无法解析时该记录pos为-1
+#   dup       完整read ID在组内重复的记录为1（多重比对，整体去除）
+PafChunk = namedtuple('PafChunk', ['read_ids', 'offsets', 'contigs', 'contig', 'strand', 'pos',
+                                   'matches', 'aln_len', 'mapq', 'dup'])
+
+class PafChunkBuilder(object):
+    """父进程中逐行投影PAF列并累积为PafChunk，不保留整行和可选标签"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.read_ids = []
+        self.offsets = array('q', [0])
+        self.contigs = []
+        self.contig_index = {}
+        self.contig = array('l')
+        self.strand = array('B')
+        self.pos = array('q')
+        self.matches = array('q')
+        self.aln_len = array('q')
+        self.mapq = array('l')
+        self.dup = array('B')
+        self.group_names = {}
+
+    def __len__(self):
+        return len(self.pos)
+
+    def start_group(self, base_id):
+        """开始一个新的read分组"""
+        if self.read_ids:
+            self.offsets.append(len(self.pos))
+        self.read_ids.append(base_id)
+        self.group_names = {}
+
+    def add(self, fields):
+        """添加一条记录，fields为 line.split('\\t', 12) 的结果"""
+        index = len(self.pos)
+        # 组内完整read ID重复：该ID的所有记录都标记为多重比对
+        full_id = fields[0]
+        first = self.group_names.setdefault(full_id, index)
+        duplicate = first != index
+        if duplicate:
+            self.dup[first] = 1
+        self.dup.append(duplicate)
+
+        contig = fields[5]
+        contig_id = self.contig_index.get(contig)
+        if contig_id is None:
+            contig_id = self.contig_index[contig] = len(self.contigs)
+            self.contigs.append(contig)
+        self.contig.append(contig_id)
+        self.strand.append(strand_change(fields[4]))
         try:
-            matches = int(record[9])
-            aln_len = int(record[10])
-            if matches / aln_len > min_identity:
-                filtered_alignments.append(record)
-        except (ValueError, IndexError, ZeroDivisionError):
-            continue
-    
-    # 3. 如果没有有效记录或只有一条记录，跳过该组
-    if len(filtered_alignments) < 2:
-        return []
-    
-    # 4. 生成所有有效组合
-    combination_count = 0
-    
-    for pair in combinations(filtered_alignments, 2):
+            mapq = int(fields[11])
+            pos = (int(fields[7]) + int(fields[8])) // 2
+        except ValueError:
+            mapq, pos = 0, -1
+        self.mapq.append(mapq)
+        self.pos.append(pos)
         try:
-            strand1 = strand_change(pair[0][4])
-            strand2 = strand_change(pair[1][4])
-            mapq1 = pair[0][11]
-            mapq2 = pair[1][11]
-            chr1 = pair[0][5]
-            chr2 = pair[1][5]
-            
-            # 计算位置（使用整数除法提高效率）
-            start1, end1 = int(pair[0][7]), int(pair[0][8])
-            start2, end2 = int(pair[1][7]), int(pair[1][8])
-            pos1 = (start1 + end1) // 2
-            pos2 = (start2 + end2) // 2
-            
-            # 提取基础read ID（去掉位置信息）
-            base_read_id = pair[0][0].split(':')[0]
-            
-            # 构建MND记录
-            results.append(
-                f"{strand1}\t{chr1}\t{pos1}\t0\t{strand2}\t{chr2}\t{pos2}\t1\t{mapq1}\t-\t-\t{mapq2}\t-\t-\t{base_read_id}\t{base_read_id}\n"
-            )
-            
-            combination_count += 1
-        except (IndexError, ValueError):
-            continue
-    
-    return results
+            matches, aln_len = int(fields[9]), int(fields[10])
+        except ValueError:
+            matches, aln_len = 0, 0
+        self.matches.append(matches)
+        self.aln_len.append(aln_len)
+
+    def build(self):
+        """返回当前累积的PafChunk并清空"""
+        offsets = self.offsets
+        if self.read_ids:
+            offsets.append(len(self.pos))
+        chunk = PafChunk(self.read_ids, offsets, self.contigs, self.contig, self.strand,
+                         self.pos, self.matches, self.aln_len, self.mapq, self.dup)
+        self.reset()
+        return chunk
+
+# 组合方式：
+#   all       组内所有两两组合（默认）
+#   adjacent  只组合read上相邻的片段
+#   knn       每个片段与read上其后neighbors个片段组合
+#   capped    所有组合，但每条read最多max_pairs个，超过时按read ID确定性抽样
+# weight为真时MND增加第17列权重 = 该read全部组合数 / 实际输出组合数，
+# 各模式的权重之和与all模式的记录数相同。
+Pairing = namedtuple('Pairing', ['mode', 'neighbors', 'max_pairs', 'weight'])
+PAIRING_MODES = ('all', 'adjacent', 'knn', 'capped')
+DEFAULT_PAIRING = Pairing('all', 1, 0, False)
+
+def sample_pair_ranks(read_id, total, max_pairs):
+    """从total个组合（按combinations顺序编号）中确定性抽取max_pairs个，返回升序编号
 
-def base_id_key(record):
-    """提取基础read ID作为键"""
-    full_id = record[0]
-    return full_id.split(':')[0] if ':' in full_id else full_id
+    随机种子为read ID的crc32，结果与块划分、进程数无关。
+    """
+    rng = random.Random(zlib.crc32(read_id.encode()))
+    return sorted(rng.sample(range(total), max_pairs))
 
-def process_chunk(chunk, min_identity, output_file):
-    """处理一个数据块，确保同一基础read ID的记录连续"""
-    # 按基础read ID分组
-    groups = defaultdict(list)
+def select_pairs(count, read_id, pairing):
+    """按组合方式返回 [(左, 右), ...]，左右为组内保留记录的序号"""
+    if pairing.mode == 'adjacent':
+        return [(a, a + 1) for a in range(count - 1)]
+    if pairing.mode == 'knn':
+        return [(a, b) for a in range(count)
+                for b in range(a + 1, min(count, a + pairing.neighbors + 1))]
+    pairs = list(combinations(range(count), 2))
+    if pairing.mode == 'capped' and len(pairs) > pairing.max_pairs:
+        pairs = [pairs[rank] for rank in sample_pair_ranks(read_id, len(pairs), pairing.max_pairs)]
+    return pairs
+
+def format_weight(all_pairs, emitted):
+    return f"{all_pairs / emitted:.6g}"
+
+def process_read_group(chunk, start, end, read_id, min_identity=0.75, pairing=DEFAULT_PAIRING):
+    """处理单个read ID的分组数据（chunk中第start到end-1条记录），生成MND记录"""
+    # 1. 检查是否为唯一比对 - 只有一条记录的组跳过，完整read ID重复的记录全部去除
+    if end - start < 2:
+        return []
+    dup = chunk.dup
+    matches = chunk.matches
+    aln_len = chunk.aln_len
+
+    # 2. identity过滤（坐标或比对质量无法解析的记录不参与组合）
+    pos = chunk.pos
+    filtered_alignments = [i for i in range(start, end)
+                           if not dup[i] and aln_len[i] != 0
+                           and matches[i] / aln_len[i] > min_identity and pos[i] >= 0]
+    count = len(filtered_alignments)
+    if count < 2:
+        return []
+
+    # 3. 预先格式化每条记录在MND中的两半
+    strand = chunk.strand
+    mapq = chunk.mapq
+    contig = chunk.contig
+    contigs = chunk.contigs
+    left = [f"{strand[i]}\t{contigs[contig[i]]}\t{pos[i]}\t0\t" for i in filtered_alignments]
+    right = [f"{strand[i]}\t{contigs[contig[i]]}\t{pos[i]}\t1\t" for i in filtered_alignments]
+    mapqs = [mapq[i] for i in filtered_alignments]
+
+    # 4. 按组合方式生成组合
+    pairs = select_pairs(count, read_id, pairing)
+    if pairing.weight:
+        tail = (f"\t-\t-\t{read_id}\t{read_id}\t"
+                f"{format_weight(count * (count - 1) // 2, len(pairs))}\n")
+    else:
+        tail = f"\t-\t-\t{read_id}\t{read_id}\n"
+    return [f"{left[a]}{right[b]}{mapqs[a]}\t-\t-\t{mapqs[b]}{tail}" for a, b in pairs]
+
+def surviving_groups(chunk):
+    """返回需要处理的组下标（按基础read ID首次出现的顺序）
+
+    同一块内基础read ID不连续重复出现时，以后出现的组为准（保持原有行为）。
+    """
+    groups = {}
+    for index, read_id in enumerate(chunk.read_ids):
+        groups[read_id] = index
+    return list(groups.values())
+
+def pair_indices(chunk, order, min_identity, pairing=DEFAULT_PAIRING):
+    """向量化计算整块的组合下标
+
+    order为surviving_groups的结果。返回 (保留记录下标, 其所属order中的组序号,
+    组合左端, 组合右端)，左右端为保留记录数组中的下标；组合按组、再按
+    (左, 右) 的字典序排列，与itertools.combinations一致。
+    """
+    offsets = np.asarray(chunk.offsets)
+    order = np.asarray(order, dtype=np.int64)
+    starts = offsets[order]
+    lengths = offsets[order + 1] - starts
+    # 按组顺序展开所有记录下标
+    records = np.arange(int(lengths.sum())) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    record_group = np.repeat(np.arange(len(order)), lengths)
+
+    # 去除多重比对、identity过滤，坐标或比对质量无法解析的记录不参与组合
+    matches = np.asarray(chunk.matches)[records]
+    aln_len = np.asarray(chunk.aln_len)[records]
+    identity = np.divide(matches, aln_len, out=np.zeros(len(records)), where=aln_len != 0)
+    keep = ((np.asarray(chunk.dup)[records] == 0) & (aln_len != 0) & (identity > min_identity)
+            & (np.asarray(chunk.pos)[records] >= 0))
+    kept = records[keep]
+    kept_group = record_group[keep]
+
+    # 三角下标展开：每条记录与组内其后的每条记录组成一对（adjacent/knn只取其后几条）
+    group_ends = np.cumsum(np.bincount(kept_group, minlength=len(order)))
+    partners = group_ends[kept_group] - np.arange(len(kept)) - 1
+    if pairing.mode in ('adjacent', 'knn'):
+        partners = np.minimum(partners, 1 if pairing.mode == 'adjacent' else pairing.neighbors)
+    left = np.repeat(np.arange(len(kept)), partners)
+    block_starts = np.cumsum(partners) - partners
+    right = left + 1 + np.arange(len(left)) - np.repeat(block_starts, partners)
+
+    if pairing.mode == 'capped':
+        # 组合数超过上限的组抽样，其余组全部保留
+        read_ids = chunk.read_ids
+        group_pairs = np.bincount(kept_group[left], minlength=len(order))
+        pair_starts = np.cumsum(group_pairs) - group_pairs
+        selected = np.ones(len(left), dtype=bool)
+        for group in np.flatnonzero(group_pairs > pairing.max_pairs).tolist():
+            total = int(group_pairs[group])
+            start = int(pair_starts[group])
+            selected[start:start + total] = False
+            ranks = sample_pair_ranks(read_ids[order[group]], total, pairing.max_pairs)
+            selected[start + np.asarray(ranks, dtype=np.int64)] = True
+        left = left[selected]
+        right = right[selected]
+    return kept, kept_group, left, right
+
+def format_pairs(chunk, order, kept, kept_group, left, right, weight=False):
+    """按组合下标批量拼接MND记录，返回整块文本
+
+    每条记录的两半、比对质量和每组的read ID只格式化一次，组合部分由
+    切片赋值和str.join完成，不逐对执行Python代码。
+    """
+    contigs = chunk.contigs
+    strand = np.asarray(chunk.strand)[kept].tolist()
+    contig = np.asarray(chunk.contig)[kept].tolist()
+    pos = np.asarray(chunk.pos)[kept].tolist()
+    mapq = np.asarray(chunk.mapq)[kept].tolist()
+    read_ids = [chunk.read_ids[index] for index in order]
+    first = [f"{s}\t{contigs[c]}\t{p}\t0\t" for s, c, p in zip(strand, contig, pos)]
+    second = [f"{s}\t{contigs[c]}\t{p}\t1\t" for s, c, p in zip(strand, contig, pos)]
+    first_mapq = [f"{q}\t-\t-\t" for q in mapq]
+    second_mapq = [str(q) for q in mapq]
+    if weight:
+        # 每组的权重 = 该组全部组合数 / 输出组合数
+        kept_counts = np.bincount(kept_group, minlength=len(order)).tolist()
+        emitted = np.bincount(kept_group[left], minlength=len(order)).tolist()
+        group_tails = [f"\t-\t-\t{read_id}\t{read_id}\t"
+                       f"{format_weight(n * (n - 1) // 2, m) if m else 0}\n"
+                       for read_id, n, m in zip(read_ids, kept_counts, emitted)]
+    else:
+        group_tails = [f"\t-\t-\t{read_id}\t{read_id}\n" for read_id in read_ids]
+    tails = [group_tails[g] for g in kept_group.tolist()]
+
+    left = left.tolist()
+    right = right.tolist()
+    pieces = [None] * (5 * len(left))
+    pieces[0::5] = map(first.__getitem__, left)
+    pieces[1::5] = map(second.__getitem__, right)
+    pieces[2::5] = map(first_mapq.__getitem__, left)
+    pieces[3::5] = map(second_mapq.__getitem__, right)
+    pieces[4::5] = map(tails.__getitem__, left)
+    return "".join(pieces)
+
+def encode_contacts(chunk, order, kept, kept_group, left, right, weight=False):
+    """把组合编码为二进制contact块（contacts.EncodedChunk），没有组合时返回None"""
+    if not len(left):
+        return None
+    strand = np.asarray(chunk.strand)[kept]
+    contig = np.asarray(chunk.contig)[kept]
+    pos = np.asarray(chunk.pos)[kept]
+    mapq = np.asarray(chunk.mapq)[kept]
+    group_pairs = np.bincount(kept_group[left], minlength=len(order))
+    groups = np.flatnonzero(group_pairs)
+    read_names = [chunk.read_ids[order[group]] for group in groups.tolist()]
+    weights = None
+    if weight:
+        kept_counts = np.bincount(kept_group, minlength=len(order))[groups]
+        weights = kept_counts * (kept_counts - 1) // 2 / group_pairs[groups]
+    return contacts.encode_chunk(chunk.contigs, strand[left], contig[left], pos[left],
+                                 strand[right], contig[right], pos[right], mapq[left],
+                                 mapq[right], read_names, group_pairs[groups], weights)
+
+def process_chunk(chunk, min_identity, pairing=DEFAULT_PAIRING, with_contacts=False):
+    """处理一个PafChunk，返回 (按组顺序拼接的MND文本, MND记录数)
+
+    with_contacts为真时（需要numpy）第一项为 (MND文本, 二进制contact块或None)。
+    """
+    order = surviving_groups(chunk)
+    if np is not None:
+        kept, kept_group, left, right = pair_indices(chunk, order, min_identity, pairing)
+        text = format_pairs(chunk, order, kept, kept_group, left, right, pairing.weight)
+        if with_contacts:
+            return (text, encode_contacts(chunk, order, kept, kept_group, left, right,
+                                          pairing.weight)), len(left)
+        return text, len(left)
+
+    records = []
+    offsets = chunk.offsets
+    for index in order:
+        records.extend(process_read_group(chunk, offsets[index], offsets[index + 1],
+                                          chunk.read_ids[index], min_identity, pairing))
+    return "".join(records), len(records)
+
+# 内存预算：拆分后的PAF记录（Python字符串列表）约为原始文本的这么多倍，
+# 包含父进程中的块、传给工作进程的序列化副本和工作进程中的块
+PAF_MEMORY_FACTOR = 12
+PAF_WORKER_MEMORY = 64 * 1024 * 1024
+MIN_PAF_CHUNK_BYTES = 1024 * 1024
+
+def plan_paf_memory(max_memory, max_workers):
+    """按内存预算推算 (工作进程数, 每块字节数, 最多在途块数)
+
+    每块按实际读到的PAF行字节数累计，与read长度、每条read的比对数无关。
+    """
+    # 每个进程至少要有2个最小块在途，否则减少进程数
+    per_worker = PAF_WORKER_MEMORY + 2 * MIN_PAF_CHUNK_BYTES * PAF_MEMORY_FACTOR
+    if max_memory < per_worker:
+        raise ValueError(f"内存预算过小，至少需要 {per_worker // 1024 ** 2} MB")
+    workers = min(max_workers, max_memory // per_worker)
+    budget = max_memory - workers * PAF_WORKER_MEMORY
+    inflight = 2 * workers
+    chunk_bytes = max(MIN_PAF_CHUNK_BYTES, budget // (inflight * PAF_MEMORY_FACTOR))
+    inflight = min(inflight, max(2, budget // (chunk_bytes * PAF_MEMORY_FACTOR)))
+    return workers, chunk_bytes, inflight
+
+def read_paf_chunks(paf_handle, chunk_size, chunk_bytes, counter):
+    """按read边界把PAF行流切成PafChunk，每行只拆出前12列，投影为紧凑的列数组
+
+    行数达到chunk_size或字节数达到chunk_bytes（不为0时）即生成一块；
+    读取的总行数累加到counter['lines']。
+    """
+    builder = PafChunkBuilder()
+    chunk_nbytes = 0
     current_base_id = None
-    current_group = []
     
-    for record in chunk:
-        base_id = base_id_key(record)
+    for line in paf_handle:
+        counter['lines'] += 1
+        chunk_nbytes += len(line)
         
-        # 当基础ID变化时，保存前一个组
-        if current_base_id is not None and base_id != current_base_id:
-            if current_group:
-                groups[current_base_id] = current_group
-                current_group = []
+        # 解析记录（可选标签不拆分）
+        parts = line.split('\t', 12)
+        if len(parts) < 12:
+            continue
+            
+        # 提取基础ID
+        base_id = parts[0].partition(':')[0]
+        
+        if base_id != current_base_id:
+            # 当基础ID变化且块大小达到时，输出当前块
+            if current_base_id is not None and (
+                    len(builder) >= chunk_size or (chunk_bytes and chunk_nbytes >= chunk_bytes)):
+                yield builder.build()
+                chunk_nbytes = len(line)
+            builder.start_group(base_id)
+            current_base_id = base_id
         
-        current_group.append(record)
-        current_base_id = base_id
+        builder.add(parts)
+        
+    # 最后一块
+    if len(builder):
+        yield builder.build()
+
+# 排序输出：与流程中的 LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n 结果一致。
+# 工作进程把每块的MND行排序后写成一个有序段（run），主进程对各段做多路归并。
+# 每行在段文件中带有排序前缀，前缀按字节比较即等价于sort的键比较：
+#   第2、6列（染色体）按d规则只保留字母、数字和空白，后接\x01（小于这些字符）；
+#   第1、5、3列（方向、位置）为非负整数，编码为 长度字符+数字，定长比较即按数值比较；
+#   第4、8列（片段号）恒为0和1，不影响顺序；键相同时按整行比较（sort的最后比较）。
+SORT_KEY_SEP = "\x01"
+NON_DICTIONARY = re.compile(r"[^A-Za-z0-9 \t]")
+# 一次归并最多同时打开的段数，超过时先分批归并为中间段
+MAX_MERGE_RUNS = 256
+
+def numeric_sort_key(value):
+    """非负整数文本的定长可比编码"""
+    return chr(96 + len(value)) + value
+
+def sort_run_lines(text):
+    """把一块MND文本按排序键排好，返回带排序前缀的行"""
+    names = {}
+    decorated = []
+    for line in text.splitlines(True):
+        fields = line.split('\t', 6)
+        keys = []
+        for name in (fields[1], fields[5]):
+            key = names.get(name)
+            if key is None:
+                key = names[name] = NON_DICTIONARY.sub('', name) + SORT_KEY_SEP
+            keys.append(key)
+        decorated.append(keys[0] + keys[1] + numeric_sort_key(fields[0]) +
+                         numeric_sort_key(fields[4]) + numeric_sort_key(fields[2]) +
+                         SORT_KEY_SEP + line)
+    decorated.sort()
+    return decorated
+
+def write_sorted_run(process_func, run_dir, with_contacts, task):
+    """在工作进程中处理task并把结果排序写为段文件，返回 (段文件路径或None, 计数...)
+
+    with_contacts为真时第一项为 (段文件路径或None, 二进制contact块或None)。
+    """
+    result = process_func(task)
+    text, contact = result[0] if with_contacts else (result[0], None)
+    path = None
+    if text:
+        fd, path = tempfile.mkstemp(prefix='run_', suffix='.txt', dir=run_dir)
+        with os.fdopen(fd, 'w') as run_f:
+            run_f.writelines(sort_run_lines(text))
+    return ((path, contact) if with_contacts else path,) + tuple(result[1:])
+
+def merge_runs(runs, out_f, run_dir):
+    """多路归并各有序段并去掉排序前缀写入out_f；段数过多时先分批归并"""
+    while len(runs) > MAX_MERGE_RUNS:
+        merged = []
+        for i in range(0, len(runs), MAX_MERGE_RUNS):
+            fd, path = tempfile.mkstemp(prefix='merge_', suffix='.txt', dir=run_dir)
+            with os.fdopen(fd, 'w') as merge_f:
+                merge_run_group(runs[i:i + MAX_MERGE_RUNS], merge_f.writelines)
+            merged.append(path)
+        runs = merged
+    merge_run_group(runs, lambda lines: out_f.writelines(
+        line.split(SORT_KEY_SEP, 3)[3] for line in lines))
+
+def merge_run_group(runs, write_lines):
+    """归并一组段文件，合并结果交给write_lines，完成后删除这些段"""
+    handles = [open(path) for path in runs]
+    try:
+        write_lines(heapq.merge(*handles))
+    finally:
+        for handle, path in zip(handles, runs):
+            handle.close()
+            os.remove(path)
+
+def write_ordered(pool, process_func, tasks, mnd_file, slots, stop, own_pool, sort_dir=None,
+                  contact_writer=None):
+    """用imap并行处理tasks，结果文本按输入顺序写入mnd_file，每写出一个结果释放一个名额
+
+    结果为 (MND文本, 计数...)，返回各计数之和的列表。sort_dir不为None时输出排序后的MND：
+    工作进程把每个结果排序写为sort_dir下临时目录中的有序段，全部完成后归并写入mnd_file。
+    contact_writer不为None时结果第一项为 (MND文本, 二进制contact块或None)，
+    contact块按输入顺序写入contact_writer（排序输出时也不排序）。
+    """
+    totals = []
+    run_dir = None
+    runs = []
+    if sort_dir is not None:
+        run_dir = tempfile.mkdtemp(prefix='paf2mnd_runs_', dir=sort_dir)
+        process_func = partial(write_sorted_run, process_func, run_dir,
+                               contact_writer is not None)
+    try:
+        # imap保证结果顺序与输入一致
+        with open(mnd_file, 'w') as out_f:
+            for result in pool.imap(process_func, tasks):
+                payload = result[0]
+                if contact_writer is not None:
+                    payload, contact = payload
+                    if contact is not None:
+                        contact_writer.write_chunk(contact)
+                if run_dir is None:
+                    out_f.write(payload)
+                elif payload is not None:
+                    runs.append(payload)
+                counts = result[1:]
+                totals = [a + b for a, b in zip(totals, counts)] if totals else list(counts)
+                slots.release()
+            if run_dir is not None:
+                merge_runs(runs, out_f, run_dir)
+    except BaseException:
+        # 让任务线程退出，避免阻塞在名额上
+        stop.set()
+        slots.release()
+        if own_pool:
+            pool.terminate()
+        raise
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
     
-    # 处理最后一个组
-    if current_group:
-        groups[current_base_id] = current_group
+    if own_pool:
+        pool.close()
+        pool.join()
+    return totals
+
+@contextmanager
+def open_contact_writer(contacts_file, pairing):
+    """contacts_file为None时返回None，否则返回contacts.ContactWriter，退出时关闭"""
+    if contacts_file is None:
+        yield None
+        return
+    with contacts.ContactWriter(contacts_file, pairing.weight) as writer:
+        yield writer
+
+def convert_paf_stream(paf_handle, mnd_file, min_identity, chunk_size, max_workers, pool=None,
+                       chunk_bytes=0, max_inflight=0, pairing=DEFAULT_PAIRING, sort_dir=None,
+                       contacts_file=None):
+    """将PAF文本行流转换为MND文件，返回 (输入行数, MND记录数)
+
+    paf_handle可以是文件句柄，也可以是比对程序stdout等任意按行迭代的对象；
+    pool为None时自行创建进程池。块在read边界处切分，行数达到chunk_size或
+    字节数达到chunk_bytes（不为0时）即提交。同时在途的块最多max_inflight个
+    （0 = 工作进程数的2倍），工作进程返回MND文本和记录数，主线程按输入顺序
+    直接写入输出文件，不产生临时文件。pairing为组合方式（见Pairing）。
+    sort_dir不为None时输出排序后的MND，有序段临时写在该目录下（见write_ordered）；
+    contacts_file不为None时同时输出二进制contact文件（需要numpy，见contacts.py）。
+    """
+    # 使用多进程池
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes=max_workers)
     
-    # 处理分组并写入临时文件
-    temp_file = tempfile.NamedTemporaryFile(mode='w+', delete=False)
-    for group in groups.values():
-        mnd_records = process_read_group(group, min_identity)
-        for record in mnd_records:
-            temp_file.write(record)
-    temp_file.close()
+    # 读取、切块在进程池的任务线程中进行，受在途名额限制
+    counter = {'lines': 0}
+    slots = threading.Semaphore(max_inflight or 2 * max_workers)
+    stop = threading.Event()
+    chunks = inflight.bounded_chunks(
+        read_paf_chunks(paf_handle, chunk_size, chunk_bytes, counter), slots, stop)
+    process_func = partial(process_chunk, min_identity=min_identity, pairing=pairing,
+                           with_contacts=contacts_file is not None)
+    with open_contact_writer(contacts_file, pairing) as contact_writer:
+        totals = write_ordered(pool, process_func, chunks, mnd_file, slots, stop, own_pool,
+                               sort_dir, contact_writer)
+
+    return counter['lines'], totals[0] if totals else 0
+
+# 按字节区间并行读取：每个工作进程自己读取并处理文件的一个区间。
+# 区间边界规则（同一read的记录在PAF中连续）：
+#   区间k处理起点不超过其终点e的行，以及e之后第一条有效行所在的整组（可越过e读完）；
+#   区间k+1跳过起点不超过e的行（即第一行，可能是半行），再跳过下一条有效行所在的整组。
+# 这样每组恰好由其所在区间之一处理，输出按区间顺序写出，结果确定。
+DEFAULT_RANGE_BYTES = 64 * 1024 * 1024
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b"\x1f\x8b"
+
+def bgzf_block_size(header):
+    """从BGZF块头（前12字节+扩展字段）中取出块的压缩字节数，不是BGZF时返回None"""
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        return None
+    extra = header[12:]
+    pos = 0
+    while pos + 4 <= len(extra):
+        sub_id = extra[pos:pos + 2]
+        sub_length = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if sub_id == b"BC" and sub_length == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + sub_length
+    return None
+
+def read_bgzf_header(handle):
+    """读取当前位置的BGZF块头，返回 (块头bytes, 块压缩字节数)，文件结束时返回 (b"", 0)"""
+    header = handle.read(12)
+    if not header:
+        return b"", 0
+    if len(header) == 12:
+        header += handle.read(struct.unpack('<H', header[10:12])[0])
+    block_size = bgzf_block_size(header)
+    if block_size is None:
+        raise ValueError("输入不是BGZF格式（请用bgzip压缩）")
+    return header, block_size
+
+def scan_bgzf(handle, offset, uncompressed):
+    """从压缩偏移offset（对应解压后偏移uncompressed）开始逐块读取块头，
+
+    返回 (之后各块起点的 [(压缩偏移, 解压后偏移), ...], 解压后总字节数)。
+    """
+    blocks = []
+    while True:
+        handle.seek(offset)
+        _, block_size = read_bgzf_header(handle)
+        if not block_size:
+            return blocks, uncompressed
+        handle.seek(offset + block_size - 4)
+        uncompressed += struct.unpack('<I', handle.read(4))[0]
+        offset += block_size
+        blocks.append((offset, uncompressed))
+
+def bgzf_blocks(path):
+    """返回BGZF文件 (各块起点的 [(压缩偏移, 解压后偏移), ...], 解压后总字节数)
+
+    有bgzip -i生成的.gzi索引时直接读取索引，只需扫描最后几个块。
+    """
+    blocks = [(0, 0)]
+    index_path = path + '.gzi'
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            count = struct.unpack('<Q', f.read(8))[0]
+            data = struct.unpack(f'<{2 * count}Q', f.read(16 * count))
+        blocks += list(zip(data[0::2], data[1::2]))
+    with open(path, 'rb') as f:
+        more, total = scan_bgzf(f, *blocks[-1])
+    # 扫描得到的最后一项是文件末尾，不是块起点
+    return blocks + more[:-1], total
+
+def paf_ranges(path, range_bytes, bgzf):
+    """把PAF文件切成字节区间，返回 [(读取起点, 区间长度, 是否第一个区间), ...]
+
+    普通文件的起点、长度都是文件字节；BGZF文件的区间对齐到块，起点为压缩偏移，
+    长度为解压后的字节数。
+    """
+    if not bgzf:
+        size = os.path.getsize(path)
+        return [(start, min(range_bytes, size - start), start == 0)
+                for start in range(0, max(size, 1), range_bytes)]
+
+    blocks, total = bgzf_blocks(path)
+    ranges = []
+    range_start = blocks[0]
+    for compressed, uncompressed in blocks[1:]:
+        if uncompressed - range_start[1] >= range_bytes:
+            ranges.append((range_start[0], uncompressed - range_start[1], not ranges))
+            range_start = (compressed, uncompressed)
+    ranges.append((range_start[0], total - range_start[1], not ranges))
+    return ranges
+
+def plain_pieces(path, start, piece_bytes):
+    """从start开始每次读取piece_bytes字节"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for piece in iter(lambda: f.read(piece_bytes), b""):
+            yield piece
+
+def bgzf_pieces(path, start):
+    """从压缩偏移start开始逐块解压BGZF文件"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while True:
+            header, block_size = read_bgzf_header(f)
+            if not block_size:
+                break
+            block = f.read(block_size - len(header))
+            piece = zlib.decompress(block[:-8], -15)
+            if piece:
+                yield piece
+
+def iter_offset_lines(pieces):
+    """把字节块流拆成行，生成 (行起点相对偏移, 行文本)"""
+    carry = b""
+    offset = 0
+    for piece in pieces:
+        lines = (carry + piece).split(b"\n")
+        carry = lines.pop()
+        for line in lines:
+            yield offset, line.decode()
+            offset += len(line) + 1
+    if carry:
+        yield offset, carry.decode()
+
+def process_range(task, path, bgzf, min_identity, pairing=DEFAULT_PAIRING, with_contacts=False):
+    """在工作进程中读取并处理一个字节区间，返回 (MND文本, MND记录数, 区间内的行数)
+
+    with_contacts见process_chunk。
+    """
+    start, length, first = task
+    if bgzf:
+        pieces = bgzf_pieces(path, start)
+    else:
+        pieces = plain_pieces(path, start, max(64 * 1024, min(length, 4 * 1024 * 1024)))
+    builder = PafChunkBuilder()
+    line_count = 0
+    # 非第一个区间先跳过第一行（半行或起点恰为区间起点的行）及下一条有效行所在的组
+    skip_id = None
+    skipping = not first
+    current_base_id = None
+    boundary_id = None
+    for offset, line in iter_offset_lines(pieces):
+        beyond = offset > length
+        if not beyond and (first or offset > 0):
+            line_count += 1
+        if not first and offset == 0:
+            continue
+        parts = line.split('\t', 12)
+        if len(parts) < 12:
+            continue
+        base_id = parts[0].partition(':')[0]
+
+        if skipping:
+            if skip_id is None:
+                skip_id = base_id
+            if base_id == skip_id:
+                if beyond:
+                    # 跳过的组越过了区间终点，本区间没有需要处理的组
+                    break
+                continue
+            skipping = False
+
+        if beyond:
+            # 区间终点之后：读完终点后第一条有效行所在的组即停止
+            if boundary_id is None:
+                boundary_id = base_id
+            elif base_id != boundary_id:
+                break
+
+        if base_id != current_base_id:
+            builder.start_group(base_id)
+            current_base_id = base_id
+        builder.add(parts)
+
+    if not len(builder):
+        return ("", None) if with_contacts else "", 0, line_count
+    payload, record_count = process_chunk(builder.build(), min_identity, pairing, with_contacts)
+    return payload, record_count, line_count
+
+def convert_paf_ranges(paf_file, mnd_file, min_identity, max_workers, range_bytes=0,
+                       max_inflight=0, pool=None, pairing=DEFAULT_PAIRING, sort_dir=None,
+                       contacts_file=None):
+    """按字节区间并行读取PAF（普通文件或BGZF）并转换为MND，返回 (输入行数, MND记录数)
+
+    每个区间由一个工作进程读取和处理，结果按区间顺序写出；sort_dir、contacts_file
+    见convert_paf_stream。
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes=max_workers)
     
-    return temp_file.name
+    bgzf = is_gzip(paf_file)
+    ranges = paf_ranges(paf_file, range_bytes or DEFAULT_RANGE_BYTES, bgzf)
+    slots = threading.Semaphore(max_inflight or 2 * max_workers)
+    stop = threading.Event()
+    process_func = partial(process_range, path=paf_file, bgzf=bgzf, min_identity=min_identity,
+                           pairing=pairing, with_contacts=contacts_file is not None)
+    with open_contact_writer(contacts_file, pairing) as contact_writer:
+        totals = write_ordered(pool, process_func, inflight.bounded_chunks(ranges, slots, stop),
+                               mnd_file, slots, stop, own_pool, sort_dir, contact_writer)
+    if not totals:
+        return 0, 0
+    return totals[1], totals[0]
+
+def pairing_from_args(args):
+    """由命令行参数构造Pairing并校验"""
+    if args.pairing == 'knn' and args.neighbors < 1:
+        raise ValueError("--neighbors必须至少为1")
+    if args.pairing == 'capped' and args.max_pairs < 1:
+        raise ValueError("--max-pairs必须至少为1")
+    return Pairing(args.pairing, args.neighbors, args.max_pairs, args.weight)
+
+def sort_dir_from_args(args):
+    """--sorted时有序段的临时目录（默认为输出文件所在目录），否则为None"""
+    if not args.sorted:
+        return None
+    return args.sort_tmp or os.path.dirname(os.path.abspath(args.output))
 
 def memory_optimized_paf_processing(args):
     """内存优化的PAF处理流程，利用有序特性确保组完整性"""
@@ -147,67 +803,27 @@ def memory_optimized_paf_processing(args):
     if max_workers <= 0:
         max_workers = max(1, os.cpu_count() // 2)
     
-    # 使用多进程池
-    pool = multiprocessing.Pool(processes=max_workers)
-    
-    # 分块读取和处理PAF文件
-    chunk = []
-    current_base_id = None
-    total_lines = 0
-    processed_lines = 0
-    file_size = os.path.getsize(paf_file)
-    processed_bytes = 0
-    temp_files = []
+    chunk_bytes, max_inflight = 0, 0
+    if args.max_memory is not None:
+        max_workers, chunk_bytes, max_inflight = plan_paf_memory(args.max_memory, max_workers)
+        sys.stderr.write(f"内存预算 {args.max_memory / 1024 ** 2:,.0f} MB: 工作进程 {max_workers}, "
+                         f"每块 {chunk_bytes / 1024 ** 2:,.1f} MB, 最多在途 {max_inflight} 块\n")
     
-    with open(paf_file, 'r') as f:
-        for line in f:
-            total_lines += 1
-            processed_bytes += len(line.encode('utf-8'))
-            
-            # 解析记录
-            parts = line.strip().split('\t')
-            if len(parts) < 12:
-                continue
-                
-            # 提取基础ID
-            base_id = base_id_key(parts)
-            
-            # 当基础ID变化且块大小达到时，处理当前块
-            if current_base_id is not None and base_id != current_base_id and len(chunk) >= chunk_size:
-                # 提交当前块进行处理
-                temp_files.append(pool.apply_async(process_chunk, (chunk.copy(), min_identity, mnd_file)))
-                chunk = []
-            
-            chunk.append(parts)
-            current_base_id = base_id
-            
-        # 处理最后一块
-        if chunk:
-            temp_files.append(pool.apply_async(process_chunk, (chunk.copy(), min_identity, mnd_file)))
-    
-    # 关闭进程池并等待所有任务完成
-    pool.close()
-    sys.stderr.write("\n等待工作进程完成...\n")
-    sys.stderr.flush()
-    pool.join()
-    
-    # 收集处理结果
-    temp_file_names = [result.get() for result in temp_files]
-    
-    # 合并所有临时文件
-    sys.stderr.write("合并临时文件...\n")
-    sys.stderr.flush()
-    with open(mnd_file, 'w') as out_f:
-        for temp_file in temp_file_names:
-            with open(temp_file, 'r') as in_f:
-                shutil.copyfileobj(in_f, out_f)
-            os.unlink(temp_file)
-    
-    # 统计结果
-    total_mnd_records = 0
-    with open(mnd_file, 'r') as f:
-        for line in f:
-            total_mnd_records += 1
+    pairing = pairing_from_args(args)
+    sort_dir = sort_dir_from_args(args)
+    if args.read_ranges:
+        # 工作进程各自读取一个字节区间
+        total_lines, total_mnd_records = convert_paf_ranges(
+            paf_file, mnd_file, min_identity, max_workers,
+            range_bytes=args.range_bytes or chunk_bytes, max_inflight=max_inflight,
+            pairing=pairing, sort_dir=sort_dir, contacts_file=args.contacts)
+    else:
+        opener = gzip.open if is_gzip(paf_file) else open
+        with opener(paf_file, 'rt') as f:
+            total_lines, total_mnd_records = convert_paf_stream(
+                f, mnd_file, min_identity, chunk_size, max_workers,
+                chunk_bytes=chunk_bytes, max_inflight=max_inflight, pairing=pairing,
+                sort_dir=sort_dir, contacts_file=args.contacts)
     
     end_time = time.time()
     
@@ -237,6 +853,34 @@ def main():
                         help='每个处理块的行数')
     parser.add_argument('-w', '--max-workers', type=int, default=0,
                         help='最大工作进程数 (0=自动检测)')
+    parser.add_argument('--max-memory', type=memory_size.parse_memory_size, default=None,
+                        help='内存预算，如 8G、512M（不带单位按MB计）；按字节切块并限制在途块数，'
+                             '必要时减少工作进程数（-c仍作为每块行数上限）')
+    parser.add_argument('--pairing', choices=PAIRING_MODES, default='all',
+                        help='每条read的片段组合方式：all=所有两两组合，adjacent=read上相邻片段，'
+                             'knn=每个片段与其后--neighbors个片段，capped=所有组合但每条read最多'
+                             '--max-pairs个（按read ID确定性抽样）')
+    parser.add_argument('--neighbors', type=int, default=2,
+                        help='knn模式下每个片段向后组合的片段数')
+    parser.add_argument('--max-pairs', type=int, default=100,
+                        help='capped模式下每条read最多输出的组合数')
+    parser.add_argument('--weight', action='store_true',
+                        help='MND增加第17列权重（该read全部组合数/输出组合数），'
+                             '权重之和等于all模式的记录数')
+    parser.add_argument('--read-ranges', action='store_true',
+                        help='按字节区间由工作进程并行读取PAF（普通文件或bgzip压缩的文件，'
+                             '不适用于管道），每个区间为一块，不受-c限制')
+    parser.add_argument('--range-bytes', type=int, default=0,
+                        help='--read-ranges时每个区间的字节数（BGZF为解压后字节数；'
+                             '0=按--max-memory推算或64MB）')
+    parser.add_argument('--sorted', action='store_true',
+                        help='输出按 LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n '
+                             '排序的MND（dups.awk所需顺序）：各块排序为有序段后归并，无需单独排序')
+    parser.add_argument('--sort-tmp', default=None,
+                        help='--sorted时有序段的临时目录（默认为输出文件所在目录）')
+    parser.add_argument('--contacts', default=None,
+                        help='同时输出列式二进制contact文件（contig编号、int32位置、方向位、mapq字节，'
+                             '分块压缩；需要numpy），可用contacts.py导出为MND')
     
     # 解析参数
     args = parser.parse_args()
@@ -250,6 +894,10 @@ def main():
         sys.stderr.write("错误: 最小比对质量必须在0.0和1.0之间\n")
         sys.exit(1)
         
+    if args.contacts and np is None:
+        sys.stderr.write("错误: --contacts需要numpy\n")
+        sys.exit(1)
+        
     if args.chunk_size < 1000:
         sys.stderr.write("警告: 块大小过小可能导致效率低下，建议至少1000行\n")
     
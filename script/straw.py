@@ -28,244 +28,14 @@ __author__ = "Yue Wu and Neva Durand"
 __license__ = "MIT"
 
 import sys
+import mmap
 import struct
+import threading
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import io
-
-blockMap = dict()
-# global version
-version=0
-
-def __readcstr(f):
-    """ Helper function for reading in C-style string from file
-    """
-    buf = b""
-    while True:
-        b = f.read(1)
-        if b is None or b == b"\0":
-            return buf.decode("utf-8")
-        elif b == "":
-            raise EOFError("Buffer unexpectedly empty while trying to read null-terminated string")
-        else:
-            buf += b
-
-def readHeader(req, chr1, chr2, posilist):
-    """ Reads the header
-
-    Args:
-       req (file): File to read from
-       chr1 (str): Chromosome 1
-       chr2 (str): Chromosome 2
-       c1pos1 (int, optional): Starting range of chromosome1 output
-       c1pos2 (int, optional): Stopping range of chromosome1 output
-       c2pos1 (int, optional): Starting range of chromosome2 output
-       c2pos2 (int, optional): Stopping range of chromosome2 output
-
-    Returns:
-       list: master index, chromosome1 index, chromosome2 index
-    """
-    magic_string = struct.unpack('<3s', req.read(3))[0]
-    req.read(1)
-    if (magic_string != b"HIC"):
-        print('This does not appear to be a HiC file magic string is incorrect')
-        return -1
-    global version
-    version = struct.unpack('<i',req.read(4))[0]
-    if (version < 6):
-        print("Version {0} no longer supported".format(str(version)))
-        return -1
-    print('HiC version:' + '  {0}'.format(str(version)))
-    master = struct.unpack('<q',req.read(8))[0]
-    genome = b""
-    c=req.read(1)
-    while (c != b'\0'):
-        genome += c
-        c=req.read(1)
-
-    # read and throw away attribute dictionary (stats+graphs)
-    nattributes = struct.unpack('<i',req.read(4))[0]
-    for x in range(nattributes):
-        key = __readcstr(req)
-        value = __readcstr(req)
-    nChrs = struct.unpack('<i',req.read(4))[0]
-    found1 = False
-    found2 = False
-    for i in range(0, nChrs):
-      name = __readcstr(req)
-      length = struct.unpack('<i',req.read(4))[0]
-      if (name==chr1):
-          found1=True
-          chr1ind=i
-          if (posilist[0]==-100):
-              posilist[0]=0
-              posilist[1]=length
-      if (name==chr2):
-          found2=True
-          chr2ind=i
-          if (posilist[2]==-100):
-              posilist[2]=0
-              posilist[3]=length
-    if ((not found1) or (not found2)):
-      print("One of the chromosomes wasn't found in the file. Check that the chromosome name matches the genome.\n")
-      return -1
-    return [master, chr1ind, chr2ind, posilist[0], posilist[1], posilist[2], posilist[3]]
-
-def readFooter(req, c1, c2, norm, unit, resolution):
-    """Reads the footer, which contains all the expected and normalization
-    vectors. Presumes file pointer is in correct position
-    Args:
-       req (file): File to read from; presumes file pointer is in correct
-       position
-       chr1 (str): Chromosome 1
-       chr2 (str): Chromosome 2
-       norm (str): Normalization type, one of NONE, VC, KR, VC_SQRT
-       unit (str): One of BP or FRAG
-       resolution (int): Bin size
-
-    Returns:
-       list: File position of matrix, position+size chr1 normalization vector,
-             position+size chr2 normalization vector
-    """
-    c1NormEntry=dict()
-    c2NormEntry=dict()
-    nBytes = struct.unpack('<i', req.read(4))[0]
-    key = str(c1) + "_" + str(c2)
-    nEntries = struct.unpack('<i', req.read(4))[0]
-    found = False
-    for i in range(nEntries):
-        stri = __readcstr(req)
-        fpos = struct.unpack('<q', req.read(8))[0]
-        sizeinbytes = struct.unpack('<i', req.read(4))[0]
-        if (stri==key):
-            myFilePos = fpos
-            found=True
-    if (not found):
-        print("File doesn't have the given chr_chr map\n")
-    if (norm=="NONE"):
-        return [myFilePos, 0, 0]
-    nExpectedValues = struct.unpack('<i',req.read(4))[0]
-    for i in range(nExpectedValues):
-        str_ = __readcstr(req)
-        binSize = struct.unpack('<i',req.read(4))[0]
-        nValues = struct.unpack('<i',req.read(4))[0]
-        for j in range(nValues):
-            v = struct.unpack('<d',req.read(8))[0]
-        nNormalizationFactors = struct.unpack('<i',req.read(4))[0]
-        for j in range(nNormalizationFactors):
-            chrIdx = struct.unpack('<i',req.read(4))[0]
-            v = struct.unpack('<d',req.read(8))[0]
-    nExpectedValues = struct.unpack('<i',req.read(4))[0]
-    for i in range(nExpectedValues):
-        str_ = __readcstr(req)
-        str_ = __readcstr(req)
-        binSize = struct.unpack('<i',req.read(4))[0]
-        nValues = struct.unpack('<i',req.read(4))[0]
-        for j in range(nValues):
-            v = struct.unpack('<d',req.read(8))[0]
-        nNormalizationFactors = struct.unpack('<i',req.read(4))[0]
-        for j in range(nNormalizationFactors):
-            chrIdx = struct.unpack('<i',req.read(4))[0]
-            v = struct.unpack('<d',req.read(8))[0]
-    nEntries = struct.unpack('<i',req.read(4))[0]
-    found1=False
-    found2=False
-    for i in range(nEntries):
-        normtype = __readcstr(req)
-        chrIdx = struct.unpack('<i',req.read(4))[0]
-        unit1 = __readcstr(req)
-        resolution1 = struct.unpack('<i',req.read(4))[0]
-        filePosition = struct.unpack('<q',req.read(8))[0]
-        sizeInBytes = struct.unpack('<i',req.read(4))[0]
-        if (chrIdx==c1 and normtype==norm and unit1==unit and resolution1==resolution):
-            c1NormEntry['position']=filePosition
-            c1NormEntry['size']=sizeInBytes
-            found1=True
-        if (chrIdx==c2 and normtype==norm and unit1==unit and resolution1==resolution):
-            c2NormEntry['position']=filePosition
-            c2NormEntry['size']=sizeInBytes
-            found2=True
-    if ((not found1) or (not found2)):
-        print("File did not contain {0} normalization vectors for one or both chromosomes at {1} {2}\n".format(norm, resolution, unit))
-        return -1
-    return [myFilePos, c1NormEntry, c2NormEntry]
-
-
-def readMatrixZoomData(req, myunit, mybinsize):
-    """ Reads the Matrix Zoom Data, which gives pointer list for blocks for
-    the data. Presumes file pointer is in correct position
-
-    Args:
-       req (file): File to read from; presumes file pointer is in correct
-       position
-       myunit (str): Unit (BP or FRAG) we're searching for
-       mybinsize (int): Resolution we're searching for
-
-    Returns:
-       list containing boolean indicating if we found appropriate matrix,
-       and if so, the counts for the bins and columns
-    """
-    unit = __readcstr(req)
-    temp = struct.unpack('<i',req.read(4))[0]
-    temp2 = struct.unpack('<f',req.read(4))[0]
-    temp2 = struct.unpack('<f',req.read(4))[0]
-    temp2 = struct.unpack('<f',req.read(4))[0]
-    temp2 = struct.unpack('<f',req.read(4))[0]
-    binSize = struct.unpack('<i',req.read(4))[0]
-    blockBinCount = struct.unpack('<i',req.read(4))[0]
-    blockColumnCount = struct.unpack('<i',req.read(4))[0]
-    storeBlockData = False
-    #for the initial
-    myBlockBinCount = -1
-    myBlockColumnCount = -1
-    if (myunit==unit and mybinsize==binSize):
-        myBlockBinCount=blockBinCount
-        myBlockColumnCount=blockColumnCount
-        storeBlockData=True
-    nBlocks = struct.unpack('<i',req.read(4))[0]
-    for b in range(nBlocks):
-        blockNumber = struct.unpack('<i',req.read(4))[0]
-        filePosition = struct.unpack('<q',req.read(8))[0]
-        blockSizeInBytes = struct.unpack('<i',req.read(4))[0]
-        entry=dict()
-        entry['size'] = blockSizeInBytes
-        entry['position'] = filePosition
-        if (storeBlockData):
-            blockMap[blockNumber] = entry
-    return [storeBlockData, myBlockBinCount, myBlockColumnCount]
-
-def readMatrix(req, unit, binsize):
-    """ Reads the matrix - that is, finds the appropriate pointers to block
-    data and stores them. Needs to read through headers of zoom data to find
-    appropriate matrix. Presumes file pointer is in correct position.
-
-    Args:
-       req (file): File to read from; presumes file pointer is in correct
-       position
-       unit (str): Unit to search for (BP or FRAG)
-       binsize (int): Resolution to search for
-
-    Returns:
-       list containing block bin count and block column count of matrix
-    """
-    c1 = struct.unpack('<i',req.read(4))[0]
-    c2 = struct.unpack('<i',req.read(4))[0]
-    nRes = struct.unpack('<i',req.read(4))[0]
-    i = 0
-    found = False
-    blockBinCount = -1
-    blockColumnCount = -1
-    while (i<nRes and (not found)):
-        list1 = readMatrixZoomData(req, unit, binsize)
-        found = list1[0]
-        if(list1[1]!=-1 and list1[2]!=-1):
-            blockBinCount = list1[1]
-            blockColumnCount = list1[2]
-        i=i+1
-    if (not found):
-        print("Error finding block data\n")
-        return -1
-    return [blockBinCount, blockColumnCount]
+from collections import OrderedDict
+import numpy as np
 
 def getBlockNumbersForRegionFromBinPosition(regionIndices, blockBinCount, blockColumnCount, intra):
     """ Gets the block numbers we will need for a specific region; used when
@@ -298,123 +68,495 @@ def getBlockNumbersForRegionFromBinPosition(regionIndices, blockBinCount, blockC
     # print(str(blocksSet))
     return blocksSet
 
-def readBlock(req, size):
-    """ Reads the block - reads the compressed bytes, decompresses, and stores
-    results in array. Presumes file pointer is in correct position.
+# Record layouts of the decompressed block data
+# pre-v7 blocks: binX, binY, counts for every record
+LEGACY_RECORD = np.dtype([('binX', '<i4'), ('binY', '<i4'), ('counts', '<f4')])
+# v7+ sparse rows: column offset and count, counts are shorts if useShort==0
+SHORT_CELL = np.dtype([('x', '<i2'), ('counts', '<i2')])
+FLOAT_CELL = np.dtype([('x', '<i2'), ('counts', '<f4')])
+# v7+ dense blocks mark empty cells with this short value (or NaN for floats)
+DENSE_SHORT_EMPTY = -32768
+
+def decodeCompressedBlock(compressedBytes, version):
+    """ Decompresses and decodes a block, see decodeBlock """
+    return decodeBlock(zlib.decompress(compressedBytes), version)
+
+def decodeBlock(uncompressedBytes, version):
+    """ Decodes the records of a decompressed block with numpy
 
     Args:
-       req (file): File to read from. Presumes file pointer is in correct
-       position
-       size (int): How many bytes to read
+       uncompressedBytes (bytes): Decompressed block data
+       version (int): Version of the .hic file
 
     Returns:
-       array containing row, column, count data for this block
+       tuple of arrays (binX, binY, counts) for this block
     """
-    compressedBytes = req.read(size)
-    uncompressedBytes = zlib.decompress(compressedBytes)
     nRecords = struct.unpack('<i',uncompressedBytes[0:4])[0]
-    v=[]
-    global version
     if (version < 7):
-        for i in range(nRecords):
-            binX = struct.unpack('<i',uncompressedBytes[(12*i+4):(12*i+8)])[0]
-            binY = struct.unpack('<i',uncompressedBytes[(12*i+8):(12*i+12)])[0]
-            counts = struct.unpack('<f',uncompressedBytes[(12*i+12):(12*i+16)])[0]
-            record = dict()
-            record['binX'] = binX
-            record['binY'] = binY
-            record['counts'] = counts
-            v.append(record)
-    else:
-        binXOffset = struct.unpack('<i',uncompressedBytes[4:8])[0]
-        binYOffset = struct.unpack('<i',uncompressedBytes[8:12])[0]
-        useShort = struct.unpack('<b',uncompressedBytes[12:13])[0]
-        type_ = struct.unpack('<b',uncompressedBytes[13:14])[0]
-        index=0
-        if (type_==1):
-            rowCount = struct.unpack('<h',uncompressedBytes[14:16])[0]
-            temp = 16
-            for i in range(rowCount):
-                y = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-                temp=temp+2
-                binY = y + binYOffset
-                colCount = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-                temp=temp+2
-                for j in range(colCount):
-                    x = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-                    temp=temp+2
-                    binX = binXOffset + x
-                    if (useShort==0):
-                        c = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-                        temp=temp+2
-                        counts = c
-                    else:
-                        counts = struct.unpack('<f',uncompressedBytes[temp:(temp+4)])[0]
-                        temp=temp+4
-                    record = dict()
-                    record['binX'] = binX
-                    record['binY'] = binY
-                    record['counts'] = counts
-                    v.append(record)
-                    index = index + 1
-        elif (type_== 2):
-            temp=14
-            nPts = struct.unpack('<i',uncompressedBytes[temp:(temp+4)])[0]
-            temp=temp+4
-            w = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-            temp=temp+2
-            for i in range(nPts):
-                row=int(i/w)
-                col=i-row*w
-                bin1=int(binXOffset+col)
-                bin2=int(binYOffset+row)
-                if (useShort==0):
-                    c = struct.unpack('<h',uncompressedBytes[temp:(temp+2)])[0]
-                    temp=temp+2
-                    if (c != -32768):
-                        record = dict()
-                        record['binX'] = bin1
-                        record['binY'] = bin2
-                        record['counts'] = c
-                        v.append(record)
-                        index = index + 1
-                else:
-                    counts = struct.unpack('<f',uncompressedBytes[temp:(temp+4)])[0]
-                    temp=temp+4
- #                   if (countsnot != 0x7fc00000):
-                    if (counts != 0x7fc00000):
-                        record = dict()
-                        record['binX'] = bin1
-                        record['binY'] = bin2
-                        record['counts'] = counts
-                        v.append(record)
-                        index = index + 1
-    return v
-
-def readNormalizationVector(req):
-    """ Reads the normalization vector from the file; presumes file pointer is
-    in correct position
+        records = np.frombuffer(uncompressedBytes, dtype=LEGACY_RECORD, count=nRecords, offset=4)
+        return records['binX'], records['binY'], records['counts']
+    binXOffset, binYOffset, useShort, type_ = struct.unpack('<iibb', uncompressedBytes[4:14])
+    cell = SHORT_CELL if useShort == 0 else FLOAT_CELL
+    if (type_==1):
+        # rows have variable length: walk the row headers, decode each row at once
+        rowCount = struct.unpack('<h',uncompressedBytes[14:16])[0]
+        temp = 16
+        rows = []
+        rowBins = []
+        for i in range(rowCount):
+            y, colCount = struct.unpack('<hh', uncompressedBytes[temp:(temp+4)])
+            temp = temp + 4
+            rows.append(np.frombuffer(uncompressedBytes, dtype=cell, count=colCount, offset=temp))
+            rowBins.append(np.full(colCount, y + binYOffset, dtype=np.int32))
+            temp = temp + colCount * cell.itemsize
+        if not rows:
+            return np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, cell['counts'])
+        cells = np.concatenate(rows)
+        return cells['x'].astype(np.int32) + binXOffset, np.concatenate(rowBins), cells['counts']
+    elif (type_== 2):
+        nPts, w = struct.unpack('<ih', uncompressedBytes[14:20])
+        counts = np.frombuffer(uncompressedBytes, dtype=cell['counts'], count=nPts, offset=20)
+        if (useShort==0):
+            keep = counts != DENSE_SHORT_EMPTY
+        else:
+            keep = ~np.isnan(counts)
+        index = np.flatnonzero(keep)
+        row = index // w
+        col = index - row * w
+        return ((binXOffset + col).astype(np.int32), (binYOffset + row).astype(np.int32),
+                counts[keep])
+    return np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.float32)
+
+# Default byte limit of the decompressed block cache of a HicFile
+DEFAULT_BLOCK_CACHE_BYTES = 256 * 1024 * 1024
+# Largest single read when adjacent blocks are fetched together
+MAX_MERGED_READ_BYTES = 16 * 1024 * 1024
+NORMS = ("NONE", "VC", "VC_SQRT", "KR")
+UNITS = ("BP", "FRAG")
+USAGE = "Usage: straw <NONE/VC/VC_SQRT/KR> <hicFile(s)> <chr1>[:x1:x2] <chr2>[:y1:y2] <BP/FRAG> <binsize>\n"
+# Block index entries of the matrix zoom data: block number, position, size
+BLOCK_INDEX_ENTRY = np.dtype([('blockNumber', '<i4'), ('position', '<i8'), ('size', '<i4')])
+
+def readCStringAt(buf, offset):
+    """ Reads a C-style string from a buffer
 
     Args:
-       req (file): File to read from; presumes file pointer is in correct
-       position
+       buf (bytes or mmap): Buffer to read from
+       offset (int): Position of the string in buf
 
     Returns:
-      Array of normalization values
+       tuple: the string and the offset just past its terminating null
+    """
+    end = buf.find(b"\0", offset)
+    if end < 0:
+        raise EOFError("Buffer unexpectedly empty while trying to read null-terminated string")
+    return buf[offset:end].decode("utf-8"), end + 1
+
+def readHeaderData(buf):
+    """ Reads the whole header
 
+    Args:
+       buf (bytes or mmap): Buffer starting at the start of the file
+
+    Returns:
+       tuple: version, master index position, genome id, attribute dict,
+       list of (chromosome name, length)
     """
-    value = []
-    nValues = struct.unpack('<i',req.read(4))[0]
-    for i in range(nValues):
-        d = struct.unpack('<d',req.read(8))[0]
-        value.append(d)
-    return value
-
-def straw(norm, infile, chr1loc, chr2loc, unit, binsize):
+    magic_string, version = struct.unpack_from('<3sxi', buf, 0)
+    if (magic_string != b"HIC"):
+        raise ValueError('This does not appear to be a HiC file magic string is incorrect')
+    if (version < 6):
+        raise ValueError("Version {0} no longer supported".format(str(version)))
+    master = struct.unpack_from('<q', buf, 8)[0]
+    genome, offset = readCStringAt(buf, 16)
+    attributes = dict()
+    nattributes = struct.unpack_from('<i', buf, offset)[0]
+    offset += 4
+    for x in range(nattributes):
+        key, offset = readCStringAt(buf, offset)
+        attributes[key], offset = readCStringAt(buf, offset)
+    chromosomes = []
+    nChrs = struct.unpack_from('<i', buf, offset)[0]
+    offset += 4
+    for i in range(0, nChrs):
+        name, offset = readCStringAt(buf, offset)
+        length = struct.unpack_from('<i', buf, offset)[0]
+        offset += 4
+        chromosomes.append((name, length))
+    return version, master, genome, attributes, chromosomes
+
+def readFooterData(buf, offset):
+    """ Reads the whole footer: the master index and the normalization vector
+    index. Expected value vectors are skipped
+
+    Args:
+       buf (bytes or mmap): Buffer holding the footer
+       offset (int): Position of the master index in buf
+
+    Returns:
+       tuple: dict of "c1_c2" -> (position, size) of the matrices, dict of
+       (norm, chromosome index, unit, resolution) -> (position, size) of the
+       normalization vectors
+    """
+    masterIndex = dict()
+    normIndex = dict()
+    nBytes, nEntries = struct.unpack_from('<ii', buf, offset)
+    offset += 8
+    for i in range(nEntries):
+        key, offset = readCStringAt(buf, offset)
+        masterIndex[key] = struct.unpack_from('<qi', buf, offset)
+        offset += 12
+    # expected values, then normalized expected values (with the norm type first)
+    for normalized in (False, True):
+        nExpectedValues = struct.unpack_from('<i', buf, offset)[0]
+        offset += 4
+        for i in range(nExpectedValues):
+            if normalized:
+                normtype, offset = readCStringAt(buf, offset)
+            unit, offset = readCStringAt(buf, offset)
+            binSize, nValues = struct.unpack_from('<ii', buf, offset)
+            offset += 8 + 8 * nValues
+            nNormalizationFactors = struct.unpack_from('<i', buf, offset)[0]
+            offset += 4 + 12 * nNormalizationFactors
+    # files without normalization end after the expected values
+    nEntries = 0
+    if len(buf) >= offset + 4:
+        nEntries = struct.unpack_from('<i', buf, offset)[0]
+        offset += 4
+    for i in range(nEntries):
+        normtype, offset = readCStringAt(buf, offset)
+        chrIdx = struct.unpack_from('<i', buf, offset)[0]
+        unit, offset = readCStringAt(buf, offset + 4)
+        resolution, filePosition, sizeInBytes = struct.unpack_from('<iqi', buf, offset)
+        offset += 16
+        normIndex[(normtype, chrIdx, unit, resolution)] = (filePosition, sizeInBytes)
+    return masterIndex, normIndex
+
+def readMatrixIndex(buf, offset):
+    """ Reads the block index of every zoom level of a matrix
+
+    Args:
+       buf (bytes or mmap): Buffer holding the matrix
+       offset (int): Position of the matrix in buf
+
+    Returns:
+       dict of (unit, bin size) -> (block bin count, block column count,
+       dict of block number -> (position, size))
+    """
+    zooms = dict()
+    c1, c2, nRes = struct.unpack_from('<iii', buf, offset)
+    offset += 12
+    for i in range(nRes):
+        unit, offset = readCStringAt(buf, offset)
+        # zoom index and four float statistics
+        offset += 20
+        binSize, blockBinCount, blockColumnCount, nBlocks = struct.unpack_from('<iiii', buf, offset)
+        offset += 16
+        entries = np.frombuffer(buf, dtype=BLOCK_INDEX_ENTRY, count=nBlocks, offset=offset)
+        offset += nBlocks * BLOCK_INDEX_ENTRY.itemsize
+        blocks = dict(zip(entries['blockNumber'].tolist(),
+                          zip(entries['position'].tolist(), entries['size'].tolist())))
+        del entries
+        # keep the first zoom level of each unit and bin size
+        zooms.setdefault((unit, binSize), (blockBinCount, blockColumnCount, blocks))
+    return zooms
+
+def readNormalizationVectorAt(buf, offset):
+    """ Reads a normalization vector from a buffer
+
+    Args:
+       buf (bytes or mmap): Buffer holding the vector
+       offset (int): Position of the vector in buf
+
+    Returns:
+      numpy array of normalization values (a copy, not a view of buf)
+    """
+    nValues = struct.unpack_from('<i', buf, offset)[0]
+    return np.frombuffer(buf, dtype='<f8', count=nValues, offset=offset + 4).copy()
+
+def parseLocation(loc):
+    """ Splits "chr" or "chr:start:end" into the name and optional range """
+    parts = loc.split(":")
+    if (len(parts)==3):
+        return parts[0], int(parts[1]), int(parts[2])
+    return parts[0], None, None
+
+class HicFile(object):
+    """ A .hic file (local path or URL) opened once for many queries
+
+    Header and footer metadata are parsed when the file is opened. The block
+    index of each matrix, the normalization vectors and up to
+    blockCacheBytes of decoded blocks (least recently used are evicted) are
+    cached. The object can be shared between threads.
+
+    Local files are memory-mapped: metadata is unpacked straight from the
+    mapping and block payloads are decompressed from it without copies.
+
+    With threads > 1 the blocks of a query are read in file offset order,
+    adjacent blocks with one read, and decompressed and decoded on a pool
+    of that many threads (zlib releases the GIL). Results are identical to
+    threads=1.
+
+    Example:
+    >>>import straw
+    >>>with straw.HicFile('HIC001.hic') as hic:
+    ...   x, y, counts = hic.straw('KR', 'X', 'X', 'BP', 1000000)
+    ...   x, y, counts = hic.straw('KR', 'X:0:5000000', 'Y', 'BP', 25000)
+    """
+
+    def __init__(self, infile, blockCacheBytes=DEFAULT_BLOCK_CACHE_BYTES, threads=1):
+        self.infile = infile
+        self.blockCacheBytes = blockCacheBytes
+        self.threads = threads
+        self.pool = None
+        self.lock = threading.RLock()
+        self.matrixCache = dict()
+        self.normCache = dict()
+        self.blockCache = OrderedDict()
+        self.blockCacheSize = 0
+        self.session = None
+        self.mapping = None
+        if (infile.startswith("http")):
+            self.session = requests.Session()
+            # 100K should be sufficient for header
+            r = self.session.get(infile, headers={'range' : 'bytes=0-100000',
+                                                  'x-amz-meta-requester' : 'straw'})
+            if (r.status_code >=400):
+                raise ValueError("Error accessing {0}\nHTTP status code {1}".format(
+                    infile, r.status_code))
+            self.totalBytes = int(r.headers['content-range'].split('/')[1])
+            header = r.content
+        else:
+            with open(infile, 'rb') as f:
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mapping)
+            self.totalBytes = len(self.mapping)
+            header = self.mapping
+        try:
+            (self.version, self.master, self.genome, self.attributes,
+             self.chromosomes) = readHeaderData(header)
+            self.chromosomeIndex = dict()
+            for i, (name, length) in enumerate(self.chromosomes):
+                self.chromosomeIndex[name] = i
+            self.masterIndex, self.normIndex = readFooterData(
+                *self.buffer(self.master, self.totalBytes - self.master))
+        except BaseException:
+            self.close()
+            raise
+
+    def readBytes(self, position, size):
+        """ size bytes at position; a view of the mapping for local files """
+        if self.mapping is not None:
+            return self.view[position:position + size]
+        if self.session is None:
+            raise ValueError("I/O operation on closed HicFile")
+        with self.lock:
+            endrange = 'bytes={0}-{1}'.format(position, position + size)
+            r = self.session.get(self.infile, headers={'range' : endrange,
+                                                       'x-amz-meta-requester' : 'straw'})
+            return r.content[:size]
+
+    def buffer(self, position, size):
+        """ Buffer and offset for unpacking size bytes at position """
+        if self.mapping is not None:
+            return self.mapping, position
+        return self.readBytes(position, size), 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.mapping is not None:
+            try:
+                self.view.release()
+                self.mapping.close()
+            except BufferError:
+                # slices of the mapping are still alive (kept by a caller or by
+                # the traceback of an exception being raised); the mapping is
+                # unmapped when the last of them is freed
+                pass
+            self.view = self.mapping = None
+        if self.session is not None:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def getMatrixZoom(self, c1, c2, unit, binsize):
+        """ Block bin count, block column count and block map of a matrix
+        zoom level, read once per chromosome pair
+
+        Raises:
+           ValueError if the file has no such matrix or zoom level
+        """
+        key = str(c1) + "_" + str(c2)
+        with self.lock:
+            zooms = self.matrixCache.get(key)
+        if zooms is None:
+            if key not in self.masterIndex:
+                raise ValueError("File doesn't have the given chr_chr map\n")
+            zooms = readMatrixIndex(*self.buffer(*self.masterIndex[key]))
+            with self.lock:
+                self.matrixCache[key] = zooms
+        if (unit, binsize) not in zooms:
+            raise ValueError("Error finding block data\n")
+        return zooms[(unit, binsize)]
+
+    def getNormVector(self, norm, chrIdx, unit, binsize):
+        """ Normalization vector of a chromosome, read once
+
+        Raises:
+           ValueError if the file has no such vector
+        """
+        key = (norm, chrIdx, unit, binsize)
+        with self.lock:
+            vector = self.normCache.get(key)
+        if vector is None:
+            if key not in self.normIndex:
+                raise ValueError("File did not contain {0} normalization vectors for one or both "
+                                 "chromosomes at {1} {2}\n".format(norm, binsize, unit))
+            vector = readNormalizationVectorAt(*self.buffer(*self.normIndex[key]))
+            with self.lock:
+                self.normCache[key] = vector
+        return vector
+
+    def getBlock(self, position, size):
+        """ Decoded records (binX, binY, counts) of the block at position,
+        from the LRU cache when possible
+        """
+        with self.lock:
+            records = self.blockCache.get(position)
+            if records is not None:
+                self.blockCache.move_to_end(position)
+                return records
+        # decompress and decode without holding the lock
+        records = decodeCompressedBlock(self.readBytes(position, size), self.version)
+        self.cacheBlock(position, records)
+        return records
+
+    def cacheBlock(self, position, records):
+        nbytes = sum(a.nbytes for a in records)
+        if nbytes <= self.blockCacheBytes:
+            with self.lock:
+                if position not in self.blockCache:
+                    self.blockCache[position] = records
+                    self.blockCacheSize += nbytes
+                while self.blockCacheSize > self.blockCacheBytes:
+                    evicted = self.blockCache.popitem(last=False)[1]
+                    self.blockCacheSize -= sum(a.nbytes for a in evicted)
+
+    def getBlocks(self, entries):
+        """ Decoded records of several blocks, in the order of entries
+
+        Blocks missing from the cache are read in file offset order, runs of
+        adjacent blocks (up to MAX_MERGED_READ_BYTES) with a single read, and
+        decompressed and decoded on the thread pool.
+
+        Args:
+           entries (list): (position, size) of each block
+        """
+        found = dict()
+        with self.lock:
+            for position, size in entries:
+                records = self.blockCache.get(position)
+                if records is not None:
+                    self.blockCache.move_to_end(position)
+                    found[position] = records
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        missing = sorted(set(entry for entry in entries if entry[0] not in found))
+        runs = []
+        for position, size in missing:
+            if runs:
+                start, end, members = runs[-1]
+                if position == end and end + size - start <= MAX_MERGED_READ_BYTES:
+                    runs[-1] = (start, end + size, members + [(position, size)])
+                    continue
+            runs.append((position, position + size, [(position, size)]))
+        futures = []
+        for start, end, members in runs:
+            data = memoryview(self.readBytes(start, end - start))
+            for position, size in members:
+                offset = position - start
+                futures.append((position, self.pool.submit(
+                    decodeCompressedBlock, data[offset:offset + size], self.version)))
+        for position, future in futures:
+            records = future.result()
+            self.cacheBlock(position, records)
+            found[position] = records
+        return [found[position] for position, size in entries]
+
+    def straw(self, norm, chr1loc, chr2loc, unit, binsize):
+        """ Extracts the given contact matrix, see straw()
+
+        Raises:
+           ValueError for invalid arguments or data missing from the file
+        """
+        if norm not in NORMS:
+            raise ValueError("Norm specified incorrectly, must be one of <NONE/VC/VC_SQRT/KR>\n" + USAGE)
+        if unit not in UNITS:
+            raise ValueError("Unit specified incorrectly, must be one of <BP/FRAG>\n" + USAGE)
+        chr1, c1pos1, c1pos2 = parseLocation(chr1loc)
+        chr2, c2pos1, c2pos2 = parseLocation(chr2loc)
+        if chr1 not in self.chromosomeIndex or chr2 not in self.chromosomeIndex:
+            raise ValueError("One of the chromosomes wasn't found in the file. Check that the "
+                             "chromosome name matches the genome.\n")
+        chr1ind = self.chromosomeIndex[chr1]
+        chr2ind = self.chromosomeIndex[chr2]
+        if c1pos1 is None:
+            c1pos1, c1pos2 = 0, self.chromosomes[chr1ind][1]
+        if c2pos1 is None:
+            c2pos1, c2pos2 = 0, self.chromosomes[chr2ind][1]
+        c1=min(chr1ind,chr2ind)
+        c2=max(chr1ind,chr2ind)
+        if (chr1ind > chr2ind):
+            origRegionIndices = [c2pos1, c2pos2, c1pos1, c1pos2]
+        else:
+            origRegionIndices = [c1pos1, c1pos2, c2pos1, c2pos2]
+        regionIndices = [int(pos/binsize) for pos in origRegionIndices]
+
+        blockBinCount, blockColumnCount, blocks = self.getMatrixZoom(c1, c2, unit, binsize)
+        c1Norm = c2Norm = None
+        if (norm != "NONE"):
+            c1Norm = self.getNormVector(norm, c1, unit, binsize)
+            c2Norm = self.getNormVector(norm, c2, unit, binsize)
+
+        blockNumbers = getBlockNumbersForRegionFromBinPosition(regionIndices, blockBinCount, blockColumnCount, c1==c2)
+        binXs=[]
+        binYs=[]
+        blockCounts=[]
+        entries = []
+        for i_set in (blockNumbers):
+            position, size = blocks.get(i_set, (0, 0))
+            if (size==0):
+                continue
+            entries.append((position, size))
+        if self.threads > 1:
+            records = self.getBlocks(entries)
+        else:
+            records = [self.getBlock(position, size) for position, size in entries]
+        for binX, binY, c in records:
+            binXs.append(binX)
+            binYs.append(binY)
+            blockCounts.append(c)
+        return filterRecords(binXs, binYs, blockCounts, binsize, origRegionIndices, c1==c2,
+                             c1Norm, c2Norm)
+
+def straw(norm, infile, chr1loc, chr2loc, unit, binsize, threads=1):
     """ This is the main workhorse method of the module. Reads a .hic file and
     extracts the given contact matrix. Stores in an array in sparse upper
     triangular format: row, column, (normalized) count
 
+    Opens the file for this call only; use HicFile to run several queries
+    on one file.
+
+    Returns:
+       list of three numpy arrays: x positions, y positions (int64) and
+       counts (float64). Normalized counts are inf where the normalization
+       factor is zero and NaN where it is NaN. -1 on errors.
+
     Args:
        norm(str): Normalization type, one of VC, KR, VC_SQRT, or NONE
        infile(str): File name or URL of .hic file
@@ -422,164 +564,47 @@ def straw(norm, infile, chr1loc, chr2loc, unit, binsize):
        chr2loc(str): Chromosome name and (optionally) range, i.e. "1" or "1:10000:25000"
        unit(str): One of BP or FRAG
        binsize(int): Resolution, i.e. 25000 for 25K
+       threads(int): Threads decompressing blocks, see HicFile
     """
-    # clear the global variable blockMap so that it won't keep the data from previous calls
-    for blockNum in list(blockMap.keys()):
-        blockMap.pop(blockNum)
-
-    magic_string = ""
-    if (infile.startswith("http")):
-        # try URL first. 100K should be sufficient for header
-        headers={'range' : 'bytes=0-100000', 'x-amz-meta-requester' : 'straw'}
-        s = requests.Session()
-        r=s.get(infile, headers=headers)
-        if (r.status_code >=400):
-            print("Error accessing " + infile)
-            print("HTTP status code " + str(r.status_code))
-            return -1
-        req=io.BytesIO(r.content)
-        myrange=r.headers['content-range'].split('/')
-        totalbytes=myrange[1]
-    else:
-        req=open(infile, 'rb')
-
-    if (not (norm=="NONE" or norm=="VC" or norm=="VC_SQRT" or norm=="KR")):
-        print("Norm specified incorrectly, must be one of <NONE/VC/VC_SQRT/KR>\nUsage: straw <NONE/VC/VC_SQRT/KR> <hicFile(s)> <chr1>[:x1:x2] <chr2>[:y1:y2] <BP/FRAG> <binsize>\n")
-        return -1
-    if (not (unit=="BP" or unit=="FRAG")):
-        print("Unit specified incorrectly, must be one of <BP/FRAG>\nUsage: straw <NONE/VC/VC_SQRT/KR> <hicFile(s)> <chr1>[:x1:x2] <chr2>[:y1:y2] <BP/FRAG> <binsize>\n")
+    try:
+        with HicFile(infile, threads=threads) as hic:
+            print('HiC version:' + '  {0}'.format(str(hic.version)))
+            return hic.straw(norm, chr1loc, chr2loc, unit, binsize)
+    except ValueError as e:
+        print(e)
         return -1
-    c1pos1=-100
-    c1pos2=-100
-    c2pos1=-100
-    c2pos2=-100
-    chr1_arra = chr1loc.split(":")
-    chr2_arra = chr2loc.split(":")
-    chr1=chr1_arra[0]
-    chr2=chr2_arra[0]
-    if(len(chr1_arra)==3):
-        c1pos1=chr1_arra[1]
-        c1pos2=chr1_arra[2]
-    if(len(chr2_arra)==3):
-        c2pos1=chr2_arra[1]
-        c2pos2=chr2_arra[2]
-
-    list1 = readHeader(req, chr1, chr2, [c1pos1, c1pos2, c2pos1, c2pos2])
-
-    master=list1[0]
-    chr1ind=list1[1]
-    chr2ind=list1[2]
-    c1pos1=int(list1[3])
-    c1pos2=int(list1[4])
-    c2pos1=int(list1[5])
-    c2pos2=int(list1[6])
-    c1=min(chr1ind,chr2ind)
-    c2=max(chr1ind,chr2ind)
-    origRegionIndices=[]
-    regionIndices=[]
-    if (chr1ind > chr2ind):
-        origRegionIndices.append(c2pos1)
-        origRegionIndices.append(c2pos2)
-        origRegionIndices.append(c1pos1)
-        origRegionIndices.append(c1pos2)
-        regionIndices.append(int(c2pos1/binsize))
-        regionIndices.append(int(c2pos2/binsize))
-        regionIndices.append(int(c1pos1/binsize))
-        regionIndices.append(int(c1pos2/binsize))
-    else:
-        origRegionIndices.append(c1pos1)
-        origRegionIndices.append(c1pos2)
-        origRegionIndices.append(c2pos1)
-        origRegionIndices.append(c2pos2)
-        regionIndices.append(int(c1pos1/binsize))
-        regionIndices.append(int(c1pos2/binsize))
-        regionIndices.append(int(c2pos1/binsize))
-        regionIndices.append(int(c2pos2/binsize))
-
-    # Get footer: from master to end of file
-    if (infile.startswith("http")):
-        headers={'range' : 'bytes={0}-{1}'.format(master, totalbytes) , 'x-amz-meta-requester' : 'straw'}
-        #print("Requesting {} bytes".format(int(totalbytes)-master))
-        r=s.get(infile, headers=headers);
-        #print("Received {} bytes".format(r.headers['Content-Length']))
-        req=io.BytesIO(r.content)
-    else:
-        req.seek(master)
-
-    list1 = readFooter(req, c1, c2, norm, unit, binsize)
-    myFilePos=list1[0]
-    c1NormEntry=list1[1]
-    c2NormEntry=list1[2]
-
-    if (norm != "NONE"):
-        if (infile.startswith("http")):
-            endrange='bytes={0}-{1}'.format(c1NormEntry['position'],c1NormEntry['position']+c1NormEntry['size'])
-            headers={'range' : endrange, 'x-amz-meta-requester' : 'straw'}
-            r=s.get(infile, headers=headers);
-            req=io.BytesIO(r.content);
-            c1Norm = readNormalizationVector(req)
-
-            endrange='bytes={0}-{1}'.format(c2NormEntry['position'],c2NormEntry['position']+c2NormEntry['size'])
-            headers={'range' : endrange, 'x-amz-meta-requester' : 'straw'}
-            r=s.get(infile, headers=headers)
-            req=io.BytesIO(r.content)
-            c2Norm = readNormalizationVector(req)
-        else:
-            req.seek(c1NormEntry['position'])
-            c1Norm = readNormalizationVector(req)
-            req.seek(c2NormEntry['position'])
-            c2Norm = readNormalizationVector(req)
-
-    if (infile.startswith("http")):
-        headers={'range' : 'bytes={0}-'.format(myFilePos), 'x-amz-meta-requester' : 'straw'}
-        r=s.get(infile, headers=headers, stream=True)
-        list1 = readMatrix(r.raw, unit, binsize)
-    else:
-        req.seek(myFilePos)
-        list1 = readMatrix(req, unit, binsize)
-
-    blockBinCount=list1[0]
-    blockColumnCount=list1[1]
-    blockNumbers = getBlockNumbersForRegionFromBinPosition(regionIndices, blockBinCount, blockColumnCount, c1==c2)
-    yActual=[]
-    xActual=[]
-    counts=[]
-
-    for i_set in (blockNumbers):
-        idx=dict()
-        if(i_set in blockMap):
-            idx=blockMap[i_set]
-        else:
-            idx['size']=0
-            idx['position']=0
-        if (idx['size']==0):
-            records=[]
-        else:
-            if (infile.startswith("http")):
-                endrange='bytes={0}-{1}'.format(idx['position'], idx['position']+idx['size'])
-                headers={'range' : endrange, 'x-amz-meta-requester' : 'straw'}
-                r=s.get(infile, headers=headers);
-                req=io.BytesIO(r.content);
-            else:
-                req.seek(idx['position'])
-            records=readBlock(req, idx['size'])
-
-        for j in range(len(records)):
-            rec=records[j]
-            x=rec['binX']*binsize
-            y=rec['binY']*binsize
-            c=rec['counts']
-            if (norm != "NONE"):
-                a=c1Norm[rec['binX']]*c2Norm[rec['binY']]
-                if (a!=0.0):
-                    c=(c/(c1Norm[rec['binX']]*c2Norm[rec['binY']]))
-                else:
-                    c="inf"
-            if ((x>=origRegionIndices[0] and x<=origRegionIndices[1] and y>=origRegionIndices[2] and y<=origRegionIndices[3]) or ((c1==c2) and y>=origRegionIndices[0] and y<=origRegionIndices[1] and x>= origRegionIndices[2] and x<=origRegionIndices[3])):
-	            xActual.append(x)
-	            yActual.append(y)
-	            counts.append(c)
-    return [xActual, yActual, counts]
+
+def filterRecords(binXs, binYs, blockCounts, binsize, origRegionIndices, intra,
+                  c1Norm=None, c2Norm=None):
+    """ Normalizes the decoded block records and keeps those inside the
+    requested region, all as array operations
+
+    Args:
+       binXs, binYs, blockCounts (lists of arrays): Records of each block
+       binsize (int): Resolution
+       origRegionIndices (list): Requested x start, x end, y start, y end
+       intra (bool): Whether this is an intrachromosomal matrix; then the
+       region is also matched with x and y swapped
+       c1Norm, c2Norm (arrays, optional): Normalization vectors
+
+    Returns:
+       list of three numpy arrays: x positions, y positions and counts
+    """
+    if not binXs:
+        return [np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)]
+    binX = np.concatenate(binXs).astype(np.int64)
+    binY = np.concatenate(binYs).astype(np.int64)
+    counts = np.concatenate(blockCounts).astype(np.float64)
+    if c1Norm is not None:
+        a = c1Norm[binX] * c2Norm[binY]
+        counts = np.divide(counts, a, out=np.full(len(counts), np.inf), where=a != 0.0)
+    x = binX * binsize
+    y = binY * binsize
+    x1, x2, y1, y2 = origRegionIndices
+    keep = (x >= x1) & (x <= x2) & (y >= y1) & (y <= y2)
+    if intra:
+        keep |= (y >= x1) & (y <= x2) & (x >= y1) & (x <= y2)
+    return [x[keep], y[keep], counts[keep]]
 
 def printme(norm, infile, chr1loc, chr2loc, unit, binsize,outfile):
     """ Reads a .hic file and extracts and prints the given contact matrix
@@ -596,7 +621,6 @@ def printme(norm, infile, chr1loc, chr2loc, unit, binsize,outfile):
     """
     f = open(outfile, 'w')
     result = straw(norm, infile, chr1loc, chr2loc, unit, binsize)
-    for i in range(len(result[0])):
-        f.write("{0}\t{1}\t{2}\n".format(result[0][i], result[1][i], result[2][i]))
-        #print("{0}\t{1}\t{2}".format(result[0][i], result[1][i], result[2][i]))
+    for x, y, c in zip(result[0].tolist(), result[1].tolist(), result[2].tolist()):
+        f.write("{0}\t{1}\t{2}\n".format(x, y, c))
     f.close()
@@ -0,0 +1,176 @@
+"""Tests that dups.py reproduces the duplicate rules of dups.awk"""
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script")
+sys.path.insert(0, SCRIPT_DIR)
+import dups
+
+OUTPUTS = ("merged_nodups", "dups", "optdups")
+
+
+def mnd(pos1, pos2, strand1=0, chr1="ctg1", strand2=0, chr2="ctg2", name="read"):
+    """One MND line: fragments are always 0 and 1, as paf2mnd writes them"""
+    return (f"{strand1}\t{chr1}\t{pos1}\t0\t{strand2}\t{chr2}\t{pos2}\t1\t60\t-\t-\t60\t-\t-\t"
+            f"{name}\t{name}")
+
+
+def read_outputs(prefix):
+    """Lines of name+merged_nodups.txt, dups.txt, optdups.txt (missing files as empty)"""
+    result = []
+    for kind in OUTPUTS:
+        path = f"{prefix}{kind}.txt"
+        with open(path) if os.path.exists(path) else io.StringIO() as f:
+            result.append(f.read().splitlines())
+    return tuple(result)
+
+
+def run_dups(lines, tmp_path, wobble=dups.DEFAULT_WOBBLE, optical=True, label="py"):
+    prefix = str(tmp_path / f"{label}_")
+    counts = dups.dedup_stream(io.StringIO("".join(line + "\n" for line in lines)), prefix,
+                               wobble=wobble, optical=optical)
+    outputs = read_outputs(prefix)
+    assert counts == [len(kind) for kind in outputs]
+    return outputs
+
+
+def sort_key(line):
+    """LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n for the
+    alphanumeric contig names used here"""
+    f = line.split("\t")
+    return (f[1], f[5], int(f[3]), int(f[7]), int(f[0]), int(f[4]), int(f[2]), line)
+
+
+def jitter(rng):
+    """Half of the positions repeat a cluster center exactly"""
+    return rng.randint(-6, 6) if rng.random() < 0.5 else 0
+
+
+def random_mnd(count, seed):
+    """Sorted MND with clustered positions, so that exact duplicates, wobble
+    near-duplicates and optical duplicates (Illumina names) all occur"""
+    rng = random.Random(seed)
+    centers = [rng.randrange(1000, 100000) for _ in range(count // 8 + 1)]
+    lines = []
+    for i in range(count):
+        if rng.random() < 0.5:
+            name = (f"M1:1:FC:{rng.randint(1, 2)}:{rng.randint(1101, 1102)}:"
+                    f"{rng.randint(1, 120)}:{rng.randint(1, 120)}")
+        else:
+            name = f"sim_{i}"
+        lines.append(mnd(rng.choice(centers) + jitter(rng), rng.choice(centers[:4]) + jitter(rng),
+                         strand1=rng.choice((0, 16)), chr1=rng.choice(("ctg1", "ctg2")),
+                         strand2=rng.choice((0, 16)), chr2=rng.choice(("ctg2", "ctg3")),
+                         name=name))
+    return sorted(lines, key=sort_key)
+
+
+def test_exact_duplicates(tmp_path):
+    lines = [mnd(100, 500, name="a"), mnd(100, 500, name="b"), mnd(100, 500, name="c")]
+    assert run_dups(lines, tmp_path) == ([lines[0]], lines[1:], [])
+
+
+def test_wobble_near_duplicates(tmp_path):
+    lines = [mnd(100, 500, name="a"), mnd(103, 496, name="b"), mnd(104, 505, name="c")]
+    # b is within 4 of a at both ends; c is 5 away at the second end
+    assert run_dups(lines, tmp_path) == ([lines[0], lines[2]], [lines[1]], [])
+
+
+def test_nowobble(tmp_path):
+    lines = [mnd(100, 500, name="a"), mnd(100, 500, name="b"), mnd(101, 500, name="c")]
+    assert run_dups(lines, tmp_path, wobble=0) == ([lines[0], lines[2]], [lines[1]], [])
+    assert run_dups(lines, tmp_path, label="wobble") == ([lines[0]], lines[1:], [])
+
+
+def test_no_daisy_chaining(tmp_path):
+    # one group (each line is within 4 of the previous one); c is compared
+    # with a only, because b is already marked as a duplicate
+    lines = [mnd(100, 500, name="a"), mnd(104, 500, name="b"), mnd(108, 500, name="c")]
+    assert run_dups(lines, tmp_path) == ([lines[0], lines[2]], [lines[1]], [])
+
+
+def test_group_boundaries(tmp_path):
+    # a different strand, chromosome or first position gap > wobble starts a new group
+    lines = [mnd(100, 500, name="a"), mnd(100, 500, strand1=16, name="b"),
+             mnd(100, 500, strand1=16, chr2="ctg3", name="c"),
+             mnd(105, 500, strand1=16, chr2="ctg3", name="d")]
+    assert run_dups(lines, tmp_path) == (lines, [], [])
+
+
+def test_optical_duplicates(tmp_path):
+    lines = [mnd(100, 500, name="M1:1:FC:1:1101:1000:2000"),
+             mnd(100, 500, name="M1:1:FC:1:1101:1030:2040"),
+             mnd(100, 500, name="M1:1:FC:1:1101:1100:2000")]
+    assert run_dups(lines, tmp_path) == ([lines[0]], [lines[2]], [lines[1]])
+    assert run_dups(lines, tmp_path, optical=False, label="noopt") == ([lines[0]], lines[1:], [])
+
+
+@pytest.mark.skipif(shutil.which("awk") is None, reason="awk is not installed")
+@pytest.mark.parametrize("nowobble", [False, True])
+def test_matches_dups_awk(tmp_path, nowobble):
+    lines = random_mnd(3000, seed=7)
+    text = "".join(line + "\n" for line in lines)
+    cmd = ["awk", "-f", os.path.join(SCRIPT_DIR, "dups.awk"), "-v", "name=awk_"]
+    if nowobble:
+        cmd += ["-v", "nowobble=1"]
+    subprocess.run(cmd, input=text, universal_newlines=True, cwd=str(tmp_path), check=True)
+    expected = read_outputs(str(tmp_path / "awk_"))
+    assert all(expected)
+    assert run_dups(lines, tmp_path, wobble=0 if nowobble else dups.DEFAULT_WOBBLE) == expected
+
+
+@pytest.mark.parametrize("block_bytes", [2000, 50000])
+def test_parallel_matches_single_process(tmp_path, block_bytes):
+    # small blocks put many cuts inside runs of one chromosome pair
+    lines = random_mnd(3000, seed=11)
+    expected = run_dups(lines, tmp_path)
+    prefix = str(tmp_path / "t4_")
+    counts = dups.dedup_parallel(io.StringIO("".join(line + "\n" for line in lines)), prefix,
+                                 workers=4, block_bytes=block_bytes)
+    assert read_outputs(prefix) == expected
+    assert counts == [len(kind) for kind in expected]
+
+
+def run_hash(lines, tmp_path, label, **kwargs):
+    prefix = str(tmp_path / f"{label}_")
+    counts = dups.dedup_hash(io.StringIO("".join(line + "\n" for line in lines)), prefix,
+                             tmp_dir=str(tmp_path), **kwargs)
+    outputs = read_outputs(prefix)
+    assert counts == [len(kind) for kind in outputs]
+    return outputs
+
+
+def shuffled_mnd(count, seed):
+    lines = random_mnd(count, seed)
+    random.Random(seed).shuffle(lines)
+    return lines
+
+
+def test_hash_matches_sorted_nowobble(tmp_path):
+    lines = shuffled_mnd(3000, seed=13)
+    nodups, dup_lines, optdups = run_hash(lines, tmp_path, "hash")
+    expected = run_dups(sorted(lines, key=sort_key), tmp_path, wobble=0, optical=False)
+    assert [len(nodups), len(dup_lines), len(optdups)] == [len(kind) for kind in expected]
+    assert dup_lines and not optdups
+    # one line is kept per exact-duplicate key, the first one in the input
+    first = {}
+    for line in lines:
+        first.setdefault(dups.line_key(line), line)
+    assert nodups == [line for line in lines if first[dups.line_key(line)] == line]
+
+
+def test_hash_spill_keeps_order(tmp_path, capsys):
+    lines = shuffled_mnd(3000, seed=17)
+    expected = run_hash(lines, tmp_path, "memory")
+    # room for 20 fingerprints: spills after the first block
+    spilled = run_hash(lines, tmp_path, "spill", max_memory=20 * dups.FINGERPRINT_BYTES,
+                       block_bytes=4000)
+    assert "spilling" in capsys.readouterr().err
+    assert spilled == expected
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith("dups_spill_")]
@@ -0,0 +1,173 @@
+"""Tests for the chunked PAF to MND conversion in paf2mnd.py"""
+import gzip
+import io
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script"))
+import paf2mnd
+from paf2mnd import Pairing
+
+CONTIGS = ("ctg1", "ctg_1", "ctg2", "scaffold.10", "ctg|3", "chr-9")
+PAIRINGS = [
+    paf2mnd.DEFAULT_PAIRING,
+    Pairing("all", 1, 0, True),
+    Pairing("adjacent", 1, 0, False),
+    Pairing("knn", 2, 0, True),
+    Pairing("capped", 1, 3, True),
+]
+
+
+def paf_line(name, strand, contig, start, aln_len, matches, mapq, tags):
+    return (f"{name}\t5000\t0\t{aln_len}\t{strand}\t{contig}\t900000\t{start}\t"
+            f"{start + aln_len}\t{matches}\t{aln_len}\t{mapq}{tags}\n")
+
+
+def random_paf(reads, seed):
+    """PAF grouped by read, with multi-mapped fragments, low-identity records,
+    unparsable fields, short lines and optional tags of varying length"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(reads):
+        names = []
+        for j in range(rng.randint(1, 7)):
+            # a repeated full read ID marks a multi-mapped fragment
+            names.append(rng.choice(names) if names and rng.random() < 0.1 else f"read{i}:{j}")
+        for name in names:
+            aln_len = rng.randint(100, 3000)
+            mapq = "*" if rng.random() < 0.03 else rng.randint(0, 60)
+            tags = "".join(f"\ttg:i:{rng.randint(0, 10 ** 6)}" for _ in range(rng.randint(0, 3)))
+            lines.append(paf_line(name, rng.choice("+-"), rng.choice(CONTIGS),
+                                  rng.randint(0, 10 ** 6), aln_len,
+                                  int(aln_len * rng.uniform(0.6, 1.0)), mapq, tags))
+            if rng.random() < 0.02:
+                lines.append(f"read{i}\ttruncated\n")
+    return lines
+
+
+def paf_chunks(lines, chunk_size):
+    counter = {'lines': 0}
+    chunks = list(paf2mnd.read_paf_chunks(io.StringIO("".join(lines)), chunk_size, 0, counter))
+    assert counter['lines'] == len(lines)
+    return chunks
+
+
+@pytest.mark.parametrize("pairing", PAIRINGS)
+@pytest.mark.parametrize("chunk_size", [40, 100000])
+def test_numpy_matches_fallback(monkeypatch, pairing, chunk_size):
+    pytest.importorskip("numpy")
+    lines = random_paf(300, seed=3)
+    # a base read ID that comes back later in the same chunk: the later group wins
+    lines += lines[:5]
+    chunks = paf_chunks(lines, chunk_size)
+    vectorized = [paf2mnd.process_chunk(chunk, 0.75, pairing) for chunk in chunks]
+    monkeypatch.setattr(paf2mnd, "np", None)
+    fallback = [paf2mnd.process_chunk(chunk, 0.75, pairing) for chunk in chunks]
+    assert sum(count for _, count in fallback) > 0
+    assert vectorized == fallback
+
+
+def write_bgzf(path, data, block_bytes):
+    """bgzip-style file: blocks of block_bytes uncompressed bytes and an empty EOF block"""
+    with open(path, 'wb') as f:
+        for start in range(0, len(data), block_bytes):
+            piece = data[start:start + block_bytes]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = compressor.compress(piece) + compressor.flush()
+            f.write(struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2,
+                                len(deflated) + 25))
+            f.write(deflated + struct.pack('<II', zlib.crc32(piece), len(piece)))
+        f.write(bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000"))
+    return path
+
+
+def range_outputs(path, range_bytes, bgzf, pairing):
+    """Runs process_range over every range; returns (concatenated MND, records, lines)"""
+    tasks = paf2mnd.paf_ranges(path, range_bytes, bgzf)
+    assert len(tasks) > 1 or range_bytes > os.path.getsize(path)
+    results = [paf2mnd.process_range(task, path, bgzf, 0.75, pairing) for task in tasks]
+    return ("".join(text for text, _, _ in results), sum(count for _, count, _ in results),
+            sum(line_count for _, _, line_count in results))
+
+
+@pytest.mark.parametrize("bgzf", [False, True])
+@pytest.mark.parametrize("range_bytes", [1, 97, 500, 4096, 10 ** 7])
+def test_ranges_match_whole_file(tmp_path, bgzf, range_bytes):
+    # ranges of one byte start inside nearly every line; larger ones end in
+    # the middle of groups, on line starts and on short lines
+    lines = random_paf(150, seed=5)
+    data = "".join(lines).encode()
+    expected, expected_count = paf2mnd.process_chunk(paf_chunks(lines, 10 ** 9)[0], 0.75,
+                                                     Pairing("all", 1, 0, True))
+    if bgzf:
+        path = write_bgzf(str(tmp_path / "reads.paf.gz"), data, 300)
+        with gzip.open(path) as f:
+            assert f.read() == data
+    else:
+        path = str(tmp_path / "reads.paf")
+        with open(path, 'wb') as f:
+            f.write(data)
+    text, count, line_count = range_outputs(path, range_bytes, bgzf, Pairing("all", 1, 0, True))
+    assert count == expected_count > 0
+    assert text == expected
+    assert line_count == len(lines)
+
+
+def test_range_starts_on_group_boundaries(tmp_path):
+    # every possible range start, split exactly on line starts and one byte either side
+    lines = random_paf(40, seed=9)
+    path = str(tmp_path / "reads.paf")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    expected, _ = paf2mnd.process_chunk(paf_chunks(lines, 10 ** 9)[0], 0.75)
+    cut = 0
+    for line in lines[:-1]:
+        cut += len(line)
+        for start in (cut - 1, cut, cut + 1):
+            tasks = [(0, start, True), (start, os.path.getsize(path) - start, False)]
+            results = [paf2mnd.process_range(task, path, False, 0.75) for task in tasks]
+            assert "".join(text for text, _, _ in results) == expected
+            assert sum(result[2] for result in results) == len(lines)
+
+
+def random_mnd(count, seed):
+    """MND lines whose contig names only differ in characters that sort -d
+    ignores, and numbers of different widths"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        pos1 = rng.choice((rng.randint(0, 120), rng.randint(0, 10 ** 7)))
+        pos2 = rng.randint(0, 999)
+        lines.append(f"{rng.choice((0, 16))}\t{rng.choice(CONTIGS)}\t{pos1}\t0\t"
+                     f"{rng.choice((0, 16))}\t{rng.choice(CONTIGS)}\t{pos2}\t1\t"
+                     f"{rng.randint(0, 60)}\t-\t-\t{rng.randint(0, 60)}\t-\t-\t"
+                     f"read{i % 50}\tread{i % 50}\n")
+    return lines
+
+
+@pytest.mark.skipif(shutil.which("sort") is None, reason="sort is not installed")
+@pytest.mark.parametrize("max_merge_runs", [paf2mnd.MAX_MERGE_RUNS, 3])
+def test_merge_runs_matches_sort(tmp_path, monkeypatch, max_merge_runs):
+    # 3 runs per merge forces intermediate merges of the 20 runs
+    monkeypatch.setattr(paf2mnd, "MAX_MERGE_RUNS", max_merge_runs)
+    lines = random_mnd(2000, seed=21)
+    run_dir = tmp_path / "runs"
+    run_dir.mkdir()
+    runs = [paf2mnd.write_sorted_run(lambda text: (text, 0), str(run_dir), False,
+                                     "".join(lines[i:i + 100]))[0]
+            for i in range(0, len(lines), 100)]
+    out = io.StringIO()
+    paf2mnd.merge_runs(runs, out, str(run_dir))
+    expected = subprocess.run(
+        ["sort", "-k2,2d", "-k6,6d", "-k4,4n", "-k8,8n", "-k1,1n", "-k5,5n", "-k3,3n"],
+        input="".join(lines), stdout=subprocess.PIPE, universal_newlines=True, check=True,
+        env=dict(os.environ, LC_ALL="C")).stdout
+    assert out.getvalue() == expected
+    assert not os.listdir(str(run_dir))
@@ -0,0 +1,111 @@
+"""Tests for closing straw.HicFile on the memory-mapped backend"""
+import os
+import struct
+import sys
+import zlib
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("requests")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script"))
+import straw
+
+BINSIZE = 1000
+CHROM_LENGTH = 10000
+BLOCK_BIN_COUNT = 5
+BLOCK_COLUMN_COUNT = 3
+# block number -> (binX, binY, count) records, version 8 list-of-rows blocks
+BLOCKS = {
+    0: [(0, 0, 5), (3, 1, 2)],
+    1: [(5, 2, 7), (8, 4, 1)],
+}
+
+
+def cstr(s):
+    return s.encode() + b"\0"
+
+
+def encode_block(records):
+    binXOffset = min(x for x, y, c in records)
+    binYOffset = min(y for x, y, c in records)
+    rows = dict()
+    for x, y, c in records:
+        rows.setdefault(y - binYOffset, []).append((x - binXOffset, c))
+    body = struct.pack('<h', len(rows))
+    for y, cells in sorted(rows.items()):
+        body += struct.pack('<hh', y, len(cells))
+        for x, c in cells:
+            body += struct.pack('<hh', x, c)
+    return struct.pack('<iiibb', len(records), binXOffset, binYOffset, 0, 1) + body
+
+
+def write_hic(path, corrupt=()):
+    """Writes a version 8 .hic with one chromosome "chr1" and the BLOCKS
+    matrix; blocks in corrupt get a payload that is not zlib data"""
+    out = bytearray(b"HIC\0" + struct.pack('<i', 8))
+    masterPos = len(out)
+    out += struct.pack('<q', 0) + cstr("test") + struct.pack('<i', 0)
+    out += struct.pack('<i', 1) + cstr("chr1") + struct.pack('<i', CHROM_LENGTH)
+    index = []
+    for blockNumber, records in sorted(BLOCKS.items()):
+        data = zlib.compress(encode_block(records))
+        if blockNumber in corrupt:
+            data = b"\xff" * len(data)
+        index.append((blockNumber, len(out), len(data)))
+        out += data
+    matrixPos = len(out)
+    out += struct.pack('<iii', 0, 0, 1) + cstr("BP") + struct.pack('<i', 0) + b"\0" * 16
+    out += struct.pack('<iiii', BINSIZE, BLOCK_BIN_COUNT, BLOCK_COLUMN_COUNT, len(index))
+    for entry in index:
+        out += struct.pack('<iqi', *entry)
+    matrixSize = len(out) - matrixPos
+    struct.pack_into('<q', out, masterPos, len(out))
+    footer = struct.pack('<i', 1) + cstr("0_0") + struct.pack('<qi', matrixPos, matrixSize)
+    footer += struct.pack('<iii', 0, 0, 0)
+    out += struct.pack('<i', len(footer)) + footer
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+
+def records(result):
+    return sorted(zip(result[0].tolist(), result[1].tolist(), result[2].tolist()))
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_straw_reads_blocks(tmp_path, threads):
+    path = write_hic(str(tmp_path / "ok.hic"))
+    with straw.HicFile(path, threads=threads) as hic:
+        result = hic.straw("NONE", "chr1", "chr1", "BP", BINSIZE)
+    expected = sorted((x * BINSIZE, y * BINSIZE, float(c))
+                      for block in BLOCKS.values() for x, y, c in block)
+    assert records(result) == expected
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_corrupt_block_raises_zlib_error(tmp_path, threads):
+    path = write_hic(str(tmp_path / "corrupt.hic"), corrupt=(1,))
+    with pytest.raises(zlib.error):
+        with straw.HicFile(path, threads=threads) as hic:
+            hic.straw("NONE", "chr1", "chr1", "BP", BINSIZE)
+    with pytest.raises(zlib.error):
+        straw.straw("NONE", path, "chr1", "chr1", "BP", BINSIZE, threads=threads)
+
+
+def test_close_with_held_slice(tmp_path):
+    path = write_hic(str(tmp_path / "ok.hic"))
+    hic = straw.HicFile(path)
+    data = hic.readBytes(0, 4)
+    hic.close()
+    assert bytes(data) == b"HIC\0"
+    with pytest.raises(ValueError):
+        hic.readBytes(0, 4)
+
+
+def test_exception_in_with_block_is_kept(tmp_path):
+    path = write_hic(str(tmp_path / "ok.hic"))
+    with pytest.raises(KeyError):
+        with straw.HicFile(path) as hic:
+            data = hic.readBytes(0, 4)
+            raise KeyError("chr2")